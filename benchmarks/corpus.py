@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Synthetic corpus generator.
+
+Generate realistic calendars and address books for benchmarks and load
+tests. The output only depends on the seed, so runs are comparable.
+
+"""
+
+import base64
+import datetime
+import optparse
+import os
+import random
+import subprocess
+import sys
+
+VTIMEZONES = {
+    "Europe/Oslo": """BEGIN:VTIMEZONE
+TZID:Europe/Oslo
+BEGIN:STANDARD
+DTSTART:19701025T030000
+RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=10
+TZNAME:CET
+TZOFFSETFROM:+0200
+TZOFFSETTO:+0100
+END:STANDARD
+BEGIN:DAYLIGHT
+DTSTART:19700329T020000
+RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3
+TZNAME:CEST
+TZOFFSETFROM:+0100
+TZOFFSETTO:+0200
+END:DAYLIGHT
+END:VTIMEZONE
+""",
+    "America/New_York": """BEGIN:VTIMEZONE
+TZID:America/New_York
+BEGIN:STANDARD
+DTSTART:20071104T020000
+RRULE:FREQ=YEARLY;BYDAY=1SU;BYMONTH=11
+TZNAME:EST
+TZOFFSETFROM:-0400
+TZOFFSETTO:-0500
+END:STANDARD
+BEGIN:DAYLIGHT
+DTSTART:20070311T020000
+RRULE:FREQ=YEARLY;BYDAY=2SU;BYMONTH=3
+TZNAME:EDT
+TZOFFSETFROM:-0500
+TZOFFSETTO:-0400
+END:DAYLIGHT
+END:VTIMEZONE
+""",
+    "Asia/Tokyo": """BEGIN:VTIMEZONE
+TZID:Asia/Tokyo
+BEGIN:STANDARD
+DTSTART:19700101T000000
+TZNAME:JST
+TZOFFSETFROM:+0900
+TZOFFSETTO:+0900
+END:STANDARD
+END:VTIMEZONE
+""",
+}
+
+WORDS = ("planning review standup lunch dentist budget release retro design "
+         "call sync offsite training interview demo party workshop").split()
+
+FIRST_NAMES = ("Ada Alan Barbara Claude Donald Edsger Frances Grace Ivan John "
+               "Ken Leslie Margaret Niklaus Radia Tim Tony Ursula").split()
+LAST_NAMES = ("Lovelace Turing Liskov Shannon Knuth Dijkstra Allen Hopper "
+              "Sutherland McCarthy Thompson Lamport Hamilton Wirth Perlman").split()
+
+
+def _fmt(dt):
+    return dt.strftime("%Y%m%dT%H%M%S")
+
+
+def event(rng, index, recurring=0.2, timezones=0.5, allday=0.1, start=None):
+    """Return the text of one VCALENDAR holding a single VEVENT."""
+    if start is None:
+        start = datetime.datetime(2015, 1, 1)
+    begin = start + datetime.timedelta(days=rng.randint(0, 3 * 365),
+                                       minutes=15 * rng.randint(28, 80))
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//Calypso//benchmark corpus//EN"]
+    body = ["BEGIN:VEVENT",
+            "UID:bench-%08d@calypso.example" % index,
+            "DTSTAMP:20150101T000000Z",
+            "LAST-MODIFIED:%sZ" % _fmt(begin - datetime.timedelta(days=7)),
+            "SUMMARY:%s %s" % (rng.choice(WORDS).capitalize(), rng.choice(WORDS)),
+            "DESCRIPTION:%s" % " ".join(rng.choice(WORDS) for i in range(rng.randint(5, 40)))]
+    tzid = None
+    if rng.random() < allday:
+        body.append("DTSTART;VALUE=DATE:%s" % begin.strftime("%Y%m%d"))
+        body.append("DTEND;VALUE=DATE:%s" % (begin + datetime.timedelta(days=1)).strftime("%Y%m%d"))
+    elif rng.random() < timezones:
+        tzid = rng.choice(sorted(VTIMEZONES))
+        end = begin + datetime.timedelta(minutes=30 * rng.randint(1, 6))
+        body.append("DTSTART;TZID=%s:%s" % (tzid, _fmt(begin)))
+        body.append("DTEND;TZID=%s:%s" % (tzid, _fmt(end)))
+    else:
+        end = begin + datetime.timedelta(minutes=30 * rng.randint(1, 6))
+        body.append("DTSTART:%sZ" % _fmt(begin))
+        body.append("DTEND:%sZ" % _fmt(end))
+    if rng.random() < recurring:
+        rule = rng.choice(["FREQ=DAILY;COUNT=%d" % rng.randint(2, 30),
+                           "FREQ=WEEKLY;BYDAY=MO,WE,FR",
+                           "FREQ=WEEKLY;INTERVAL=2",
+                           "FREQ=MONTHLY;BYMONTHDAY=%d" % rng.randint(1, 28),
+                           "FREQ=YEARLY"])
+        body.append("RRULE:%s" % rule)
+    body.append("END:VEVENT")
+    if tzid:
+        lines.extend(VTIMEZONES[tzid].strip().splitlines())
+    lines.extend(body)
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def _fold(line):
+    """Fold a content line at 75 octets."""
+    chunks = [line[:75]]
+    line = line[75:]
+    while line:
+        chunks.append(" " + line[:74])
+        line = line[74:]
+    return "\r\n".join(chunks)
+
+
+def vcard(rng, index, photos=0.3, photo_size=4096):
+    """Return the text of one VCARD."""
+    first = rng.choice(FIRST_NAMES)
+    last = rng.choice(LAST_NAMES)
+    lines = ["BEGIN:VCARD", "VERSION:3.0",
+             "UID:bench-card-%08d@calypso.example" % index,
+             "N:%s;%s;;;" % (last, first),
+             "FN:%s %s" % (first, last),
+             "ORG:%s Inc." % rng.choice(LAST_NAMES),
+             "EMAIL;TYPE=INTERNET:%s.%s%d@example.com" % (first.lower(), last.lower(), index),
+             "TEL;TYPE=CELL:+47 %08d" % rng.randint(0, 99999999),
+             "ADR;TYPE=HOME:;;%d %s Street;Springfield;;%05d;USA" % (
+                 rng.randint(1, 999), rng.choice(LAST_NAMES), rng.randint(0, 99999)),
+             "REV:20150101T000000Z"]
+    if rng.random() < photos:
+        photo = "".join(chr(rng.randint(0, 255)) for i in range(photo_size))
+        lines.append(_fold("PHOTO;ENCODING=b;TYPE=JPEG:" + base64.b64encode(photo)))
+    lines.append("END:VCARD")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def calendar(count, seed=0, **kwargs):
+    """Return the texts of ``count`` events."""
+    rng = random.Random(seed)
+    return [event(rng, i, **kwargs) for i in range(count)]
+
+
+def addressbook(count, seed=0, **kwargs):
+    """Return the texts of ``count`` vcards."""
+    rng = random.Random(seed)
+    return [vcard(rng, i, **kwargs) for i in range(count)]
+
+
+def named(text):
+    """``text`` naming itself by its UID, as the files written by calypso do."""
+    lines = text.split("\r\n")
+    uid = [line[len("UID:"):] for line in lines if line.startswith("UID:")][0]
+    lines.insert(1, "X-CALYPSO-NAME:%s" % uid)
+    return "\r\n".join(lines)
+
+
+def write_collection(path, texts, extension, is_calendar=True, git=True):
+    """Store ``texts`` as a git-backed collection in ``path``."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(path, ".calypso-collection"), "w") as f:
+        f.write("[collection]\nis-calendar = %d\nis-addressbook = %d\n" % (
+            is_calendar, not is_calendar))
+    prefix = "cal-" if extension == ".ics" else "card-"
+    for i, text in enumerate(texts):
+        with open(os.path.join(path, "%s%08d%s" % (prefix, i, extension)), "w") as f:
+            f.write(named(text))
+    if git:
+        devnull = open(os.devnull, "w")
+        subprocess.check_call(["git", "init", "-q"], cwd=path)
+        subprocess.check_call(["git", "config", "user.name", "Calypso Benchmark"], cwd=path)
+        subprocess.check_call(["git", "config", "user.email", "bench@example.com"], cwd=path)
+        subprocess.check_call(["git", "add", "-A"], cwd=path)
+        subprocess.check_call(["git", "commit", "-q", "-m", "benchmark corpus"],
+                              cwd=path, stdout=devnull)
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] DIRECTORY")
+    parser.add_option("-e", "--events", type="int", default=1000, help="number of events")
+    parser.add_option("-c", "--cards", type="int", default=1000, help="number of vcards")
+    parser.add_option("--recurring", type="float", default=0.2, help="share of recurring events")
+    parser.add_option("--timezones", type="float", default=0.5, help="share of events with a TZID")
+    parser.add_option("--allday", type="float", default=0.1, help="share of all-day events")
+    parser.add_option("--photos", type="float", default=0.3, help="share of vcards with a photo")
+    parser.add_option("--seed", type="int", default=0, help="random seed")
+    parser.add_option("--user", default="bench", help="owner of the generated collections")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("missing output directory")
+    root = os.path.join(args[0], options.user)
+    write_collection(os.path.join(root, "calendar"),
+                     calendar(options.events, options.seed, recurring=options.recurring,
+                              timezones=options.timezones, allday=options.allday),
+                     ".ics")
+    write_collection(os.path.join(root, "addressbook"),
+                     addressbook(options.cards, options.seed, photos=options.photos),
+                     ".vcf", is_calendar=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
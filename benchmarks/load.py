@@ -0,0 +1,369 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+CalDAV load generator.
+
+Start Calypso on a generated corpus and drive it with concurrent
+simulated clients over loopback. Each client follows the sync pattern of
+real CalDAV clients: poll the collection ctag, list the etags when it
+changed, fetch the changed items with a multiget, and now and then PUT
+or DELETE an event of its own.
+
+    python -m benchmarks.load --clients 20 --duration 60
+
+Throughput, latency percentiles and error rates are reported per request
+type, and can be saved as JSON.
+
+"""
+
+import base64
+import httplib
+import json
+import optparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import xml.etree.ElementTree as ET
+
+from . import corpus
+
+CTAG_REQUEST = """<?xml version="1.0" encoding="utf-8"?>
+<D:propfind xmlns:D="DAV:" xmlns:CS="http://calendarserver.org/ns/">
+  <D:prop><CS:getctag/></D:prop>
+</D:propfind>"""
+
+ETAGS_REQUEST = """<?xml version="1.0" encoding="utf-8"?>
+<D:propfind xmlns:D="DAV:">
+  <D:prop><D:getetag/></D:prop>
+</D:propfind>"""
+
+MULTIGET_REQUEST = """<?xml version="1.0" encoding="utf-8"?>
+<C:calendar-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+  <D:prop><D:getetag/><C:calendar-data/></D:prop>
+%s
+</C:calendar-multiget>"""
+
+DAV = "{DAV:}"
+CS = "{http://calendarserver.org/ns/}"
+
+
+class RequestError(Exception):
+    pass
+
+
+class Stats(object):
+    """Latencies and errors of every request type."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, kind, seconds, error=False):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            if error:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, duration):
+        result = {}
+        for kind, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            result[kind] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(kind, 0),
+                "throughput": len(latencies) / duration,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1],
+            }
+        return result
+
+
+def percentile(values, percent):
+    """The ``percent`` percentile of the sorted ``values``."""
+    if not values:
+        return None
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class Client(threading.Thread):
+    """Simulated CalDAV client syncing one collection."""
+
+    def __init__(self, number, options, stats, deadline):
+        threading.Thread.__init__(self, name="load-client-%d" % number)
+        self.daemon = True
+        self.number = number
+        self.options = options
+        self.stats = stats
+        self.deadline = deadline
+        self.random = random.Random(options.seed + number)
+        url = urlparse.urlparse(options.url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.collection = url.path.rstrip("/") + "/"
+        self.headers = {
+            "User-Agent": "calypso-load/%d" % number,
+            "Authorization": "Basic " + base64.b64encode(
+                "%s:%s" % (options.user, options.password)),
+        }
+        if options.gzip:
+            self.headers["Accept-Encoding"] = "gzip"
+        self.connection = None
+        self.ctag = None
+        self.etags = {}
+        self.created = []
+        self.counter = 0
+
+    def request(self, kind, method, path, body=None, headers=None, expect=(200, 207)):
+        reused = self.connection is not None
+        if self.connection is None:
+            self.connection = httplib.HTTPConnection(self.host, self.port, timeout=60)
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        start = time.time()
+        try:
+            try:
+                self.connection.request(method, path, body, all_headers)
+                response = self.connection.getresponse()
+            except (socket.error, httplib.BadStatusLine):
+                if not reused:
+                    raise
+                # The server closed the idle persistent connection, retry
+                # on a new one as HTTP clients do
+                self.connection.close()
+                self.connection.request(method, path, body, all_headers)
+                response = self.connection.getresponse()
+            data = response.read()
+            if response.getheader("Content-Encoding") == "gzip":
+                import zlib
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            if response.will_close:
+                self.connection.close()
+                self.connection = None
+        except (socket.error, httplib.HTTPException) as e:
+            self.stats.add(kind, time.time() - start, True)
+            self.connection.close()
+            self.connection = None
+            raise RequestError("%s %s: %s" % (method, path, e))
+        error = response.status not in expect
+        self.stats.add(kind, time.time() - start, error)
+        if error:
+            raise RequestError("%s %s: %d" % (method, path, response.status))
+        return data
+
+    def poll_ctag(self):
+        data = self.request("ctag", "PROPFIND", self.collection, CTAG_REQUEST,
+                            {"Depth": "0", "Content-Type": "text/xml"})
+        ctag = ET.fromstring(data).find(".//" + CS + "getctag")
+        return ctag.text if ctag is not None else None
+
+    def list_etags(self):
+        data = self.request("etags", "PROPFIND", self.collection, ETAGS_REQUEST,
+                            {"Depth": "1", "Content-Type": "text/xml"})
+        etags = {}
+        for response in ET.fromstring(data).findall(DAV + "response"):
+            href = response.find(DAV + "href").text
+            etag = response.find(".//" + DAV + "getetag")
+            if etag is not None and etag.text and href.rstrip("/") + "/" != self.collection:
+                etags[href] = etag.text
+        return etags
+
+    def multiget(self, hrefs):
+        body = MULTIGET_REQUEST % "\n".join(
+            "  <D:href>%s</D:href>" % href for href in hrefs)
+        self.request("multiget", "REPORT", self.collection, body,
+                     {"Depth": "1", "Content-Type": "text/xml"})
+
+    def put(self):
+        self.counter += 1
+        index = 10 ** 6 * (self.number + 1) + self.counter
+        text = corpus.event(self.random, index)
+        uid = "bench-%08d@calypso.example" % index
+        href = self.collection + uid + ".ics"
+        self.request("put", "PUT", href, text,
+                     {"Content-Type": "text/calendar", "If-None-Match": "*"},
+                     expect=(200, 201, 204))
+        self.created.append(href)
+
+    def delete(self):
+        href = self.created.pop(self.random.randrange(len(self.created)))
+        self.request("delete", "DELETE", href, expect=(200, 204))
+
+    def sync(self):
+        ctag = self.poll_ctag()
+        if ctag == self.ctag:
+            return
+        etags = self.list_etags()
+        changed = [href for href, etag in etags.items() if self.etags.get(href) != etag]
+        for start in range(0, len(changed), self.options.multiget):
+            self.multiget(changed[start:start + self.options.multiget])
+        self.etags = etags
+        self.ctag = ctag
+
+    def step(self):
+        self.sync()
+        if self.random.random() < self.options.writes:
+            if self.created and self.random.random() < 0.5:
+                self.delete()
+            else:
+                self.put()
+
+    def run(self):
+        while time.time() < self.deadline:
+            try:
+                self.step()
+            except (RequestError, ET.ParseError) as e:
+                if self.options.verbose:
+                    sys.stderr.write("client %d: %s\n" % (self.number, e))
+            if self.options.think:
+                time.sleep(self.random.expovariate(1.0 / self.options.think))
+        if self.connection is not None:
+            self.connection.close()
+
+
+class LocalServer(object):
+    """Calypso running in a subprocess on a generated storage folder."""
+
+    def __init__(self, options):
+        self.root = tempfile.mkdtemp(prefix="calypso-load-")
+        storage = os.path.join(self.root, "calendars")
+        corpus.write_collection(os.path.join(storage, options.user, "calendar"),
+                                corpus.calendar(options.events, options.seed), ".ics")
+        self.port = options.port or free_port()
+        filename = os.path.join(self.root, "config")
+        with open(filename, "w") as f:
+            f.write("[storage]\nfolder = %s\n" % storage)
+            if options.config:
+                with open(options.config) as extra:
+                    f.write("\n" + extra.read())
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              "calypso.py")
+        env = dict(os.environ, CALYPSO_CONFIG=filename)
+        self.process = subprocess.Popen(
+            [sys.executable, script, "--foreground", "--host", "127.0.0.1",
+             "--port", str(self.port)], env=env)
+        self.url = "http://127.0.0.1:%d/%s/calendar/" % (self.port, options.user)
+        self.wait()
+
+    def wait(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Calypso exited with status %d" % self.process.returncode)
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        raise RuntimeError("Calypso did not start listening on port %d" % self.port)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.root)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def print_report(report):
+    print("%-10s %8s %7s %9s %9s %9s %9s" % (
+        "request", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for kind, result in sorted(report["requests"].items()):
+        print("%-10s %8d %7d %9.1f %9.2f %9.2f %9.2f" % (
+            kind, result["requests"], result["errors"], result["throughput"],
+            result["p50"] * 1000, result["p95"] * 1000, result["p99"] * 1000))
+    print("total: %d requests, %.1f req/s, %.2f%% errors" % (
+        report["total"], report["throughput"], report["error_rate"] * 100))
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--clients", type="int", default=10, help="concurrent clients")
+    parser.add_option("-t", "--duration", type="float", default=30, help="seconds to run")
+    parser.add_option("--think", type="float", default=0.0,
+                      help="mean pause between client steps in seconds")
+    parser.add_option("--writes", type="float", default=0.05,
+                      help="probability of a PUT or DELETE after each sync")
+    parser.add_option("--multiget", type="int", default=50, help="hrefs per multiget")
+    parser.add_option("-e", "--events", type="int", default=500, help="events in the corpus")
+    parser.add_option("--seed", type="int", default=0, help="random seed")
+    parser.add_option("--url", help="collection of an already running server to load")
+    parser.add_option("--port", type="int", help="port of the local server")
+    parser.add_option("--config", help="extra configuration for the local server")
+    parser.add_option("--user", default="bench", help="user name")
+    parser.add_option("--password", default="bench", help="password")
+    parser.add_option("--gzip", action="store_true", help="accept gzip responses")
+    parser.add_option("-o", "--output", help="save the report to this JSON file")
+    parser.add_option("-v", "--verbose", action="store_true", help="print request errors")
+    options, args = parser.parse_args(argv)
+
+    server = None
+    if not options.url:
+        server = LocalServer(options)
+        options.url = server.url
+    try:
+        stats = Stats()
+        start = time.time()
+        deadline = start + options.duration
+        clients = [Client(i, options, stats, deadline) for i in range(options.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        duration = time.time() - start
+    finally:
+        if server is not None:
+            server.close()
+
+    requests = stats.report(duration)
+    total = sum(result["requests"] for result in requests.values())
+    errors = sum(result["errors"] for result in requests.values())
+    report = {
+        "clients": options.clients,
+        "duration": duration,
+        "total": total,
+        "throughput": total / duration,
+        "error_rate": float(errors) / total if total else 0.0,
+        "requests": requests,
+    }
+    print_report(report)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Calypso benchmarks.
+
+Time the hot paths of the server against a generated corpus and save
+the results as JSON, so runs on different commits can be compared:
+
+    python -m benchmarks.run -o before.json
+    git checkout other-branch
+    python -m benchmarks.run -o after.json --compare before.json
+
+"""
+
+import base64
+import hashlib
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import calypso.config
+from calypso import webdav, xmlutils
+from calypso.acl import htpasswd
+
+from . import corpus
+
+PROPFIND_REQUEST = """<?xml version="1.0" encoding="utf-8"?>
+<D:propfind xmlns:D="DAV:" xmlns:CS="http://calendarserver.org/ns/">
+  <D:prop><D:getetag/><D:resourcetype/><CS:getctag/></D:prop>
+</D:propfind>"""
+
+MULTIGET_REQUEST = """<?xml version="1.0" encoding="utf-8"?>
+<C:calendar-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+  <D:prop><D:getetag/><C:calendar-data/></D:prop>
+%s
+</C:calendar-multiget>"""
+
+TIME_RANGE_REQUEST = """<?xml version="1.0" encoding="utf-8"?>
+<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+  <D:prop><D:getetag/></D:prop>
+  <C:filter>
+    <C:comp-filter name="VCALENDAR">
+      <C:comp-filter name="VEVENT">
+        <C:time-range start="20160101T000000Z" end="20160201T000000Z"/>
+      </C:comp-filter>
+    </C:comp-filter>
+  </C:filter>
+</C:calendar-query>"""
+
+
+def measure(function, repeat, setup=None):
+    """Run ``function`` ``repeat`` times and return the durations."""
+    times = []
+    for i in range(repeat):
+        argument = setup() if setup else None
+        start = time.time()
+        if setup:
+            function(argument)
+        else:
+            function()
+        times.append(time.time() - start)
+    return times
+
+
+def summary(times, operations=1):
+    times = sorted(times)
+    middle = len(times) // 2
+    if len(times) % 2:
+        median = times[middle]
+    else:
+        median = (times[middle - 1] + times[middle]) / 2.0
+    return {
+        "runs": len(times),
+        "operations": operations,
+        "min": times[0],
+        "median": median,
+        "mean": sum(times) / len(times),
+        "max": times[-1],
+    }
+
+
+class Bench(object):
+    """Benchmarks sharing a generated storage folder."""
+
+    def __init__(self, options):
+        self.options = options
+        self.root = tempfile.mkdtemp(prefix="calypso-bench-")
+        calypso.config.set("storage", "folder", self.root)
+        calypso.config.set("storage", "watch", "False")
+        self.events = corpus.calendar(options.events, options.seed)
+        self.cards = corpus.addressbook(options.cards, options.seed)
+        corpus.write_collection(os.path.join(self.root, "bench", "calendar"), self.events, ".ics")
+        corpus.write_collection(os.path.join(self.root, "bench", "addressbook"), self.cards,
+                                ".vcf", is_calendar=False)
+        self.calendar = webdav.Collection("/bench/calendar")
+        self.results = {}
+
+    def close(self):
+        shutil.rmtree(self.root)
+
+    def run(self, name, function, operations=1, setup=None, repeat=None):
+        if self.options.only and not any(only in name for only in self.options.only):
+            return
+        times = measure(function, repeat or self.options.repeat, setup)
+        result = self.results[name] = summary(times, operations)
+        print("%-24s %10.3f ms median %10.3f ms min  (%d ops)" % (
+            name, result["median"] * 1000, result["min"] * 1000, operations))
+        sys.stdout.flush()
+
+    def all(self):
+        events, cards = self.events, self.cards
+        self.run("parse_events", lambda: [webdav.Item(text, None, None, "/bench/calendar")
+                                          for text in events], len(events))
+        self.run("parse_vcards", lambda: [webdav.Item(text, None, None, "/bench/addressbook")
+                                          for text in cards], len(cards))
+        self.run("scan_dir_cold", lambda: webdav.Collection("/bench/calendar"), len(events))
+
+        calendar = self.calendar
+        self.run("propfind_depth1",
+                 lambda: xmlutils.propfind("/bench/calendar/", PROPFIND_REQUEST, calendar, "1",
+                                           {"user": "bench"}),
+                 len(events))
+
+        hrefs = "\n".join("  <D:href>/bench/calendar/%s</D:href>" % item.name
+                          for item in calendar.items[:self.options.multiget])
+        multiget = MULTIGET_REQUEST % hrefs
+        self.run("report_multiget",
+                 lambda: xmlutils.report("/bench/calendar/", multiget, calendar),
+                 min(len(events), self.options.multiget))
+        self.run("report_time_range",
+                 lambda: xmlutils.report("/bench/calendar/", TIME_RANGE_REQUEST, calendar),
+                 len(events))
+
+        filter_element = xmlutils.ET.fromstring(TIME_RANGE_REQUEST).find(
+            xmlutils._tag("C", "filter"))
+        items = calendar.items
+        self.run("match_filter",
+                 lambda: [xmlutils.match_filter(item, filter_element) for item in items],
+                 len(items))
+
+        self.bench_put()
+        self.bench_htpasswd()
+
+    def bench_put(self):
+        counter = [0]
+
+        def new_event():
+            counter[0] += 1
+            text = corpus.event(corpus.random.Random(counter[0]), 10 ** 7 + counter[0])
+            return text
+
+        calendar = self.calendar
+        self.run("put_git",
+                 lambda text: calendar.append(None, text, {"user": "bench", "user-agent": None}),
+                 setup=new_event, repeat=self.options.puts)
+
+    def bench_htpasswd(self):
+        filename = os.path.join(self.root, "htpasswd")
+        password = "secret"
+        users = ["user%04d" % i for i in range(self.options.users)]
+        digest = "{SHA}" + base64.b64encode(hashlib.sha1(password).digest())
+        with open(filename, "w") as f:
+            for user in users:
+                f.write("%s:%s\n" % (user, digest))
+        old = htpasswd.FILENAME, htpasswd.PERSONAL, htpasswd.CHECK_PASSWORD
+        htpasswd.FILENAME, htpasswd.PERSONAL, htpasswd.CHECK_PASSWORD = \
+            filename, False, htpasswd._sha1
+        try:
+            last = users[-1]
+            self.run("htpasswd_sha1", lambda: htpasswd.has_right(last, last, password))
+        finally:
+            htpasswd.FILENAME, htpasswd.PERSONAL, htpasswd.CHECK_PASSWORD = old
+
+
+def git_revision():
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=directory).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Print the ratio of each median to the one of ``previous``."""
+    print("")
+    print("%-24s %12s %12s %8s" % ("benchmark", "before", "after", "ratio"))
+    for name in sorted(results):
+        if name not in previous:
+            continue
+        before = previous[name]["median"]
+        after = results[name]["median"]
+        print("%-24s %9.3f ms %9.3f ms %7.2fx" % (
+            name, before * 1000, after * 1000, after / before if before else float("inf")))
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("-e", "--events", type="int", default=500, help="number of events")
+    parser.add_option("-c", "--cards", type="int", default=500, help="number of vcards")
+    parser.add_option("-r", "--repeat", type="int", default=5, help="runs of each benchmark")
+    parser.add_option("--puts", type="int", default=20, help="number of PUT runs")
+    parser.add_option("--multiget", type="int", default=100, help="items per multiget")
+    parser.add_option("--users", type="int", default=1000, help="htpasswd file entries")
+    parser.add_option("--seed", type="int", default=0, help="corpus random seed")
+    parser.add_option("-k", "--only", action="append", help="only run matching benchmarks")
+    parser.add_option("-o", "--output", help="save results to this JSON file")
+    parser.add_option("--compare", help="compare with results saved in this JSON file")
+    options, args = parser.parse_args(argv)
+
+    bench = Bench(options)
+    try:
+        bench.all()
+    finally:
+        bench.close()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "options": {"events": options.events, "cards": options.cards,
+                    "repeat": options.repeat, "seed": options.seed},
+        "results": bench.results,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            compare(bench.results, json.load(f)["results"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -41,6 +41,7 @@ import lockfile
 import logging
 import optparse
 import os
+import signal
 import sys
 
 import calypso
@@ -80,10 +81,27 @@ parser.add_option(
     help="certificate file ")
 parser.add_option(
     "-i", "--import", dest="import_dest")
+parser.add_option(
+    "-e", "--export", dest="export_dest",
+    help="export collections to this directory, - for stdout")
+parser.add_option(
+    "-j", "--jobs", type="int", default=1,
+    help="number of collections exported in parallel")
+parser.add_option(
+    "--layout", choices=calypso.layout.LAYOUTS,
+    help="move the item files of collections to the flat or sharded layout")
 parser.add_option(
     "-g", "--debug", action="store_true",
     default=False,
     help="enable debug logging")
+parser.add_option(
+    "-w", "--warm-up", action="store_true", dest="warmup",
+    default=calypso.config.getboolean("server", "warmup"),
+    help="load all collections in the background at startup")
+parser.add_option(
+    "--follower", action="store_true",
+    default=calypso.config.getboolean("server", "follower"),
+    help="serve read-only from git repositories following a primary server")
 parser.add_option(
     "-P", "--pid-file", dest="pidfile",
     default=calypso.config.get("server", "pidfile"),
@@ -97,6 +115,8 @@ for option in parser.option_list:
     if key:
         value = getattr(options, key)
         calypso.config.set("server", key, value)
+# Read back as a boolean
+calypso.config.set("server", "follower", str(options.follower))
 
 log = logging.getLogger()
 ch = logging.StreamHandler()
@@ -115,6 +135,7 @@ else:
 
 # Run import if requested
 if options.import_dest:
+    webdav.parse_pool()
     try:
         collection = webdav.Collection(options.import_dest)
     except Exception:
@@ -129,15 +150,60 @@ if options.import_dest:
     else:
         sys.exit(1)
 
+# Run export if requested
+if options.export_dest:
+    collections = args or calypso.warmup.discover()
+    if calypso.export.export(collections, options.export_dest, options.jobs):
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+# Change the layout of collections if requested
+if options.layout:
+    success = True
+    for urlpath in args or calypso.warmup.discover():
+        try:
+            moved = webdav.Collection(urlpath).set_layout(options.layout)
+            log.warning("Moved %d files of %s to the %s layout", moved, urlpath, options.layout)
+        except Exception:
+            log.exception("Cannot change the layout of %s", urlpath)
+            success = False
+    sys.exit(0 if success else 1)
+
 def run_server():
+    # Fork the parse workers before any thread starts
+    calypso.webdav.parse_pool()
     try:
         # Launch server
         log.debug("Starting HTTP%s server on %s:%d" % ("S" if options.ssl else "",
                                                        options.host if options.host else "*",
                                                        options.port))
-        server_class = calypso.HTTPSServer if options.ssl else calypso.HTTPServer
-        server = server_class(
-            (options.host, options.port), calypso.CollectionHTTPHandler)
+        engine = calypso.config.get("server", "engine")
+        if engine == "eventloop" and options.ssl:
+            log.error("The eventloop engine does not support SSL, using the blocking engine")
+            engine = "blocking"
+        if engine == "eventloop":
+            server = calypso.engine.EventLoopServer(
+                (options.host, options.port), calypso.CollectionHTTPHandler)
+        else:
+            server_class = calypso.HTTPSServer if options.ssl else calypso.HTTPServer
+            server = server_class(
+                (options.host, options.port), calypso.CollectionHTTPHandler)
+        signal.signal(signal.SIGUSR2, calypso.profiler.toggle)
+        signal.signal(signal.SIGUSR1, calypso.memory.signal_handler(
+            calypso.CollectionHTTPHandler.collections))
+        if calypso.config.getboolean("memory", "trace"):
+            calypso.memory.start()
+        calypso.metrics.start_server()
+        calypso.accesslog.setup()
+        if calypso.maintenance.enabled():
+            calypso.maintenance.start()
+        if options.follower:
+            calypso.follower.start(calypso.CollectionHTTPHandler.collections)
+        if options.warmup:
+            calypso.warmup.start(calypso.CollectionHTTPHandler.collections)
+        else:
+            calypso.warmup.mark_ready()
         server.serve_forever(poll_interval=10)
     except KeyboardInterrupt:
         server.socket.close()
@@ -39,10 +39,13 @@ import os.path
 import base64
 import socket
 import time
+import urlparse
 import email.utils
 import logging
 import rfc822
+import select
 import ssl
+import threading
 
 # Manage Python2/3 different modules
 # pylint: disable=F0401
@@ -53,7 +56,7 @@ except ImportError:
     import BaseHTTPServer as server
 # pylint: enable=F0401
 
-from . import acl, config, webdav, xmlutils, paths, gssapi
+from . import acl, accesslog, cache, compression, config, engine, export, follower, layout, maintenance, memory, metrics, notify, profiler, tls, tzcache, webdav, xmlutils, paths, gssapi, warmup
 
 log = logging.getLogger()
 ch = logging.StreamHandler()
@@ -64,28 +67,43 @@ negotiate = gssapi.Negotiate(log)
 
 VERSION = "1.5"
 
+def _authenticate(request, owner):
+    """Return the user of ``request`` and whether it has rights on ``owner``'s collections."""
+    # pylint: disable=W0212
+    user = password = None
+    negotiate_success = False
+
+    with metrics.phase("auth"):
+        authorization = request.headers.get("Authorization", None)
+        if authorization:
+            if authorization.startswith("Basic"):
+                challenge = authorization.lstrip("Basic").strip().encode("ascii")
+                plain = request._decode(base64.b64decode(challenge))
+                user, password = plain.split(":")
+            elif negotiate.enabled():
+                user, negotiate_success = negotiate.try_aaa(authorization, request, owner)
+                metrics.note("auth", "negotiate")
+        if not negotiate_success:
+            metrics.note("auth", request.server.acl.__name__.rsplit(".", 1)[-1])
+        metrics.note("user", user)
+
+        # Also send UNAUTHORIZED if there's no collection. Otherwise one
+        # could probe the server for (non-)existing collections.
+        allowed = request.server.acl.has_right(owner, user, password) or negotiate_success
+    return user, allowed
+    # pylint: enable=W0212
+
+
 def _check(request, function):
     """Check if user has sufficient rights for performing ``request``."""
     # ``_check`` decorator can access ``request`` protected functions
     # pylint: disable=W0212
-    owner = user = password = None
-    negotiate_success = False
-
+    owner = None
     if request._collection:
         owner = request._collection.owner
 
-    authorization = request.headers.get("Authorization", None)
-    if authorization:
-        if authorization.startswith("Basic"):
-            challenge = authorization.lstrip("Basic").strip().encode("ascii")
-            plain = request._decode(base64.b64decode(challenge))
-            user, password = plain.split(":")
-        elif negotiate.enabled():
-            user, negotiate_success = negotiate.try_aaa(authorization, request, owner)
-
-    # Also send UNAUTHORIZED if there's no collection. Otherwise one
-    # could probe the server for (non-)existing collections.
-    if request.server.acl.has_right(owner, user, password) or negotiate_success:
+    user, allowed = request.authenticate(owner)
+    if allowed:
         function(request, context={"user": user, "user-agent": request.headers.get("User-Agent", None)})
     else:
         request.send_calypso_response(client.UNAUTHORIZED, 0)
@@ -110,22 +128,69 @@ class HTTPServer(server.HTTPServer):
         self.acl = acl.load()
     # pylint: enable=W0231
 
+    def waiting_sockets(self):
+        """Sockets readable while other clients are waiting to be served."""
+        return [self.socket] if self.socket is not None else []
+
+    def clients_waiting(self):
+        """Whether other clients are waiting for their connection to be accepted."""
+        try:
+            return bool(select.select(self.waiting_sockets(), [], [], 0)[0])
+        except (select.error, socket.error):
+            return False
+
 
 class HTTPSServer(HTTPServer):
     """HTTPS server."""
     PROTOCOL = "https"
 
     def __init__(self, address, handler):
-        """Create server by wrapping HTTP socket in an SSL socket."""
+        """Create server, loading the certificate once and for all."""
         HTTPServer.__init__(self, address, handler)
-        self.socket = ssl.wrap_socket(
-            socket.socket(self.address_family, self.socket_type),
-            server_side=True,
-            certfile=os.path.expanduser(config.get("server", "certificate")),
-            keyfile=os.path.expanduser(config.get("server", "key")),
-            ssl_version=ssl.PROTOCOL_SSLv23)
-        self.server_bind()
-        self.server_activate()
+        tls.context()
+        # Connections are still handled one at a time, by the thread
+        # holding this lock
+        self.serving = threading.Lock()
+        # A byte for each connection waiting for the lock, so that an
+        # idle persistent connection can be given up for it
+        self.wake_read, self.wake_write = os.pipe()
+
+    def process_request(self, request, client_address):
+        """Handle the connection ``request`` in its own thread.
+
+        The listening socket is a plain one, so that a slow handshake
+        happens there, with a timeout, rather than in ``accept`` or in
+        the thread accepting connections.
+
+        """
+        thread = threading.Thread(target=self.process_connection,
+                                  args=(request, client_address))
+        thread.daemon = True
+        thread.start()
+
+    def process_connection(self, request, client_address):
+        """Complete the TLS handshake, then handle the connection."""
+        connection = tls.handshake(request, client_address)
+        if connection is None:
+            return
+        os.write(self.wake_write, "x")
+        with self.serving:
+            os.read(self.wake_read, 1)
+            try:
+                self.finish_request(connection, client_address)
+            except Exception:
+                self.handle_error(connection, client_address)
+            finally:
+                tls.shutdown(connection)
+                self.shutdown_request(request)
+
+    def waiting_sockets(self):
+        return HTTPServer.waiting_sockets(self) + [self.wake_read]
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        os.close(self.wake_read)
+        os.close(self.wake_write)
 
 
 class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
@@ -142,9 +207,17 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
 
     timeout = 90
 
+    # Buffer the responses so that the status line, the headers and
+    # small bodies go out in a single send; handle_one_request flushes
+    wbufsize = -1
+
     server_version = "Calypso/%s" % VERSION
     queued_headers = {}
 
+    # Set by the event loop engine when a request waiting for changes
+    # is put aside until they happen
+    parked = None
+
     def queue_header(self, keyword, value):
         self.queued_headers[keyword] = value
 
@@ -159,6 +232,24 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             self.queued_headers = {}
         return server.BaseHTTPRequestHandler.end_headers(self)
 
+    def setup(self):
+        server.BaseHTTPRequestHandler.setup(self)
+        self.wfile = metrics.CountingFile(self.wfile)
+        self.handled_requests = 0
+
+    def send_error(self, code, message=None):
+        # Error pages are sent with "Connection: close" and no length
+        self.close_connection = 1
+        server.BaseHTTPRequestHandler.send_error(self, code, message)
+
+    def send_response(self, code, message=None):
+        self.status = code
+        server.BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def authenticate(self, owner):
+        """Return the user of the request and whether it has rights on ``owner``'s collections."""
+        return _authenticate(self, owner)
+
     def address_string(self):
         return str(self.client_address[0])
 
@@ -168,13 +259,31 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             conntype = "Keep-Alive"
         self.send_header("Connection", conntype)
 
-    def send_calypso_response(self, response, length):
+    def send_calypso_response(self, response, length, coding=None):
         self.send_response(response)
         self.send_connection_header()
         self.send_header("Content-Length", length)
+        if coding:
+            self.send_header("Content-Encoding", coding)
+            self.send_header("Vary", "Accept-Encoding")
         for header, value in config.items('headers'):
             self.send_header(header, value)
 
+    def accepted_coding(self):
+        """Content coding to use for the response, or None."""
+        return compression.negotiate(self.headers.get("Accept-Encoding", None))
+
+    def compress_answer(self, answer):
+        """Compress ``answer`` if the client accepts it and it is large enough.
+
+        Return the (possibly compressed) answer and the coding used.
+
+        """
+        coding = self.accepted_coding()
+        if not coding or len(answer) < compression.min_size():
+            return answer, None
+        return compression.compress(answer, coding), coding
+
 
     def handle_one_request(self):
         """Handle a single HTTP request.
@@ -188,11 +297,15 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             self.wfile.flush()
             self.close_connection = 1
 
+            if self.handled_requests and not self.next_request_ready():
+                log.debug("Closing idle connection")
+                return
+
             self.connection.settimeout(5)
 
             self.raw_requestline = self.rfile.readline(65537)
 
-            self.connection.settimeout(90)
+            self.connection.settimeout(self.timeout)
 
             if len(self.raw_requestline) > 65536:
                 log.error("Read request too long")
@@ -205,29 +318,18 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
                 log.error("Connection closed")
                 return
             log.debug("First line '%s'", self.raw_requestline)
-            if not self.parse_request():
-                # An error code has been sent, just exit
-                self.close_connection = 1
-                return
-            # parse_request clears close_connection on all http/1.1 links
-            # it should only do this if a keep-alive header is seen
-            self.close_connection = 1
-            conntype = self.headers.get('Connection', "")
-            if (conntype.lower() == 'keep-alive'
-                and self.protocol_version >= "HTTP/1.1"):
-                log.debug("keep-alive")
-                self.close_connection = 0
-            reqlen = self.headers.get('Content-Length',"0")
-            log.debug("reqlen %s", reqlen)
-            self.xml_request = self.rfile.read(int(reqlen))
-            mname = 'do_' + self.command
-            if not hasattr(self, mname):
-                log.error("Unsupported method (%r)", self.command)
-                self.send_error(501, "Unsupported method (%r)" % self.command)
-                return
-            method = getattr(self, mname)
-            method()
-            self.wfile.flush() #actually send the response if not already done.
+            self.status = None
+            self.request_bytes = 0
+            self.response_start = self.wfile.written
+            metrics.begin_request()
+            profile = profiler.start()
+            try:
+                self.handle_request()
+            finally:
+                self.handled_requests += 1
+                self.account_request(profile)
+            # Send the response before waiting for the next request
+            self.wfile.flush()
         except socket.timeout as e:
             #a read or a write timed out.  Discard this connection
             log.error("Request timed out: %r", e)
@@ -240,17 +342,213 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             return
 
 
-    collections = {}
+    def handle_request(self):
+        """Parse the request whose first line has been read and answer it."""
+        if not self.parse_request():
+            # An error code has been sent, just exit
+            self.close_connection = 1
+            return
+        self.close_connection = int(not self.keep_alive())
+        reqlen = self.headers.get('Content-Length',"0")
+        log.debug("reqlen %s", reqlen)
+        self.xml_request = self.rfile.read(int(reqlen))
+        self.request_bytes = len(self.xml_request)
+        content_coding = self.headers.get('Content-Encoding', "")
+        if content_coding:
+            try:
+                self.xml_request = compression.decompress(self.xml_request, content_coding)
+            except ValueError as e:
+                log.error("Cannot decode request body: %s", e)
+                self.send_error(415, str(e))
+                return
+        if self.is_metrics_request():
+            self.send_metrics()
+            return
+        if self.is_memory_request():
+            self.send_memory()
+            return
+        if self.command in engine.WRITE_METHODS and follower.enabled():
+            self.refuse_write()
+            return
+        mname = 'do_' + self.command
+        if not hasattr(self, mname):
+            log.error("Unsupported method (%r)", self.command)
+            self.send_error(501, "Unsupported method (%r)" % self.command)
+            return
+        method = getattr(self, mname)
+        method()
+        self.wfile.flush() #actually send the response if not already done.
+
+    def next_request_ready(self):
+        """Wait for the next request on a persistent connection.
+
+        The server handles one connection at a time: give the connection
+        up once it has been idle for the keep-alive timeout, or as soon as
+        it is idle while other clients are waiting. Persistent connections
+        are thus only kept while the server is not busy.
+
+        """
+        rbuf = getattr(self.rfile, "_rbuf", None)
+        if rbuf is not None and rbuf.tell():
+            # Pipelined request already read
+            return True
+        pending = getattr(self.connection, "pending", None)
+        if pending is not None and pending():
+            return True
+        waiting = [self.connection] + self.server.waiting_sockets()
+        try:
+            readable = select.select(waiting, [], [],
+                                     config.getfloat("server", "keepalive_timeout"))[0]
+        except (select.error, socket.error):
+            return False
+        return self.connection in readable
+
+    def clients_waiting(self):
+        """Whether other clients are waiting to be served."""
+        return self.server.clients_waiting()
+
+    def keep_alive(self):
+        """Whether the connection persists after this request.
+
+        As in RFC 7230, HTTP/1.1 connections persist unless the client
+        asks to close them, HTTP/1.0 ones only if it asks to keep them
+        alive. Connections are closed after a maximum number of requests.
+
+        """
+        tokens = [token.strip().lower()
+                  for token in self.headers.get('Connection', "").split(",")]
+        if "close" in tokens:
+            return False
+        if self.request_version == "HTTP/1.0" and "keep-alive" not in tokens:
+            return False
+        max_requests = config.getint("server", "keepalive_requests")
+        if max_requests and self.handled_requests + 1 >= max_requests:
+            return False
+        # Let the waiting clients in rather than holding the server
+        return not self.clients_waiting()
+
+    def account_request(self, profile=None):
+        """Record metrics for the request that was just handled.
+
+        Dump ``profile`` if the request was slow.
+
+        """
+        record = metrics.end_request()
+        elapsed = record.elapsed
+        command = getattr(self, 'command', None)
+        if not command or not hasattr(self, 'do_' + command):
+            command = "other"
+        status = str(self.status or 0)
+        metrics.REQUESTS.inc(method=command, status=status)
+        metrics.REQUEST_SECONDS.observe(elapsed, method=command, status=status)
+        profiler.finish(profile, command, elapsed, self.describe_request)
+        accesslog.write(record,
+                        client=self.client_address[0],
+                        method=getattr(self, 'command', None),
+                        path=getattr(self, 'path', None),
+                        status=self.status,
+                        request_bytes=self.request_bytes,
+                        response_bytes=self.wfile.written - self.response_start)
+
+    def describe_request(self):
+        """Lines describing the current request, for diagnostics."""
+        lines = ["request: %s" % getattr(self, 'requestline', ''),
+                 "status: %s" % self.status]
+        if not getattr(self, 'path', None):
+            return lines
+        path = paths.collection_from_path(urlparse.urlparse(self.path).path)
+        if path:
+            lines.append("collection: %s" % path)
+            collection = CollectionHTTPHandler.collections.peek(path)
+            if collection is not None:
+                lines.append("items: %d" % len(collection.my_items))
+        return lines
+
+    def is_local_client(self):
+        return self.client_address[0] in ("127.0.0.1", "::1", "::ffff:127.0.0.1")
+
+    def is_metrics_request(self):
+        path = config.get("metrics", "path")
+        if not path or self.command != "GET" or self.path.split("?")[0] != path:
+            return False
+        # Metrics are only served to local clients
+        return self.is_local_client()
+
+    def send_metrics(self):
+        self._answer = metrics.render().encode("utf-8")
+        self.send_calypso_response(client.OK, len(self._answer))
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.end_headers()
+        self.wfile.write(self._answer)
+
+    def refuse_write(self):
+        """Answer a write to a follower, redirecting it to the primary if known."""
+        primary = config.get("follower", "primary")
+        if primary:
+            self.send_calypso_response(client.TEMPORARY_REDIRECT, 0)
+            self.send_header("Location", primary.rstrip("/") + self.path)
+        else:
+            self.send_calypso_response(client.FORBIDDEN, 0)
+        self.end_headers()
+
+    def is_memory_request(self):
+        path = config.get("memory", "path")
+        if not path or self.command != "GET" or self.path.split("?")[0] != path:
+            return False
+        # The memory report is only served to local clients
+        return self.is_local_client()
+
+    def is_admin(self):
+        """Whether the request is authenticated as one of ``[memory] admins``."""
+        admins = [admin.strip() for admin in config.get("memory", "admins").split(",")
+                  if admin.strip()]
+        if not admins:
+            return False
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Basic"):
+            return False
+        plain = self._decode(base64.b64decode(authorization[len("Basic"):].strip()))
+        user, _, password = plain.partition(":")
+        return user in admins and self.server.acl.has_right(user, user, password)
+
+    def send_memory(self):
+        """Answer with the memory report.
+
+        ``?trace=start`` and ``?trace=stop`` turn allocation tracing on and
+        off, ``?snapshot=1`` adds a tracemalloc snapshot to the report.
+
+        """
+        if not self.is_admin():
+            self.send_calypso_response(client.UNAUTHORIZED, 0)
+            self.send_header(
+                "WWW-Authenticate",
+                'Basic realm="Calypso CalDAV/CardDAV server - password required"')
+            self.end_headers()
+            return
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        trace = query.get("trace", [""])[0]
+        if trace == "start":
+            memory.start()
+        elif trace == "stop":
+            memory.stop()
+        take_snapshot = query.get("snapshot", ["0"])[0] not in ("", "0")
+        self._answer = memory.render(CollectionHTTPHandler.collections,
+                                     take_snapshot).encode("utf-8")
+        self.send_calypso_response(client.OK, len(self._answer))
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(self._answer)
+
+    collections = cache.CollectionCache()
 
     @property
     def _collection(self):
         """The ``webdav.Collection`` object corresponding to the given path."""
-        path = paths.collection_from_path(self.path)
+        path = paths.collection_from_path(urlparse.urlparse(self.path).path)
         if not path:
             return None
-        if not path in CollectionHTTPHandler.collections:
-            CollectionHTTPHandler.collections[path] = webdav.Collection(path)
-        return CollectionHTTPHandler.collections[path]
+        metrics.note("collection", path)
+        return CollectionHTTPHandler.collections.get(path)
 
     def _decode(self, text):
         """Try to decode text according to various parameters."""
@@ -281,7 +579,12 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
     @check_rights
     def do_GET(self, context):
         """Manage GET request."""
-        self.do_get_head(context, True)
+        path, _, query = self.path.partition("?")
+        query = urlparse.parse_qs(query)
+        if "since" in query and self._collection and not paths.resource_from_path(path):
+            self.do_changes(query)
+        else:
+            self.do_get_head(context, True)
 
     @check_rights
     def do_HEAD(self, context):
@@ -293,6 +596,7 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
 
         self._answer = ''
         answer_text = ''
+        coding = None
         try:
             item_name = paths.resource_from_path(self.path)
             if item_name and self._collection:
@@ -310,21 +614,26 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             elif self._collection:
                 # Get whole collection
                 if is_get:
-                    answer_text = self._collection.text
+                    coding = self.accepted_coding()
+                    if coding:
+                        self._answer = self._collection.compressed_text(coding, self._encoding)
+                    else:
+                        answer_text = self._collection.text
                 etag = self._collection.etag
             else:
                 self.send_calypso_response(client.NOT_FOUND, 0)
                 self.end_headers()
                 return
 
-            if is_get:
+            if is_get and not coding:
                 try:
                     self._answer = answer_text.encode(self._encoding,"xmlcharrefreplace")
                 except UnicodeDecodeError:
                     answer_text = answer_text.decode(errors="ignore")
                     self._answer = answer_text.encode(self._encoding,"ignore")
+                self._answer, coding = self.compress_answer(self._answer)
 
-            self.send_calypso_response(client.OK, len(self._answer))
+            self.send_calypso_response(client.OK, len(self._answer), coding)
             self.send_header("Content-Type", "text/calendar")
             self.send_header("Last-Modified", email.utils.formatdate(time.mktime(self._collection.last_modified)))
             self.send_header("ETag", etag)
@@ -336,6 +645,56 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             self.send_calypso_response(client.BAD_REQUEST, 0)
             self.end_headers()
 
+    def do_changes(self, query):
+        """Answer with the ctag of the collection once it changes.
+
+        ``since`` is the ctag the client knows, and ``timeout`` how long
+        to wait for it to change, at most ``[server] longpoll_timeout``
+        seconds; the answer is 304 Not Modified if it did not.
+
+        """
+        since = query["since"][0]
+        timeout = config.getfloat("server", "longpoll_timeout")
+        try:
+            timeout = max(0, min(timeout, float(query.get("timeout", [timeout])[0])))
+        except ValueError:
+            pass
+        ctag = self.wait_for_changes(self._collection, since, self.changes_deadline(timeout))
+        if self.parked:
+            return
+        if ctag is None:
+            self.send_calypso_response(client.NOT_MODIFIED, 0)
+            self.end_headers()
+            return
+        self._answer = ctag.encode("ascii")
+        self.send_calypso_response(client.OK, len(self._answer))
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(self._answer)
+
+    def changes_deadline(self, timeout):
+        return time.time() + timeout
+
+    def wait_for_changes(self, collection, since, deadline):
+        """Wait for the ctag of ``collection`` to differ from ``since``.
+
+        Return the new ctag, or None once ``deadline`` passed. As for
+        persistent connections, give up as soon as other clients are
+        waiting, the server handling one connection at a time.
+
+        """
+        while True:
+            seen = notify.version(collection.urlpath)
+            ctag = collection.ctag
+            if ctag != since:
+                return ctag
+            remaining = deadline - time.time()
+            if remaining <= 0 or self.clients_waiting():
+                return None
+            # Collections that are not watched are looked at every second
+            notify.wait(collection.urlpath, seen, min(remaining, 1))
+
     def if_match(self, item):
         header = self.headers.get("If-Match", item.etag)
         header = rfc822.unquote(header)
@@ -360,10 +719,11 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
                 # No ETag precondition or precondition verified, delete item
                 self._answer = xmlutils.delete(self.path, self._collection, context=context)
 
-                self.send_calypso_response(client.NO_CONTENT, len(self._answer))
-                self.send_header("Content-Type", "text/xml")
+                # A 204 response has no body, whatever its Content-Length:
+                # sending the answer would corrupt the next response on a
+                # persistent connection
+                self.send_calypso_response(client.NO_CONTENT, 0)
                 self.end_headers()
-                self.wfile.write(self._answer)
             elif not item:
                 # Item does not exist
                 self.send_calypso_response(client.NOT_FOUND, 0)
@@ -377,6 +737,78 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             self.send_calypso_response(client.BAD_REQUEST, 0)
             self.end_headers()
 
+    @check_rights
+    def do_COPY(self, context):
+        """Manage COPY request."""
+        self.transfer(context, False)
+
+    @check_rights
+    def do_MOVE(self, context):
+        """Manage MOVE request."""
+        self.transfer(context, True)
+
+    def destination(self):
+        """Collection and item name of the Destination header, or None.
+
+        Read rfc4918-10.3 for info.
+
+        """
+        header = self.headers.get("Destination", None)
+        if not header:
+            return None
+        path = urlparse.urlparse(header).path
+        collection_path = paths.collection_from_path(path)
+        name = paths.resource_from_path(path)
+        if not collection_path or not name or not paths.is_collection(collection_path):
+            return None
+        return CollectionHTTPHandler.collections.get(collection_path), name
+
+    def transfer(self, context, move):
+        """Manage either MOVE or COPY request of an item.
+
+        Collections are git repositories, or directories of one, and are
+        not moved or copied.
+
+        """
+        try:
+            item_name = paths.resource_from_path(self.path)
+            item = self._collection.get_item(item_name) if item_name else None
+            destination = self.destination()
+            if not item_name:
+                status = client.FORBIDDEN
+            elif not item:
+                status = client.NOT_FOUND
+            elif not self.if_match(item):
+                status = client.PRECONDITION_FAILED
+            elif destination is None:
+                # No collection to hold the item
+                status = client.CONFLICT
+            else:
+                collection, name = destination
+                old_item = collection.get_item(name)
+                overwrite = self.headers.get("Overwrite", "T").strip().upper() != "F"
+                if old_item is item:
+                    status = client.FORBIDDEN
+                elif old_item and not overwrite:
+                    status = client.PRECONDITION_FAILED
+                elif collection.owner != self._collection.owner and \
+                        not _authenticate(self, collection.owner)[1]:
+                    status = client.FORBIDDEN
+                else:
+                    new_item = self._collection.transfer(
+                        item, collection, name, move, context=context)
+                    status = client.NO_CONTENT if old_item else client.CREATED
+                    self.send_calypso_response(status, 0)
+                    self.send_header("ETag", new_item.etag)
+                    self.end_headers()
+                    return
+            self.send_calypso_response(status, 0)
+            self.end_headers()
+        except Exception:
+            log.exception("Failed %s for %s", self.command, self.path)
+            self.send_calypso_response(client.BAD_REQUEST, 0)
+            self.end_headers()
+
     @check_rights
     def do_MKCALENDAR(self, context):
         """Manage MKCALENDAR request."""
@@ -387,11 +819,31 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
         """Manage OPTIONS request."""
         self.send_calypso_response(client.OK, 0)
         self.send_header(
-            "Allow", "DELETE, HEAD, GET, MKCALENDAR, "
-            "OPTIONS, PROPFIND, PUT, REPORT")
+            "Allow", "COPY, DELETE, HEAD, GET, MKCALENDAR, MOVE, "
+            "OPTIONS, POST, PROPFIND, PUT, REPORT")
         self.send_header("DAV", "1, access-control, calendar-access, addressbook")
         self.end_headers()
 
+    @check_rights
+    def do_POST(self, context):
+        """Manage POST request of a batch of changes to a collection."""
+        try:
+            if not self._collection or paths.resource_from_path(self.path):
+                self.send_calypso_response(client.METHOD_NOT_ALLOWED, 0)
+                self.end_headers()
+                return
+            self._answer = xmlutils.batch(self.path, self.xml_request,
+                                          self._collection, context=context)
+            self._answer, coding = self.compress_answer(self._answer)
+            self.send_calypso_response(client.MULTI_STATUS, len(self._answer), coding)
+            self.send_header("Content-Type", "text/xml")
+            self.end_headers()
+            self.wfile.write(self._answer)
+        except Exception:
+            log.exception("Failed POST for %s", self.path)
+            self.send_calypso_response(client.BAD_REQUEST, 0)
+            self.end_headers()
+
     @check_rights
     def do_PROPFIND(self, context):
         """Manage PROPFIND request."""
@@ -410,7 +862,8 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
 
             log.debug("PROPFIND ANSWER %s", self._answer)
 
-            self.send_calypso_response(status, len(self._answer))
+            self._answer, coding = self.compress_answer(self._answer)
+            self.send_calypso_response(status, len(self._answer), coding)
             self.send_header("DAV", "1, calendar-access")
             self.send_header("Content-Type", "text/xml")
             self.end_headers()
@@ -472,7 +925,8 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             log.debug("REPORT %s %s", self.path, xml_request)
             self._answer = xmlutils.report(self.path, xml_request, self._collection)
             log.debug("REPORT ANSWER %s", self._answer)
-            self.send_calypso_response(client.MULTI_STATUS, len(self._answer))
+            self._answer, coding = self.compress_answer(self._answer)
+            self.send_calypso_response(client.MULTI_STATUS, len(self._answer), coding)
             self.send_header("Content-Type", "text/xml")
             self.end_headers()
             self.wfile.write(self._answer)
@@ -482,3 +936,20 @@ class CollectionHTTPHandler(server.BaseHTTPRequestHandler):
             self.end_headers()
 
     # pylint: enable=C0103
+
+
+def _cache_stat(stat):
+    return lambda: CollectionHTTPHandler.collections.stats()[stat]
+
+metrics.Callback("calypso_cache_collections", "Collections held in memory.",
+                 _cache_stat("collections"))
+metrics.Callback("calypso_cache_memory_bytes",
+                 "Estimated memory held by cached collections.",
+                 _cache_stat("memory"))
+for _stat in ("hits", "misses", "evictions", "reloads"):
+    metrics.Callback("calypso_cache_%s_total" % _stat, "Collection cache %s." % _stat,
+                     _cache_stat(_stat), kind="counter")
+metrics.Callback("calypso_timezones", "Distinct time zone definitions cached.",
+                 tzcache.size)
+metrics.Callback("calypso_ready", "Whether startup warm-up is complete.",
+                 lambda: int(warmup.ready.is_set()))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Structured access log.
+
+Write one JSON object per request. Entries are queued by the request
+thread and written in batches by a background thread, so a slow disk
+never delays a response; entries are dropped if the queue is full.
+
+"""
+
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+from . import config, metrics
+
+log = logging.getLogger()
+
+
+class BufferedHandler(logging.Handler):
+    """Logging handler writing records from a background thread."""
+
+    def __init__(self, filename, capacity=10000, batch=1000):
+        logging.Handler.__init__(self)
+        self.filename = filename
+        self.stream = open(filename, "a")
+        self.queue = Queue.Queue(capacity)
+        self.batch = batch
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="calypso-accesslog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        if lines:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                self.write(records)
+            except (IOError, OSError) as e:
+                log.error("Cannot write access log %s: %s", self.filename, e)
+            for record in records:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until every queued record is written."""
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.stream.close()
+        logging.Handler.close(self)
+
+
+class JSONFormatter(logging.Formatter):
+    """Format the ``entry`` dictionary of a record as a JSON line."""
+
+    def format(self, record):
+        entry = dict(record.entry)
+        entry["time"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + \
+            ".%03dZ" % record.msecs
+        return json.dumps(entry, sort_keys=True)
+
+
+_logger = logging.getLogger("calypso.access")
+_logger.propagate = False
+_handler = None
+
+
+def enabled():
+    return _handler is not None
+
+
+def setup():
+    """Start writing the access log if ``[accesslog] file`` is set."""
+    global _handler
+    filename = config.get("accesslog", "file")
+    if not filename or _handler is not None:
+        return _handler
+    _handler = BufferedHandler(os.path.expanduser(filename),
+                               capacity=config.getint("accesslog", "queue_size"))
+    _handler.setFormatter(JSONFormatter())
+    _logger.addHandler(_handler)
+    _logger.setLevel(logging.INFO)
+    return _handler
+
+
+def entry(record, **fields):
+    """Build the log entry for a finished request.
+
+    ``record`` is the ``metrics.RequestRecord`` of the request, ``fields``
+    the request attributes known to the handler.
+
+    """
+    result = dict(fields)
+    result.update(record.notes)
+    result.update(record.counts)
+    result["wall"] = round(record.elapsed, 6)
+    result["phases"] = dict(
+        (name, {"wall": round(wall, 6)}) for name, (wall, cpu) in record.phases.items())
+    if metrics.thread_cpu:
+        result["cpu"] = round(record.cpu, 6)
+        for name, (wall, cpu) in record.phases.items():
+            result["phases"][name]["cpu"] = round(cpu, 6)
+    return result
+
+
+def write(record, **fields):
+    """Queue the access log entry of a finished request."""
+    if _handler is None:
+        return
+    _logger.info("access", extra={"entry": entry(record, **fields)})
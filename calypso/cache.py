@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collection cache.
+
+Keep the most recently used collections in memory, bounded by a number
+of collections, an estimated memory budget and an idle time. Evicted
+collections are simply loaded again from disk on their next use.
+
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from . import config, metrics, watcher, webdav
+
+log = logging.getLogger()
+
+
+class CollectionCache(object):
+    """LRU cache of ``webdav.Collection`` objects keyed by URL path."""
+
+    def __init__(self, max_collections=None, max_memory=None, idle_timeout=None,
+                 loader=webdav.Collection):
+        if max_collections is None:
+            max_collections = config.getint("cache", "max_collections")
+        if max_memory is None:
+            max_memory = config.getint("cache", "max_memory") * 1024 * 1024
+        if idle_timeout is None:
+            idle_timeout = config.getint("cache", "idle_timeout")
+        self.max_collections = max_collections
+        self.max_memory = max_memory
+        self.idle_timeout = idle_timeout
+        self.loader = loader
+        self.lock = threading.RLock()
+        # path -> (collection, last access time), least recently used first
+        self.entries = collections.OrderedDict()
+        self.evicted = set()
+        # path -> event set once a collection being loaded is available
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        """Return the collection for ``path``, loading it if needed.
+
+        Loading happens outside of the cache lock; concurrent requests
+        for the same path wait for the first one to finish.
+
+        """
+        with self.lock:
+            now = time.time()
+            self.expire(now)
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.hits += 1
+                metrics.count("cache_hits")
+                self.entries[path] = (entry[0], now)
+                return entry[0]
+            loading = self.loading.get(path)
+            if loading is None:
+                loading = self.loading[path] = threading.Event()
+                self.misses += 1
+                metrics.count("cache_misses")
+                if path in self.evicted:
+                    self.evicted.discard(path)
+                    self.reloads += 1
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            loading.wait()
+            return self.get(path)
+
+        try:
+            collection = self.loader(path)
+        finally:
+            with self.lock:
+                del self.loading[path]
+                loading.set()
+
+        with self.lock:
+            self.entries[path] = (collection, time.time())
+            self.shrink()
+        return collection
+
+    def peek(self, path):
+        """Return the cached collection for ``path`` or None, without loading."""
+        with self.lock:
+            entry = self.entries.get(path)
+            return entry[0] if entry else None
+
+    def evict(self, path):
+        """Drop ``path`` from the cache."""
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None:
+                return
+            log.debug("Evicting collection %s", path)
+            watcher.unwatch(entry[0])
+            self.evicted.add(path)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            for path in list(self.entries):
+                self.evict(path)
+
+    def expire(self, now=None):
+        """Evict collections not used for ``idle_timeout`` seconds."""
+        if not self.idle_timeout:
+            return
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for path, (collection, used) in list(self.entries.items()):
+                if now - used < self.idle_timeout:
+                    break
+                self.evict(path)
+
+    @property
+    def memory(self):
+        """Estimated memory held by the cached collections, in bytes."""
+        with self.lock:
+            return sum(collection.estimated_size for collection, used in self.entries.values())
+
+    def is_full(self):
+        """Whether loading another collection would evict one."""
+        with self.lock:
+            if self.max_collections and len(self.entries) >= self.max_collections:
+                return True
+            return bool(self.max_memory) and self.memory >= self.max_memory
+
+    def over_budget(self):
+        if self.max_collections and len(self.entries) > self.max_collections:
+            return True
+        return bool(self.max_memory) and self.memory > self.max_memory
+
+    def shrink(self):
+        """Evict least recently used collections until within budget.
+
+        The most recently used collection is always kept.
+
+        """
+        with self.lock:
+            while len(self.entries) > 1 and self.over_budget():
+                self.evict(next(iter(self.entries)))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "collections": len(self.entries),
+                "memory": self.memory,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+            }
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+HTTP content codings.
+
+Negotiate gzip/deflate ``Content-Encoding`` for responses and undo it on
+request bodies.
+
+"""
+
+import zlib
+
+from . import config
+
+SUPPORTED = ("gzip", "deflate")
+
+# Refuse to inflate request bodies beyond this size
+MAX_DECOMPRESSED = 64 * 1024 * 1024
+
+#
+# Codings enabled in the configuration, in order of preference
+#
+
+def enabled():
+    codings = config.get("server", "compression").replace(",", " ").split()
+    return [coding.lower() for coding in codings if coding.lower() in SUPPORTED]
+
+#
+# Responses smaller than this are not worth compressing
+#
+
+def min_size():
+    return config.getint("server", "compression_min_size")
+
+#
+# Pick the coding to use for a response given the Accept-Encoding
+# header of the request, or None to send the response as is
+#
+
+def negotiate(accept_encoding):
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for element in accept_encoding.split(","):
+        params = element.strip().split(";")
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding == "x-gzip":
+            coding = "gzip"
+        qualities[coding] = q
+
+    best = None
+    best_q = 0.0
+    for coding in enabled():
+        q = qualities.get(coding, qualities.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+#
+# Return a zlib compression object producing ``coding``. HTTP
+# "deflate" is the zlib format, gzip needs the gzip wrapper.
+#
+
+def compressor(coding):
+    if coding == "gzip":
+        wbits = 16 + zlib.MAX_WBITS
+    elif coding == "deflate":
+        wbits = zlib.MAX_WBITS
+    else:
+        raise ValueError("Unsupported content coding %r" % coding)
+    return zlib.compressobj(6, zlib.DEFLATED, wbits)
+
+
+def compress(data, coding):
+    """Compress ``data`` with ``coding``."""
+    obj = compressor(coding)
+    return obj.compress(data) + obj.flush()
+
+
+def decompress(data, coding):
+    """Undo ``coding`` on ``data``.
+
+    Raise ``ValueError`` for unknown codings, corrupt data or data
+    inflating to more than ``MAX_DECOMPRESSED`` bytes.
+
+    """
+    coding = coding.strip().lower()
+    if coding in ("", "identity"):
+        return data
+    if coding in ("gzip", "x-gzip"):
+        candidates = (16 + zlib.MAX_WBITS,)
+    elif coding == "deflate":
+        # Some clients send raw deflate streams without the zlib header
+        candidates = (zlib.MAX_WBITS, -zlib.MAX_WBITS)
+    else:
+        raise ValueError("Unsupported content coding %r" % coding)
+
+    for wbits in candidates:
+        obj = zlib.decompressobj(wbits)
+        try:
+            result = obj.decompress(data, MAX_DECOMPRESSED)
+        except zlib.error:
+            continue
+        if obj.unconsumed_tail:
+            raise ValueError("Request body too large once decompressed")
+        return result + obj.flush()
+    raise ValueError("Corrupt %s request body" % coding)
@@ -45,9 +45,23 @@ INITIAL_CONFIG = {
         "ssl": "False",
         "certificate": "/etc/apache2/ssl/server.crt",
         "key": "/etc/apache2/ssl/server.key",
+        "ciphers": "",
+        "ecdh_curve": "prime256v1",
+        "session_tickets": "True",
+        "handshake_timeout": "10",
         "pidfile": "/var/run/calypso.pid",
         "user_principal": "/+%(user)s",
         "base_prefix": "/",
+        "compression": "gzip, deflate",
+        "compression_min_size": "1024",
+        "warmup": "False",
+        "ready_file": "",
+        "keepalive_timeout": "15",
+        "keepalive_requests": "100",
+        "longpoll_timeout": "300",
+        "engine": "blocking",
+        "workers": "4",
+        "follower": "False",
     },
     "encoding": {
         "request": "utf-8",
@@ -60,10 +74,56 @@ INITIAL_CONFIG = {
         "pam_service": "passwd",
     },
     "storage": {
-        "folder": os.path.expanduser("~/.config/calypso/calendars")
+        "folder": os.path.expanduser("~/.config/calypso/calendars"),
+        "watch": "False",
+        "parse_workers": "0",
+        "parse_batch": "200",
+        "import_batch": "0",
+        "fsync": "none",
     },
     "headers": {
     },
+    "metrics": {
+        "path": "",
+        "host": "127.0.0.1",
+        "port": "0",
+    },
+    "memory": {
+        "path": "",
+        "admins": "",
+        "trace": "False",
+        "trace_frames": "1",
+        "top": "20",
+    },
+    "accesslog": {
+        "file": "",
+        "queue_size": "10000",
+    },
+    "profiler": {
+        "enabled": "False",
+        "threshold": "1.0",
+        "sample_rate": "0.1",
+        "spool": "~/.cache/calypso/profiles",
+        "max_files": "50",
+        "max_size": "50",
+    },
+    "follower": {
+        "interval": "10",
+        "remote": "origin",
+        "primary": "",
+    },
+    "maintenance": {
+        "enabled": "False",
+        "check_interval": "300",
+        "loose_objects": "6700",
+        "packs": "50",
+        "gc_interval": "86400",
+    },
+    "cache": {
+        "max_collections": "0",
+        "max_memory": "0",
+        "idle_timeout": "0",
+    },
 }
 
 # Create a ConfigParser and configure it
@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Event loop server engine.
+
+A single thread multiplexes every connection with epoll (or poll) and
+only reads and writes bytes: an idle keep-alive connection costs a file
+descriptor and a few bytes of state. Once a whole request has been read,
+it is handed to a pool of worker threads running the usual
+``CollectionHTTPHandler`` on the buffered request, and the response is
+written back by the event loop.
+
+Requests on the same collection are handled one at a time, and requests
+modifying collections one at a time, since collections and git
+repositories are not safe for concurrent use.
+
+Requests waiting for the changes of a collection do not keep a worker:
+they are parked in the event loop, and handed to a worker again when
+the collection reports a change, when they time out, or every few
+seconds for one of them, to notice the changes of collections that are
+not watched.
+
+"""
+
+import collections
+import errno
+import logging
+import os
+import Queue
+import select
+import socket
+import StringIO
+import threading
+import time
+import urlparse
+
+from . import acl, config, metrics, notify, paths
+
+log = logging.getLogger()
+
+# Methods changing collections, serialized as git does not like
+# concurrent commits
+WRITE_METHODS = ("PUT", "DELETE", "MKCALENDAR", "MKCOL", "PROPPATCH", "POST", "MOVE", "COPY")
+
+MAX_HEADER_SIZE = 65536 + 8192
+RECV_SIZE = 65536
+
+# Seconds between two looks at a collection with parked requests
+PROBE_INTERVAL = 5
+
+READ = select.POLLIN | select.POLLPRI
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+class Poller(object):
+    """epoll where available, poll elsewhere, with timeouts in seconds."""
+
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            self.scale = 1000
+
+    def register(self, fd, events):
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            return self.poller.poll(timeout * self.scale)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+def request_length(data):
+    """Length of the first request in ``data``, None if it is incomplete.
+
+    Raise ValueError if the request is malformed.
+
+    """
+    end = data.find("\r\n\r\n")
+    separator = 4
+    if end < 0:
+        end = data.find("\n\n")
+        separator = 2
+    if end < 0:
+        if len(data) > MAX_HEADER_SIZE:
+            raise ValueError("Request header too long")
+        return None
+    length = 0
+    for line in data[:end].splitlines()[1:]:
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value.strip())
+            if length < 0:
+                raise ValueError("Invalid Content-Length")
+    total = end + separator + length
+    if len(data) < total:
+        return None
+    return total
+
+
+def request_header(data, name):
+    """Value of the header ``name``, given in lower case, of the request ``data``, or None."""
+    head = data.split("\r\n\r\n", 1)[0].split("\n\n", 1)[0]
+    for line in head.splitlines()[1:]:
+        key, _, value = line.partition(":")
+        if key.strip().lower() == name:
+            return value.strip()
+    return None
+
+
+# Request waiting for the changes of the collection at ``path`` until
+# ``deadline``; ``version`` is the notify version the request saw, and
+# ``credentials`` the result of its authentication
+Parked = collections.namedtuple("Parked", ["path", "deadline", "version", "credentials", "data"])
+
+
+class Connection(object):
+    """State of a client connection."""
+
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.input = ""
+        self.output = ""
+        self.busy = False
+        self.requests = 0
+        self.close_after_write = False
+        self.last_active = time.time()
+        # Parked request, kept while a worker handles it again
+        self.parked = None
+        self.waiting = False
+
+    def fileno(self):
+        return self.fd
+
+    def settimeout(self, timeout):
+        # Requests are read before being handled, handlers never block
+        pass
+
+
+def buffered_handler(handler):
+    """Subclass of the request handler class ``handler`` handling a buffered request."""
+
+    class BufferedHandler(handler):
+
+        def __init__(self, server, connection, data, output):
+            # Unlike the base class, do not handle the request right away
+            self.server = server
+            self.client_address = connection.address
+            self.request = self.connection = connection
+            self.queued_headers = {}
+            self.rfile = StringIO.StringIO(data)
+            self.wfile = metrics.CountingFile(output)
+            self.handled_requests = connection.requests
+            self.parked = None
+            self.credentials = None
+
+        # The event loop waits for requests and accepts every client
+        def next_request_ready(self):
+            return True
+
+        def clients_waiting(self):
+            return False
+
+        def authenticate(self, owner):
+            # A parked request is not authenticated again
+            parked = self.connection.parked
+            if parked is not None:
+                self.credentials = parked.credentials
+            else:
+                self.credentials = handler.authenticate(self, owner)
+            return self.credentials
+
+        def changes_deadline(self, timeout):
+            parked = self.connection.parked
+            if parked is not None:
+                return parked.deadline
+            return handler.changes_deadline(self, timeout)
+
+        def wait_for_changes(self, collection, since, deadline):
+            seen = notify.version(collection.urlpath)
+            ctag = collection.ctag
+            if ctag != since:
+                return ctag
+            if time.time() < deadline:
+                # Wait in the event loop rather than in a worker
+                self.parked = (collection.urlpath, deadline, seen)
+            return None
+
+        def account_request(self, profile=None):
+            if self.parked:
+                # Accounted for once answered
+                if profile is not None:
+                    profile.disable()
+                metrics.end_request()
+                return
+            handler.account_request(self, profile)
+
+    return BufferedHandler
+
+
+class EventLoopServer(object):
+    """HTTP server multiplexing connections in an event loop."""
+    PROTOCOL = "http"
+
+    def __init__(self, address, handler, workers=None):
+        self.RequestHandlerClass = handler
+        self.BufferedHandlerClass = buffered_handler(handler)
+        self.acl = acl.load()
+        family = socket.AF_INET
+        if address[0]:
+            # The host may be an IPv6 address or a name resolving to one
+            family, _, _, _, address = socket.getaddrinfo(
+                address[0], address[1], socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+                socket.AI_PASSIVE)[0]
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.timeout = config.getfloat("server", "keepalive_timeout")
+        self.poller = Poller()
+        self.poller.register(self.socket.fileno(), READ)
+        self.connections = {}
+        # Wake up the loop when a worker finished a request
+        self.wake_read, self.wake_write = os.pipe()
+        self.poller.register(self.wake_read, READ)
+        self.done = collections.deque()
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.collection_locks = {}
+        # collection path -> connections parked until it changes
+        self.parked = {}
+        self.changed = collections.deque()
+        self.last_probe = time.time()
+        notify.subscribe(self.collection_changed)
+        self.stopping = False
+        self.stopped = threading.Event()
+        if workers is None:
+            workers = config.getint("server", "workers")
+        self.workers = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self.work, name="calypso-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    #
+    # Event loop
+    #
+
+    def serve_forever(self, poll_interval=0.5):
+        self.stopped.clear()
+        last_expire = time.time()
+        while not self.stopping:
+            for fd, events in self.poller.poll(min(poll_interval, 1.0)):
+                if fd == self.socket.fileno():
+                    self.accept()
+                elif fd == self.wake_read:
+                    os.read(self.wake_read, 4096)
+                    self.finish_requests()
+                    self.resume_changed()
+                else:
+                    connection = self.connections.get(fd)
+                    if connection is None:
+                        continue
+                    if events & READ:
+                        self.read(connection)
+                    if events & WRITE and fd in self.connections:
+                        self.write(connection)
+                    if events & ERROR and fd in self.connections and not events & READ:
+                        self.close(connection)
+            now = time.time()
+            if now - last_expire >= 1:
+                self.expire(now)
+                last_expire = now
+        self.stopping = False
+        self.stopped.set()
+
+    def shutdown(self):
+        """Stop the event loop and wait for it to exit, as in SocketServer."""
+        self.stopping = True
+        os.write(self.wake_write, "x")
+        self.stopped.wait()
+
+    def server_close(self):
+        notify.unsubscribe(self.collection_changed)
+        for connection in list(self.connections.values()):
+            self.close(connection)
+        self.socket.close()
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    log.error("Cannot accept connection: %s", e)
+                    return
+                raise
+            sock.setblocking(0)
+            connection = Connection(sock, address)
+            self.connections[sock.fileno()] = connection
+            self.poller.register(sock.fileno(), READ)
+
+    def read(self, connection):
+        try:
+            data = connection.socket.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.close(connection)
+            return
+        if not data:
+            if not connection.busy or connection.waiting:
+                self.close(connection)
+            else:
+                connection.close_after_write = True
+                self.poller.modify(connection.fileno(), 0)
+            return
+        connection.input += data
+        connection.last_active = time.time()
+        self.dispatch(connection)
+
+    def dispatch(self, connection):
+        """Hand the next complete request of ``connection`` to a worker."""
+        if connection.busy or connection.output:
+            return
+        try:
+            length = request_length(connection.input)
+        except ValueError as e:
+            log.error("Bad request from %s: %s", connection.address[0], e)
+            connection.output = "HTTP/1.1 400 Bad Request\r\nConnection: close\r\n" \
+                                "Content-Length: 0\r\n\r\n"
+            connection.close_after_write = True
+            self.write(connection)
+            return
+        if length is None:
+            return
+        data, connection.input = connection.input[:length], connection.input[length:]
+        connection.busy = True
+        # Do not read further requests until this one is answered
+        self.poller.modify(connection.fileno(), 0)
+        self.requests.put((connection, data))
+
+    def finish_requests(self):
+        while self.done:
+            connection, output, close, parked = self.done.popleft()
+            connection.busy = False
+            connection.parked = None
+            if connection.fileno() not in self.connections:
+                continue
+            if parked is not None and not connection.close_after_write:
+                self.park(connection, parked)
+                continue
+            connection.requests += 1
+            connection.output += output
+            connection.close_after_write = connection.close_after_write or close
+            connection.last_active = time.time()
+            self.write(connection)
+
+    def write(self, connection):
+        if connection.output:
+            try:
+                sent = connection.socket.send(connection.output)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    sent = 0
+                else:
+                    self.close(connection)
+                    return
+            connection.output = connection.output[sent:]
+        if connection.output:
+            self.poller.modify(connection.fileno(), WRITE)
+            return
+        if connection.close_after_write:
+            self.close(connection)
+            return
+        self.poller.modify(connection.fileno(), READ)
+        # The client may have sent its next request already
+        self.dispatch(connection)
+
+    def close(self, connection):
+        fd = connection.fileno()
+        if self.connections.pop(fd, None) is None:
+            return
+        self.unpark(connection)
+        try:
+            self.poller.unregister(fd)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        try:
+            connection.socket.close()
+        except socket.error:
+            pass
+
+    def expire(self, now):
+        """Close connections idle for longer than the keep-alive timeout.
+
+        Also resume the parked requests that timed out, and one parked
+        request of each collection every ``PROBE_INTERVAL`` seconds.
+
+        """
+        for connection in list(self.connections.values()):
+            if not connection.busy and not connection.output and \
+                    now - connection.last_active > self.timeout:
+                self.close(connection)
+        probe = now - self.last_probe >= PROBE_INTERVAL
+        if probe:
+            self.last_probe = now
+        for waiting in list(self.parked.values()):
+            for connection in list(waiting):
+                if now >= connection.parked.deadline:
+                    self.resume(connection)
+            if probe and waiting:
+                self.resume(next(iter(waiting)))
+
+    #
+    # Requests waiting for changes
+    #
+
+    def park(self, connection, parked):
+        """Keep the request ``parked`` of ``connection`` until its collection changes."""
+        connection.busy = True
+        connection.parked = parked
+        connection.waiting = True
+        self.parked.setdefault(parked.path, set()).add(connection)
+        # Only to notice the client going away
+        self.poller.modify(connection.fileno(), READ)
+        if notify.version(parked.path) != parked.version:
+            # Changed while the request was handled
+            self.resume(connection)
+
+    def unpark(self, connection):
+        if not connection.waiting:
+            return
+        connection.waiting = False
+        waiting = self.parked.get(connection.parked.path)
+        if waiting is not None:
+            waiting.discard(connection)
+            if not waiting:
+                del self.parked[connection.parked.path]
+
+    def resume(self, connection):
+        """Hand the parked request of ``connection`` to a worker again."""
+        self.unpark(connection)
+        self.poller.modify(connection.fileno(), 0)
+        self.requests.put((connection, connection.parked.data))
+
+    def collection_changed(self, path):
+        # Called by any thread
+        if path in self.parked:
+            self.changed.append(path)
+            os.write(self.wake_write, "x")
+
+    def resume_changed(self):
+        while self.changed:
+            path = self.changed.popleft()
+            for connection in list(self.parked.get(path, ())):
+                self.resume(connection)
+
+    #
+    # Workers
+    #
+
+    def collection_lock(self, path):
+        with self.lock:
+            lock = self.collection_locks.get(path)
+            if lock is None:
+                lock = self.collection_locks[path] = threading.Lock()
+            return lock
+
+    def work(self):
+        while True:
+            connection, data = self.requests.get()
+            try:
+                output, close, parked = self.handle(connection, data)
+            except Exception:
+                log.exception("Error handling request from %s", connection.address[0])
+                output, close, parked = "", True, None
+            self.done.append((connection, output, close, parked))
+            os.write(self.wake_write, "x")
+
+    def handle(self, connection, data):
+        """Run the request handler on the buffered request ``data``.
+
+        Return the response, whether to close the connection, and the
+        ``Parked`` request if it waits for changes.
+
+        """
+        requestline = data.split("\n", 1)[0].split()
+        method = requestline[0] if requestline else ""
+        path = None
+        if len(requestline) > 1:
+            path = paths.collection_from_path(urlparse.urlparse(requestline[1]).path)
+        locked = set([path])
+        if method in ("MOVE", "COPY"):
+            # Both collections change, locked in a fixed order
+            destination = request_header(data, "destination")
+            if destination:
+                locked.add(paths.collection_from_path(urlparse.urlparse(destination).path))
+        locks = []
+        if method in WRITE_METHODS:
+            locks.append(self.write_lock)
+        locks.extend(self.collection_lock(collection) for collection in sorted(locked))
+        for lock in locks:
+            lock.acquire()
+        try:
+            output = StringIO.StringIO()
+            handler = self.BufferedHandlerClass(self, connection, data, output)
+            handler.handle_one_request()
+            parked = None
+            if handler.parked:
+                path, deadline, version = handler.parked
+                parked = Parked(path, deadline, version, handler.credentials, data)
+            return output.getvalue(), handler.close_connection, parked
+        finally:
+            for lock in reversed(locks):
+                lock.release()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collection export.
+
+Stream collections to ICS or VCF files straight from the stored item
+files, without parsing them. As for a GET of a whole collection, the
+items are written one after the other, each with its own properties, so
+that an export can be imported back as is. Items are written in file
+name order, which does not change when an item is modified, so
+successive backups diff well.
+
+"""
+
+import logging
+import multiprocessing
+import os
+import sys
+
+from . import layout, paths
+
+log = logging.getLogger()
+
+BUFFER_SIZE = 64 * 1024
+
+
+def item_files(urlpath):
+    """Stored item files of the collection ``urlpath``, in a stable order."""
+    directory = paths.url_to_file(urlpath)
+    directories = [directory]
+    if layout.directory_layout(directory) == layout.SHARDED:
+        directories.extend(layout.shards(directory))
+    files = []
+    for directory in directories:
+        for filename in os.listdir(directory):
+            # Skip .git and the collection metadata
+            if filename.startswith("."):
+                continue
+            filepath = os.path.join(directory, filename)
+            if os.path.isfile(filepath):
+                files.append(filepath)
+    # File names are unique across shards: sort on them so that the
+    # order does not depend on the layout
+    files.sort(key=os.path.basename)
+    return files
+
+
+def is_addressbook(files):
+    return bool(files) and all(filepath.endswith(".vcf") for filepath in files)
+
+
+def extension(urlpath):
+    return ".vcf" if is_addressbook(item_files(urlpath)) else ".ics"
+
+
+def write_collection(urlpath, out):
+    """Write the collection ``urlpath`` to the file object ``out``.
+
+    Return the number of items written.
+
+    """
+    files = item_files(urlpath)
+    for filepath in files:
+        with open(filepath, "rb") as f:
+            last = ""
+            for chunk in iter(lambda: f.read(BUFFER_SIZE), ""):
+                out.write(chunk)
+                last = chunk
+        if last and not last.endswith("\n"):
+            out.write("\r\n")
+    return len(files)
+
+
+def destination(directory, urlpath):
+    """File receiving the export of ``urlpath`` in ``directory``."""
+    # Named after the storage path, whatever the base prefix
+    name = os.path.relpath(paths.url_to_file(urlpath), paths.data_root())
+    if name == os.curdir:
+        name = "root"
+    return os.path.join(directory, name + extension(urlpath))
+
+
+def export_to_file(args):
+    """Export a collection to a file; runs in the worker processes.
+
+    ``args`` is the URL path of the collection and the destination
+    directory; return the path, the file written and the number of items,
+    or the path, None and the error message.
+
+    """
+    urlpath, directory = args
+    try:
+        filename = destination(directory, urlpath)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        # Write next to the destination so a backup is never left half-written
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as out:
+            count = write_collection(urlpath, out)
+        os.rename(tmp, filename)
+        return (urlpath, filename, count)
+    except Exception as ex:
+        return (urlpath, None, "%s: %s" % (type(ex).__name__, ex))
+
+
+def export(urlpaths, directory, jobs=1):
+    """Export the collections ``urlpaths`` to ``directory``, or stdout for "-".
+
+    Collections are exported by ``jobs`` processes in parallel. Return
+    whether every collection was exported.
+
+    """
+    if directory == "-":
+        success = True
+        for urlpath in urlpaths:
+            try:
+                write_collection(urlpath, sys.stdout)
+            except (IOError, OSError) as ex:
+                log.error("Cannot export %s: %s", urlpath, ex)
+                success = False
+        sys.stdout.flush()
+        return success
+    tasks = [(urlpath, directory) for urlpath in urlpaths]
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(export_to_file, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [export_to_file(task) for task in tasks]
+    success = True
+    for urlpath, filename, count in results:
+        if filename is None:
+            log.error("Cannot export %s: %s", urlpath, count)
+            success = False
+        else:
+            log.info("Exported %d items of %s to %s", count, urlpath, filename)
+    return success
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Read-only follower.
+
+A follower serves a storage folder whose git repositories are clones of
+those of a primary server. They are fetched every ``[follower]
+interval`` seconds and reset to their upstream branch; the files that
+changed between the old and the new commit are marked dirty in the
+loaded collections, which read only those files again on their next
+request. Collections of a follower learn of their changes this way
+only, as watched collections do from inotify.
+
+Writes are refused, or redirected to the primary server.
+
+"""
+
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from . import config, layout, notify, paths, warmup
+
+log = logging.getLogger()
+
+
+def enabled():
+    """Whether this server is a follower."""
+    return config.getboolean("server", "follower")
+
+
+def git(repository, *args):
+    return subprocess.check_output(("git",) + args, cwd=repository)
+
+
+def sync(repository):
+    """Bring ``repository`` up to date with its upstream branch.
+
+    Return the paths of the files changed.
+
+    """
+    try:
+        old = git(repository, "rev-parse", "--verify", "--quiet", "HEAD").strip()
+    except subprocess.CalledProcessError:
+        # Nothing checked out yet
+        old = None
+    git(repository, "fetch", "--quiet", config.get("follower", "remote"))
+    new = git(repository, "rev-parse", "@{upstream}").strip()
+    if old == new:
+        return []
+    if old is None:
+        names = git(repository, "ls-tree", "-r", "-z", "--name-only", new)
+    else:
+        names = git(repository, "diff", "--name-only", "-z", "--no-renames", old, new)
+    git(repository, "reset", "--hard", "--quiet", new)
+    log.info("Updated %s to %s", repository, new)
+    return [os.path.join(repository, name) for name in names.split("\0") if name]
+
+
+def urlpath(directory):
+    """URL path of the collection stored in ``directory``."""
+    return paths.file_to_url(directory)
+
+
+def refresh(collections, filepaths):
+    """Mark the ``filepaths`` dirty in the collections of the cache ``collections``.
+
+    A file is marked in the collection of its directory, or of the
+    directory of its shard. Collections above only learn of the
+    subcollections added or removed.
+
+    """
+    root = paths.data_root()
+    changed = set()
+    for filepath in filepaths:
+        child = filepath
+        directory = os.path.dirname(filepath)
+        while True:
+            collection = collections.peek(urlpath(directory))
+            if collection is not None:
+                if child == filepath or (
+                        child == os.path.dirname(filepath) and collection.sharded and
+                        layout.is_shard_name(os.path.basename(child))):
+                    collection.mark_dirty(filepath)
+                    changed.add(collection.urlpath)
+                elif os.path.exists(child) != (child in collection.files.get(directory, {})):
+                    collection.mark_dirty(child)
+                    changed.add(collection.urlpath)
+            if directory == root or len(directory) < len(root):
+                break
+            child, directory = directory, os.path.dirname(directory)
+    for path in changed:
+        notify.changed(path)
+    return changed
+
+
+def run(collections):
+    while True:
+        for url in warmup.discover():
+            repository = paths.url_to_file(url)
+            try:
+                refresh(collections, sync(repository))
+            except Exception:
+                log.exception("Cannot update %s", repository)
+        time.sleep(config.getfloat("follower", "interval"))
+
+
+def start(collections):
+    """Follow the primary in a background thread, refreshing ``collections``."""
+    thread = threading.Thread(target=run, args=(collections,), name="calypso-follower")
+    thread.daemon = True
+    thread.start()
+    return thread
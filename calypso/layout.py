@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+On-disk layout of collections.
+
+Item files are stored either directly in the collection directory, the
+flat layout, or spread over subdirectories named after the first hex
+digits of the SHA-1 of the item name, the sharded layout. Sharding keeps
+directories small for very large collections: a write only changes one
+shard, and only that shard is listed again by the next scan. Item URLs
+do not depend on the layout.
+
+A collection is sharded when its metadata file says ``layout = sharded``
+in its ``[collection]`` section; ``calypso --layout`` migrates
+collections from one layout to the other.
+
+"""
+
+import ConfigParser
+import hashlib
+import os
+
+FLAT = "flat"
+SHARDED = "sharded"
+LAYOUTS = (FLAT, SHARDED)
+
+# Hex digits naming the shards: 256 shards
+SHARD_LENGTH = 2
+
+METADATA_FILENAME = ".calypso-collection"
+
+
+def shard_name(key):
+    """Name of the shard storing the item called ``key``."""
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return hashlib.sha1(key).hexdigest()[:SHARD_LENGTH]
+
+
+def is_shard_name(filename):
+    return len(filename) == SHARD_LENGTH and \
+        all(char in "0123456789abcdef" for char in filename)
+
+
+def metadata_layout(metadata):
+    """Layout named in the collection ``metadata`` parser."""
+    try:
+        value = metadata.get("collection", "layout").strip().lower()
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+        return FLAT
+    return value if value in LAYOUTS else FLAT
+
+
+def directory_layout(directory):
+    """Layout of the collection stored in ``directory``."""
+    parser = ConfigParser.RawConfigParser()
+    parser.read(os.path.join(directory, METADATA_FILENAME))
+    return metadata_layout(parser)
+
+
+def shards(directory):
+    """Paths of the shard directories of the collection in ``directory``."""
+    result = []
+    for filename in sorted(os.listdir(directory)):
+        filepath = os.path.join(directory, filename)
+        if is_shard_name(filename) and os.path.isdir(filepath):
+            result.append(filepath)
+    return result
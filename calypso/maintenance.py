@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Git repository maintenance.
+
+Every change is a commit whose objects git leaves loose, so the object
+database of a busy repository keeps growing and its git commands keep
+getting slower. A background thread looks after the repositories that
+were committed to, as ``git gc --auto`` would after a commit, but
+outside of the requests:
+
+- loose objects are packed by an incremental repack once there are
+  about ``[maintenance] loose_objects`` of them, and the commit-graph
+  is written again;
+- git gc consolidates the packs once there are more than ``packs`` of
+  them, or every ``gc_interval`` seconds;
+- the stat information of the index is refreshed after either.
+
+Repacking and gc run alongside the git commands of requests, as git
+allows; gc leaves refs and reflogs alone, as they are locked by
+commits. Refreshing the index would make a concurrent git add fail:
+the git commands of requests hold the lock of their repository, which
+maintenance only takes if it is free, leaving the refresh for later
+otherwise.
+
+"""
+
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from . import config, metrics, paths
+
+log = logging.getLogger()
+
+# Git commands of the maintenance tasks
+TASKS = {
+    "repack": ["git", "repack", "-d", "-q"],
+    "commit-graph": ["git", "commit-graph", "write", "--reachable"],
+    "gc": ["git", "-c", "gc.packRefs=false", "-c", "gc.reflogExpire=never",
+           "-c", "gc.reflogExpireUnreachable=never", "-c", "gc.autoDetach=false",
+           "gc", "--quiet"],
+    "index": ["git", "update-index", "-q", "--refresh"],
+}
+
+TASKS_RUN = metrics.Counter(
+    "calypso_git_maintenance_total", "Git maintenance tasks run.", ("task", "result"))
+TASK_SECONDS = metrics.Histogram(
+    "calypso_git_maintenance_duration_seconds", "Time spent in git maintenance tasks.",
+    ("task",), buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+
+
+class Repository(object):
+    """Maintenance state of the git repository in ``path``."""
+
+    def __init__(self, path):
+        self.path = path
+        # Held by the git commands of requests
+        self.lock = threading.Lock()
+        # Commits since the last gc
+        self.commits = 0
+        self.last_gc = time.time()
+        self.loose = 0
+
+
+_lock = threading.Lock()
+# top directory -> Repository
+_repositories = {}
+
+
+def enabled():
+    return config.getboolean("maintenance", "enabled")
+
+
+def repository(path):
+    """The ``Repository`` holding ``path``, or None if it is not in one."""
+    root = paths.git_root(path)
+    if root is None:
+        return None
+    with _lock:
+        result = _repositories.get(root)
+        if result is None:
+            result = _repositories[root] = Repository(root)
+        return result
+
+
+class lock(object):
+    """Context manager holding the lock of the repository of ``path``.
+
+    Without maintenance, there is nothing to hold it against.
+
+    """
+
+    def __init__(self, path):
+        self.repository = repository(path) if enabled() else None
+
+    def __enter__(self):
+        if self.repository is not None:
+            self.repository.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.repository is not None:
+            self.repository.lock.release()
+        return False
+
+
+def committed(path):
+    """Record a commit in the repository of ``path``."""
+    if not enabled():
+        return
+    result = repository(path)
+    if result is not None:
+        with _lock:
+            result.commits += 1
+
+
+def loose_objects(repository):
+    """Estimate of the loose objects of ``repository``, from one of their directories."""
+    try:
+        names = os.listdir(os.path.join(repository.path, ".git", "objects", "17"))
+    except OSError:
+        return 0
+    return 256 * len([name for name in names if len(name) == 38])
+
+
+def packs(repository):
+    try:
+        names = os.listdir(os.path.join(repository.path, ".git", "objects", "pack"))
+    except OSError:
+        return 0
+    return len([name for name in names if name.endswith(".pack")])
+
+
+def needed(repository, now):
+    """Maintenance tasks ``repository`` needs."""
+    repository.loose = loose_objects(repository)
+    if packs(repository) > config.getint("maintenance", "packs") or \
+            now - repository.last_gc >= config.getfloat("maintenance", "gc_interval"):
+        return ["gc", "index"]
+    if repository.loose >= config.getint("maintenance", "loose_objects"):
+        return ["repack", "commit-graph", "index"]
+    return []
+
+
+def run_task(repository, task):
+    """Run the maintenance ``task`` on ``repository``; return whether it succeeded."""
+    locked = task == "index"
+    if locked and not repository.lock.acquire(False):
+        # Requests are using the repository, refresh the index next time
+        TASKS_RUN.inc(task=task, result="skipped")
+        return False
+    start = time.time()
+    try:
+        with open(os.devnull, "w") as devnull:
+            status = subprocess.call(TASKS[task], cwd=repository.path, stdout=devnull)
+    except OSError as e:
+        log.error("Cannot run git %s in %s: %s", task, repository.path, e)
+        status = -1
+    finally:
+        if locked:
+            repository.lock.release()
+    elapsed = time.time() - start
+    TASK_SECONDS.observe(elapsed, task=task)
+    TASKS_RUN.inc(task=task, result="ok" if status == 0 else "failed")
+    if status != 0:
+        log.error("git %s failed in %s with status %d", task, repository.path, status)
+        return False
+    log.info("git %s of %s took %.1f seconds", task, repository.path, elapsed)
+    return True
+
+
+def maintain(repository, now=None):
+    """Run the maintenance tasks ``repository`` needs; return them."""
+    if now is None:
+        now = time.time()
+    tasks = needed(repository, now)
+    for task in tasks:
+        if run_task(repository, task) and task == "gc":
+            with _lock:
+                repository.commits = 0
+            repository.last_gc = now
+    return tasks
+
+
+def run():
+    while True:
+        time.sleep(config.getfloat("maintenance", "check_interval"))
+        with _lock:
+            repositories = [repository for repository in _repositories.values()
+                            if repository.commits]
+        for repository in repositories:
+            try:
+                maintain(repository)
+            except Exception:
+                log.exception("Maintenance of %s failed", repository.path)
+
+
+def start():
+    """Run maintenance in a background thread."""
+    thread = threading.Thread(target=run, name="calypso-maintenance")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+metrics.Callback("calypso_git_loose_objects",
+                 "Estimated loose objects in the repositories maintained.",
+                 lambda: sum(repository.loose for repository in _repositories.values()))
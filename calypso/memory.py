@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory accounting.
+
+Report the items and estimated memory held by each cached collection,
+and, when the ``tracemalloc`` module is available (Python 3, or the
+pytracemalloc backport on a patched Python 2), allocation snapshots
+grouped by module together with the difference to the previous one.
+
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from . import config, webdav
+
+log = logging.getLogger()
+
+# Modules reported on their own rather than by top-level package
+GROUPS = ("xml.etree", "vobject", "dateutil", "calypso")
+
+_lock = threading.Lock()
+_previous = None
+
+
+def available():
+    return tracemalloc is not None
+
+
+def tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def start(frames=None):
+    """Start tracing allocations; return False if tracemalloc is missing."""
+    if tracemalloc is None:
+        log.error("tracemalloc is not available, cannot trace allocations")
+        return False
+    if frames is None:
+        frames = config.getint("memory", "trace_frames")
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    return True
+
+
+def stop():
+    global _previous
+    if tracing():
+        tracemalloc.stop()
+    _previous = None
+
+
+def collection_report(collection):
+    """Item counts and estimated memory of ``collection``."""
+    # Subcollections are listed along with the items
+    items = [item for item in collection.my_items if isinstance(item, webdav.Item)]
+    parsed = [item for item in items if item._object is not None]
+    text = sum(item.size for item in items)
+    # Parsed items hold a vobject tree, the others only their text
+    estimated = sum(item.estimated_size for item in parsed) + \
+        sum(item.size for item in items if item._object is None)
+    return {
+        "path": collection.urlpath,
+        "items": len(items),
+        "parsed": len(parsed),
+        "text_bytes": text,
+        "estimated_bytes": estimated,
+    }
+
+
+def collections_report(collections):
+    """Reports of all collections of ``collections``, largest first."""
+    with collections.lock:
+        cached = [collection for collection, used in collections.entries.values()]
+    reports = [collection_report(collection) for collection in cached]
+    reports.sort(key=lambda report: report["estimated_bytes"], reverse=True)
+    return reports
+
+
+def module_name(filename):
+    """Dotted module name of the source file ``filename``."""
+    filename = os.path.abspath(filename)
+    best = None
+    for directory in sys.path:
+        directory = os.path.join(os.path.abspath(directory or os.curdir), "")
+        if filename.startswith(directory) and (best is None or len(directory) > len(best)):
+            best = directory
+    if best is None:
+        return filename
+    name = os.path.splitext(filename[len(best):])[0].replace(os.sep, ".")
+    if name.endswith(".__init__"):
+        name = name[:-len(".__init__")]
+    return name
+
+
+def group(filename):
+    """Name of the group the allocations from ``filename`` are reported in."""
+    name = module_name(filename)
+    for prefix in GROUPS:
+        if name == prefix or name.startswith(prefix + "."):
+            return prefix
+    return name.split(".")[0]
+
+
+def snapshot(limit=None):
+    """Take an allocation snapshot and group it by module.
+
+    The difference to the previous snapshot is included; return None if
+    allocations are not traced.
+
+    """
+    global _previous
+    if not tracing():
+        return None
+    if limit is None:
+        limit = config.getint("memory", "top")
+    with _lock:
+        current = tracemalloc.take_snapshot()
+        previous, _previous = _previous, current
+    groups = {}
+    if previous is None:
+        statistics = [(stat.traceback[0].filename, stat.size, stat.count, 0, 0)
+                      for stat in current.statistics("filename")]
+    else:
+        statistics = [(stat.traceback[0].filename, stat.size, stat.count,
+                       stat.size_diff, stat.count_diff)
+                      for stat in current.compare_to(previous, "filename")]
+    for filename, size, count, size_diff, count_diff in statistics:
+        totals = groups.setdefault(group(filename), [0, 0, 0, 0])
+        totals[0] += size
+        totals[1] += count
+        totals[2] += size_diff
+        totals[3] += count_diff
+    result = [{"module": name, "size": size, "count": count,
+               "size_diff": size_diff, "count_diff": count_diff}
+              for name, (size, count, size_diff, count_diff) in groups.items()]
+    result.sort(key=lambda entry: entry["size"], reverse=True)
+    traced, peak = tracemalloc.get_traced_memory()
+    return {
+        "traced_bytes": traced,
+        "peak_bytes": peak,
+        "compared": previous is not None,
+        "modules": result[:limit] if limit else result,
+    }
+
+
+def report(collections, take_snapshot=False):
+    """Memory report of the cached ``collections``."""
+    reports = collections_report(collections)
+    result = {
+        "collections": reports,
+        "items": sum(report["items"] for report in reports),
+        "estimated_bytes": sum(report["estimated_bytes"] for report in reports),
+        "tracing": tracing(),
+    }
+    if take_snapshot:
+        result["tracemalloc"] = snapshot()
+    return result
+
+
+def log_report(collections):
+    """Log the memory report, with a snapshot if allocations are traced."""
+    result = report(collections, take_snapshot=tracing())
+    log.warning("Memory: %d items in %d collections, about %d bytes",
+                result["items"], len(result["collections"]), result["estimated_bytes"])
+    for entry in result["collections"][:config.getint("memory", "top")]:
+        log.warning("Memory: %(path)s %(items)d items (%(parsed)d parsed) "
+                    "about %(estimated_bytes)d bytes", entry)
+    trace = result.get("tracemalloc")
+    if trace:
+        log.warning("Memory: %d bytes traced, peak %d", trace["traced_bytes"],
+                    trace["peak_bytes"])
+        for entry in trace["modules"]:
+            log.warning("Memory: %(module)s %(size)d bytes (%(size_diff)+d) "
+                        "in %(count)d blocks (%(count_diff)+d)", entry)
+    return result
+
+
+def signal_handler(collections):
+    """Signal handler logging the memory report of ``collections``."""
+    def handler(signum, frame):
+        log_report(collections)
+    return handler
+
+
+def render(collections, take_snapshot=False):
+    return json.dumps(report(collections, take_snapshot), indent=1, sort_keys=True)
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Server metrics.
+
+Counters and histograms rendered in the Prometheus text exposition
+format, and per-request accounting of the time spent in each phase of
+request handling.
+
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import threading
+import time
+
+try:
+    from http import server
+except ImportError:
+    import BaseHTTPServer as server
+
+from . import config
+
+log = logging.getLogger()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_registry = []
+
+
+def _escape(value):
+    return unicode(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+def _number(value):
+    if isinstance(value, (int, long)):
+        return "%d" % value
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    """Base class of all metrics; registers itself for rendering."""
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        with _lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def header(self):
+        return ["# HELP %s %s" % (self.name, self.documentation),
+                "# TYPE %s %s" % (self.name, self.kind)]
+
+    def samples(self):
+        return []
+
+    def render(self):
+        return self.header() + self.samples()
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        with _lock:
+            values = sorted(self.values.items())
+        return ["%s%s %s" % (self.name, _labels(self.labelnames, key), _number(value))
+                for key, value in values]
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # label values -> [bucket counts, sum, count]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        entry = self.values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def samples(self):
+        lines = []
+        with _lock:
+            values = sorted((key, (list(entry[0]), entry[1], entry[2]))
+                            for key, entry in self.values.items())
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append("%s_bucket%s %d" % (
+                    self.name, _labels(self.labelnames, key, [("le", _number(bound))]),
+                    cumulative))
+            lines.append("%s_sum%s %r" % (self.name, _labels(self.labelnames, key), total))
+            lines.append("%s_count%s %d" % (self.name, _labels(self.labelnames, key), count))
+        return lines
+
+
+class Callback(Metric):
+    """Value read from ``function`` whenever metrics are rendered."""
+
+    def __init__(self, name, documentation, function, kind="gauge"):
+        Metric.__init__(self, name, documentation)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        try:
+            return ["%s %s" % (self.name, _number(self.function()))]
+        except Exception:
+            log.exception("Failed to read metric %s", self.name)
+            return []
+
+
+def render():
+    """All registered metrics in Prometheus text format."""
+    with _lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS = Counter(
+    "calypso_requests_total", "HTTP requests handled.", ("method", "status"))
+REQUEST_SECONDS = Histogram(
+    "calypso_request_duration_seconds", "Time spent handling HTTP requests.",
+    ("method", "status"))
+PHASE_SECONDS = Histogram(
+    "calypso_phase_duration_seconds",
+    "Time spent in each phase of request handling.", ("phase",))
+BYTES_SENT = Counter(
+    "calypso_response_bytes_total", "Bytes written to clients.")
+ITEMS_PARSED = Counter(
+    "calypso_items_parsed_total", "Calendar and address book items parsed.")
+
+#
+# Per-request accounting. The request being handled by the current
+# thread collects the time spent in each phase.
+#
+
+_local = threading.local()
+
+# Linux values, the ones Python 2 lacks
+CLOCK_THREAD_CPUTIME_ID = 3
+RUSAGE_THREAD = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _thread_clock():
+    """Function returning the CPU time of the calling thread, or None.
+
+    The process clock would count the work of the other threads, such as
+    the workers of the event loop engine or the background tasks.
+
+    """
+    if hasattr(time, "thread_time"):
+        return time.thread_time
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6").clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        value = _timespec()
+        if clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(value)) == 0:
+            def clock():
+                clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(value))
+                return value.tv_sec + value.tv_nsec * 1e-9
+            return clock
+    except (OSError, AttributeError):
+        pass
+    try:
+        import resource
+        resource.getrusage(RUSAGE_THREAD)
+    except (ImportError, ValueError, EnvironmentError):
+        log.warning("No CPU clock for threads, CPU times are not accounted")
+        return None
+
+    def clock():
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return clock
+
+
+_thread_time = _thread_clock()
+# Whether CPU times are those of the thread handling the request
+thread_cpu = _thread_time is not None
+
+
+def thread_time():
+    """CPU seconds used by the calling thread, 0 if they are unknown."""
+    return _thread_time() if _thread_time is not None else 0.0
+
+
+class RequestRecord(object):
+    """Accounting for the request handled by the current thread."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.cpu_start = thread_time()
+        # phase -> [wall seconds, cpu seconds]
+        self.phases = {}
+        self.counts = {}
+        self.notes = {}
+
+    def add(self, phase, seconds, cpu=0.0):
+        times = self.phases.setdefault(phase, [0.0, 0.0])
+        times[0] += seconds
+        times[1] += cpu
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def cpu(self):
+        return thread_time() - self.cpu_start
+
+
+def begin_request():
+    """Start accounting for a new request in this thread."""
+    record = _local.record = RequestRecord()
+    return record
+
+
+def end_request():
+    """Stop accounting for the request of this thread and return it."""
+    record = getattr(_local, "record", None)
+    _local.record = None
+    return record
+
+
+def current():
+    """The ``RequestRecord`` of this thread, or None."""
+    return getattr(_local, "record", None)
+
+
+def record_phase(name, seconds, cpu=0.0):
+    """Account ``seconds`` (``cpu`` of them on the CPU) spent in phase ``name``."""
+    PHASE_SECONDS.observe(seconds, phase=name)
+    record = current()
+    if record is not None:
+        record.add(name, seconds, cpu)
+
+
+def count(name, amount=1):
+    """Add ``amount`` to the ``name`` count of the current request."""
+    record = current()
+    if record is not None:
+        record.counts[name] = record.counts.get(name, 0) + amount
+
+
+def note(name, value):
+    """Attach ``value`` as ``name`` to the current request."""
+    record = current()
+    if record is not None:
+        record.notes[name] = value
+
+
+class phase(object):
+    """Context manager timing a phase of request handling."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        self.cpu_start = thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record_phase(self.name, time.time() - self.start, thread_time() - self.cpu_start)
+        return False
+
+
+class CountingFile(object):
+    """Wrap a file object and count the bytes written through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        BYTES_SENT.inc(len(data))
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+#
+# Serving metrics on a dedicated local port
+#
+
+class MetricsHandler(server.BaseHTTPRequestHandler):
+    """Answer every GET with the rendered metrics."""
+
+    def do_GET(self):
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("metrics: " + format, *args)
+
+
+def start_server():
+    """Serve metrics on ``[metrics] port`` if it is set."""
+    port = config.getint("metrics", "port")
+    if not port:
+        return None
+    httpd = server.HTTPServer((config.get("metrics", "host"), port), MetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name="calypso-metrics")
+    thread.daemon = True
+    thread.start()
+    return httpd
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collection change notification.
+
+Collections report here when their ctag changes, and the watcher when
+the files of a collection changed on disk. Requests waiting for the
+changes of a collection are woken up instead of having clients poll it:
+the blocking server waits on a condition, the event loop subscribes a
+listener.
+
+Collections are identified by their URL path, as in the collection
+cache.
+
+"""
+
+import logging
+import threading
+import time
+
+log = logging.getLogger()
+
+_condition = threading.Condition()
+# path -> number of changes so far
+_versions = {}
+_listeners = []
+
+
+def changed(path):
+    """Record that the collection at ``path`` changed, or may have."""
+    with _condition:
+        _versions[path] = _versions.get(path, 0) + 1
+        _condition.notify_all()
+        listeners = list(_listeners)
+    for listener in listeners:
+        try:
+            listener(path)
+        except Exception:
+            log.exception("Change listener failed")
+
+
+def version(path):
+    """Number of changes of the collection at ``path`` so far."""
+    with _condition:
+        return _versions.get(path, 0)
+
+
+def wait(path, seen, timeout):
+    """Wait for the collection at ``path`` to change after version ``seen``.
+
+    Return whether it did within ``timeout`` seconds.
+
+    """
+    deadline = time.time() + timeout
+    with _condition:
+        while _versions.get(path, 0) == seen:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            _condition.wait(remaining)
+        return True
+
+
+def subscribe(listener):
+    """Call ``listener`` with the path of each collection that changes.
+
+    Listeners are called from the thread reporting the change and must
+    not block.
+
+    """
+    with _condition:
+        _listeners.append(listener)
+
+
+def unsubscribe(listener):
+    with _condition:
+        if listener in _listeners:
+            _listeners.remove(listener)
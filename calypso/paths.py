@@ -24,7 +24,7 @@ import os.path
 import posixpath # the semantics of urls follow posix rules, not platform dependent rules
 import logging
 
-from . import config
+from . import config, metrics
 
 log = logging.getLogger()
 
@@ -68,6 +68,16 @@ def url_to_file(url):
     file = os.path.join(data_root(), tail)
     return file
 
+#
+# Given a directory of the storage folder, return the URL of the
+# collection stored there, as requests name it
+#
+
+def file_to_url(path):
+    tail = os.path.relpath(path, data_root()).replace(os.sep, "/")
+    url = base_prefix() + "/" + ("" if tail == "." else tail)
+    return url.rstrip("/") or "/"
+
 
 #
 # Does the provided URL reference a collection? This
@@ -85,6 +95,21 @@ def is_collection(url):
             return False
         urlpath, stripped = os.path.split(urlpath)
 
+#
+# Return the top directory of the git repository holding
+# the given file name, or None
+#
+
+def git_root(path):
+    path = os.path.abspath(path)
+    while True:
+        if os.path.isdir(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
 #
 # Given a URL, return the parent URL by stripping off
 # the last path element
@@ -114,6 +139,10 @@ def child_url(path):
 def resource_from_path(path):
     """Return Calypso item name from ``path``."""
 
+    with metrics.phase("path"):
+        return _resource_from_path(path)
+
+def _resource_from_path(path):
     child_path = None
     collection = path
 
@@ -142,6 +171,10 @@ def resource_from_path(path):
 def collection_from_path(path):
     """Returns Calypso collection name from ``path``."""
 
+    with metrics.phase("path"):
+        return _collection_from_path(path)
+
+def _collection_from_path(path):
     collection = path
     while collection != '/' and not is_collection(collection):
         collection = parent_url(collection)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Slow request profiler.
+
+A sample of the requests runs under cProfile. When one of them takes
+longer than the configured threshold, its profile is written to a spool
+directory next to a short description of the request. The spool is kept
+under a maximum number of files and size.
+
+"""
+
+import cProfile
+import logging
+import os
+import random
+import time
+
+from . import config
+
+log = logging.getLogger()
+
+# Toggled at runtime by ``toggle``
+enabled = config.getboolean("profiler", "enabled")
+
+
+def threshold(command):
+    """Duration in seconds above which a ``command`` request is dumped."""
+    option = "threshold_%s" % (command or "").lower()
+    if config.has_option("profiler", option):
+        return config.getfloat("profiler", option)
+    return config.getfloat("profiler", "threshold")
+
+
+def spool():
+    return os.path.expanduser(config.get("profiler", "spool"))
+
+
+def toggle(signum=None, frame=None):
+    """Turn profiling on or off; usable as a signal handler."""
+    global enabled
+    enabled = not enabled
+    log.warning("Slow request profiling %s", "enabled" if enabled else "disabled")
+
+
+def start():
+    """Start profiling the current request if it is sampled.
+
+    Return the profile, or None when the request is not profiled.
+
+    """
+    if not enabled or random.random() >= config.getfloat("profiler", "sample_rate"):
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def finish(profile, command, elapsed, describe):
+    """Stop ``profile`` and dump it if the request was slow.
+
+    ``describe`` is called to get the lines describing the request, only
+    when the profile is actually written.
+
+    """
+    if profile is None:
+        return None
+    profile.disable()
+    limit = threshold(command)
+    if limit <= 0 or elapsed < limit:
+        return None
+    directory = spool()
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        base = os.path.join(directory, "%s-%s-%dms-%d" % (
+            time.strftime("%Y%m%d-%H%M%S"), command, elapsed * 1000, os.getpid()))
+        profile.dump_stats(base + ".prof")
+        with open(base + ".txt", "w") as f:
+            f.write("elapsed: %.3f\n" % elapsed)
+            for line in describe():
+                f.write(line.encode("utf-8") if isinstance(line, unicode) else line)
+                f.write("\n")
+        log.warning("Slow %s request (%.3fs) profiled in %s.prof", command, elapsed, base)
+        trim(directory)
+        return base
+    except (IOError, OSError) as e:
+        log.error("Cannot write profile to %s: %s", directory, e)
+        return None
+
+
+def trim(directory):
+    """Delete the oldest dumps beyond the configured count and size."""
+    max_files = config.getint("profiler", "max_files")
+    max_bytes = config.getint("profiler", "max_size") * 1024 * 1024
+    dumps = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(".prof"):
+            continue
+        base = os.path.join(directory, filename[:-len(".prof")])
+        size = 0
+        for path in (base + ".prof", base + ".txt"):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        dumps.append((os.path.getmtime(base + ".prof"), base, size))
+    dumps.sort()
+    total = sum(size for mtime, base, size in dumps)
+    while dumps and (len(dumps) > max_files or total > max_bytes):
+        mtime, base, size = dumps.pop(0)
+        for path in (base + ".prof", base + ".txt"):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        total -= size
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+iCalendar and vCard line scanner.
+
+Extract the few fields the server needs for every item straight from the
+unfolded content lines, without building a vobject tree.
+
+"""
+
+import calendar
+import collections
+import time
+
+# Fields of an item. ``tag`` is the name of the outermost component and
+# ``components`` the names of its subcomponents; ``uid``, ``dtstart``,
+# ``tzid`` and ``rrule`` come from the main component, the first VEVENT,
+# VTODO or VCARD. ``names`` counts the X-CALYPSO-NAME properties of the
+# outermost component, ``name`` is the first of them.
+Scan = collections.namedtuple("Scan", [
+    "tag", "components", "name", "names", "uid", "last_modified",
+    "dtstart", "tzid", "rrule"])
+
+MAIN_COMPONENTS = ("VEVENT", "VTODO", "VCARD")
+
+
+def unfold(text):
+    """Logical content lines of ``text``."""
+    line = None
+    for physical in text.splitlines():
+        if physical[:1] in (" ", "\t"):
+            if line is not None:
+                line += physical[1:]
+            continue
+        if line is not None:
+            yield line
+        line = physical
+    if line is not None:
+        yield line
+
+
+def split_line(line):
+    """Split a content line into its upper-cased name, parameters and value.
+
+    Group prefixes (as in ``item1.EMAIL``) are dropped from the name.
+
+    """
+    quoted = False
+    for i, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ":" and not quoted:
+            head, value = line[:i], line[i + 1:]
+            break
+    else:
+        head, value = line, ""
+    name, _, params = head.partition(";")
+    name = name.rsplit(".", 1)[-1].upper()
+    return name, params, value
+
+
+def parameter(params, name):
+    """Value of the parameter ``name`` in ``params``, or None."""
+    for param in params.split(";"):
+        key, _, value = param.partition("=")
+        if key.upper() == name:
+            return value.strip('"')
+    return None
+
+
+def scan(text):
+    """Scan the item ``text`` and return its ``Scan``."""
+    depth = 0
+    tag = None
+    components = []
+    name = None
+    names = 0
+    last_modified = None
+    main_depth = None
+    main = {}
+    main_done = False
+    for line in unfold(text):
+        key, params, value = split_line(line)
+        if key == "BEGIN":
+            depth += 1
+            value = value.strip().upper()
+            if depth == 1 and tag is None:
+                tag = value
+            elif depth == 2:
+                components.append(value)
+            if main_depth is None and not main_done and value in MAIN_COMPONENTS:
+                main_depth = depth
+            continue
+        if key == "END":
+            if depth == main_depth:
+                main_depth = None
+                main_done = True
+            depth -= 1
+            continue
+        if depth == 1 and key == "X-CALYPSO-NAME":
+            names += 1
+            if name is None:
+                name = value
+        elif key == "LAST-MODIFIED" and last_modified is None:
+            last_modified = value
+        if main_depth is not None and depth == main_depth:
+            if key in ("UID", "DTSTART", "RRULE") and key not in main:
+                main[key] = (params, value)
+    dtstart = main.get("DTSTART", (None, None))
+    return Scan(tag, tuple(components), name, names, main.get("UID", (None, None))[1],
+                last_modified, dtstart[1], parameter(dtstart[0] or "", "TZID"),
+                main.get("RRULE", (None, None))[1])
+
+
+def is_vcard(tag, components):
+    """Whether an item with these ``tag`` and ``components`` is a vcard entry."""
+    if tag == "VCARD":
+        return True
+    if tag in ("VEVENT", "VTODO", "VCALENDAR"):
+        return False
+    for component in components:
+        if component == "VCARD":
+            return True
+        if component in ("VEVENT", "VTODO"):
+            return False
+    return False
+
+
+def is_vcal(tag, components):
+    """Whether an item with these ``tag`` and ``components`` is a vcal entry."""
+    if tag == "VCARD":
+        return False
+    if tag in ("VEVENT", "VTODO", "VCALENDAR"):
+        return True
+    for component in components:
+        if component == "VCARD":
+            return False
+        if component in ("VEVENT", "VTODO"):
+            return True
+    return False
+
+
+def utc_timetuple(value):
+    """Time tuple of the UTC date-time ``value``, or None if it is not one."""
+    if not value or not value.upper().endswith("Z"):
+        return None
+    try:
+        return time.gmtime(calendar.timegm(time.strptime(value[:-1], "%Y%m%dT%H%M%S")))
+    except ValueError:
+        return None
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+TLS support.
+
+The server context is built once, so that sessions cached by OpenSSL
+and session tickets let returning clients resume their session instead
+of paying a full handshake. Handshakes happen after the connection has
+been accepted, in a thread of their own and with a timeout, and are
+counted in the metrics together with the number of resumed sessions.
+
+"""
+
+import logging
+import os
+import socket
+import ssl
+import time
+
+from . import config, metrics
+
+log = logging.getLogger()
+
+# Not exported by the ssl module of Python 2
+OP_NO_TICKET = getattr(ssl, "OP_NO_TICKET", 0x00004000)
+
+HANDSHAKES = metrics.Counter(
+    "calypso_tls_handshakes_total", "TLS handshakes.", ("result",))
+HANDSHAKE_SECONDS = metrics.Histogram(
+    "calypso_tls_handshake_duration_seconds", "Time spent in TLS handshakes.")
+
+_context = None
+
+
+def context():
+    """The server SSLContext, built from the configuration."""
+    global _context
+    if _context is None:
+        _context = create_context()
+    return _context
+
+
+def create_context():
+    result = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    result.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    result.options |= getattr(ssl, "OP_NO_COMPRESSION", 0)
+    result.options |= getattr(ssl, "OP_CIPHER_SERVER_PREFERENCE", 0)
+    if not config.getboolean("server", "session_tickets"):
+        result.options |= OP_NO_TICKET
+    result.load_cert_chain(
+        certfile=os.path.expanduser(config.get("server", "certificate")),
+        keyfile=os.path.expanduser(config.get("server", "key")))
+    ciphers = config.get("server", "ciphers")
+    if ciphers:
+        result.set_ciphers(ciphers)
+    curve = config.get("server", "ecdh_curve")
+    if curve:
+        result.set_ecdh_curve(curve)
+    return result
+
+
+def handshake(sock, address):
+    """Wrap the accepted socket ``sock`` and complete the TLS handshake.
+
+    Return the SSL socket, or None if the handshake failed, in which case
+    ``sock`` is closed.
+
+    """
+    start = time.time()
+    sock.settimeout(config.getfloat("server", "handshake_timeout"))
+    try:
+        result = context().wrap_socket(sock, server_side=True)
+    except (ssl.SSLError, socket.error) as e:
+        HANDSHAKES.inc(result="failed")
+        log.error("TLS handshake with %s failed: %s", address[0], e)
+        try:
+            sock.close()
+        except socket.error:
+            pass
+        return None
+    HANDSHAKES.inc(result="ok")
+    HANDSHAKE_SECONDS.observe(time.time() - start)
+    return result
+
+
+def shutdown(sock):
+    """Close the TLS session of ``sock`` cleanly.
+
+    OpenSSL drops the sessions of connections closed without a
+    close_notify alert from its cache, so they could not be resumed.
+
+    """
+    try:
+        sock.settimeout(1)
+        sock.unwrap()
+    except (ssl.SSLError, socket.error, ValueError):
+        pass
+
+
+def session_stat(name):
+    """Session statistic ``name`` of the server context, as OpenSSL counts it."""
+    if _context is None:
+        return 0
+    return _context.session_stats()[name]
+
+
+metrics.Callback("calypso_tls_sessions_resumed_total",
+                 "TLS sessions resumed from the session cache or a ticket.",
+                 lambda: session_stat("hits"), kind="counter")
+metrics.Callback("calypso_tls_sessions_missed_total",
+                 "TLS session resumptions refused, the session being unknown.",
+                 lambda: session_stat("misses"), kind="counter")
+metrics.Callback("calypso_tls_sessions_cached", "TLS sessions in the session cache.",
+                 lambda: session_stat("number"))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Time zone cache.
+
+Every calendar item carries its own VTIMEZONE, and vobject builds a new
+tzinfo for each of them, whose offsets are then computed by iterating
+the transition rules from their start. Time zone definitions are interned
+here by TZID and content, so items sharing a time zone share one tzinfo,
+and the offsets it computes are remembered.
+
+The local time zone and the parsed bounds of time-range filters are
+cached as well.
+
+"""
+
+import hashlib
+import StringIO
+import threading
+
+import dateutil.parser
+import dateutil.tz
+import vobject.base
+import vobject.icalendar
+
+# Properties dateutil needs to build a tzinfo, as in vobject
+TZ_LINES = ('rdate', 'rrule', 'dtstart', 'tzname', 'tzoffsetfrom', 'tzoffsetto', 'tzid')
+
+# Offsets remembered per time zone
+MAX_OFFSETS = 10000
+
+# Parsed time-range bounds remembered
+MAX_BOUNDS = 1000
+
+_lock = threading.Lock()
+# (TZID, sha1 of the definition) -> tzinfo
+_timezones = {}
+_bounds = {}
+_local = None
+
+hits = 0
+misses = 0
+
+
+def definition(component):
+    """The lines of the VTIMEZONE ``component`` that define its tzinfo."""
+    buffer = StringIO.StringIO()
+
+    def serialize(obj):
+        vobject.base.foldOneLine(buffer, u"BEGIN:" + obj.name)
+        for child in obj.lines():
+            if child.name.lower() in TZ_LINES:
+                child.serialize(buffer, 75, validate=False)
+        for comp in obj.components():
+            serialize(comp)
+        vobject.base.foldOneLine(buffer, u"END:" + obj.name)
+    serialize(component)
+    return buffer.getvalue()
+
+
+def remember_offsets(tzinfo):
+    """Make ``tzinfo`` remember the transition rule of many more dates.
+
+    dateutil only keeps the last ten, not enough for a tzinfo shared by
+    all the items of a server.
+
+    """
+    find_comp = getattr(tzinfo, "_find_comp", None)
+    fold = getattr(tzinfo, "_fold", None)
+    if find_comp is None or fold is None:
+        return tzinfo
+    found = {}
+
+    def cached_find_comp(dt):
+        key = (dt.replace(tzinfo=None), fold(dt))
+        comp = found.get(key)
+        if comp is None:
+            if len(found) >= MAX_OFFSETS:
+                found.clear()
+            comp = found[key] = find_comp(dt)
+        return comp
+    tzinfo._find_comp = cached_find_comp
+    return tzinfo
+
+
+def get(component):
+    """The shared tzinfo of the VTIMEZONE ``component``."""
+    global hits, misses
+    if len(component.contents) == 0:
+        return None
+    text = definition(component)
+    tzid = component.getChildValue("tzid")
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    key = (tzid, hashlib.sha1(text).hexdigest())
+    with _lock:
+        tzinfo = _timezones.get(key)
+        if tzinfo is not None:
+            hits += 1
+            return tzinfo
+    tzinfo = remember_offsets(dateutil.tz.tzical(StringIO.StringIO(text)).get())
+    with _lock:
+        misses += 1
+        return _timezones.setdefault(key, tzinfo)
+
+
+def size():
+    return len(_timezones)
+
+
+def clear():
+    global _local
+    with _lock:
+        _timezones.clear()
+        _bounds.clear()
+        _local = None
+
+
+def local():
+    """The local time zone."""
+    global _local
+    if _local is None:
+        _local = dateutil.tz.tzlocal()
+    return _local
+
+
+def bound(value):
+    """Time-range bound ``value`` as a datetime, in local time if floating."""
+    result = _bounds.get(value)
+    if result is None:
+        result = dateutil.parser.parse(value)
+        if result.tzinfo is None:
+            result = result.replace(tzinfo=local())
+        with _lock:
+            if len(_bounds) >= MAX_BOUNDS:
+                _bounds.clear()
+            _bounds[value] = result
+    return result
+
+
+def install():
+    """Make vobject get the tzinfo of time zone components from the cache."""
+    component = vobject.icalendar.TimezoneComponent
+    component.tzinfo = property(get, component.settzinfo)
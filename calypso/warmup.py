@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Startup warm-up.
+
+Load the git-backed collections found under the storage folder in the
+background, most recently used first, while the server is already
+answering requests.
+
+"""
+
+import logging
+import os
+import threading
+import time
+
+from . import config, layout, paths
+
+log = logging.getLogger()
+
+# Set once warm-up is complete (or was never requested)
+ready = threading.Event()
+
+#
+# Return the URLs of the git-backed collections under the storage
+# folder, most recently written first
+#
+
+def discover():
+    root = paths.data_root()
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if layout.METADATA_FILENAME in filenames and \
+                layout.directory_layout(dirpath) == layout.SHARDED:
+            # Shards hold items, not subcollections
+            dirnames[:] = [name for name in dirnames if not layout.is_shard_name(name)]
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+            gitdir = os.path.join(dirpath, '.git')
+            try:
+                mtime = os.path.getmtime(os.path.join(gitdir, 'index'))
+            except OSError:
+                mtime = os.path.getmtime(dirpath)
+            found.append((mtime, paths.file_to_url(dirpath)))
+    found.sort(reverse=True)
+    return [url for mtime, url in found]
+
+
+def mark_ready():
+    """Flag the server as ready, touching the configured ready file."""
+    ready.set()
+    ready_file = config.get("server", "ready_file")
+    if ready_file:
+        try:
+            with open(os.path.expanduser(ready_file), "a"):
+                os.utime(os.path.expanduser(ready_file), None)
+        except (IOError, OSError) as e:
+            log.error("Cannot write ready file %s: %s", ready_file, e)
+
+
+def run(collections):
+    """Load every discovered collection into the ``collections`` cache."""
+    start = time.time()
+    loaded = 0
+    try:
+        for url in discover():
+            if collections.is_full():
+                log.info("Collection cache full, stopping warm-up")
+                break
+            try:
+                collections.get(url)
+                loaded += 1
+            except Exception:
+                log.exception("Warm-up of %s failed", url)
+    finally:
+        log.info("Warm-up loaded %d collections in %.1f seconds",
+                 loaded, time.time() - start)
+        mark_ready()
+
+
+def start(collections):
+    """Run warm-up in a background thread."""
+    thread = threading.Thread(target=run, args=(collections,), name="calypso-warmup")
+    thread.daemon = True
+    thread.start()
+    return thread
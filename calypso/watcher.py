@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Calypso - CalDAV/CardDAV/WebDAV Server
+#
+# This library is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calypso.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collection change watcher.
+
+On Linux, use inotify to learn which files of a collection directory
+changed, so that collections do not have to stat their directory on each
+access to find out whether something moved under them. Collections that
+cannot be watched keep using mtime polling.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import threading
+import weakref
+
+from . import config, notify
+
+log = logging.getLogger()
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class Watcher(object):
+    """inotify watcher marking changed paths dirty in watched collections."""
+
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.lock = threading.Lock()
+        # watch descriptor -> collections watching that directory
+        self.watches = {}
+        self.descriptors = {}
+        self.thread = threading.Thread(target=self.run, name="calypso-watcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self, collection):
+        """Start watching the directory of ``collection``.
+
+        Return False if the directory cannot be watched.
+
+        """
+        path = collection.path
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or "utf-8")
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err != errno.ENOENT:
+                log.warning("Cannot watch %s: %s", collection.path, os.strerror(err))
+            return False
+        with self.lock:
+            self.watches.setdefault(wd, weakref.WeakSet()).add(collection)
+            self.descriptors[collection.path] = wd
+        return True
+
+    def unwatch(self, collection):
+        """Stop delivering changes to ``collection``."""
+        with self.lock:
+            wd = self.descriptors.get(collection.path)
+            if wd is None:
+                return
+            collections = self.watches.get(wd)
+            if collections is not None:
+                collections.discard(collection)
+                if len(collections):
+                    return
+                del self.watches[wd]
+            del self.descriptors[collection.path]
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _dispatch(self, wd, mask, name):
+        with self.lock:
+            if wd == -1:
+                collections = [c for watchers in self.watches.values() for c in watchers]
+            else:
+                collections = list(self.watches.get(wd, ()))
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                for path, descriptor in self.descriptors.items():
+                    if descriptor == wd:
+                        del self.descriptors[path]
+
+        for collection in collections:
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED) or not name:
+                collection.mark_dirty(None)
+            else:
+                collection.mark_dirty(os.path.join(collection.path, name))
+            # Requests waiting for its changes look again
+            notify.changed(collection.urlpath)
+            if mask & IN_IGNORED:
+                # The kernel dropped the watch, fall back to polling
+                collection.watched = False
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                log.exception("inotify read failed, watcher stopped")
+                return
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                try:
+                    self._dispatch(wd, mask, name)
+                except Exception:
+                    log.exception("Failed to dispatch inotify event")
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+#
+# Return the process-wide watcher, or None when watching is disabled
+# or not supported on this system
+#
+
+def get():
+    global _watcher
+    if not config.getboolean("storage", "watch"):
+        return None
+    with _watcher_lock:
+        if _watcher is None:
+            libc = _load_libc()
+            if libc is None:
+                log.warning("inotify is not available, polling collections instead")
+                config.set("storage", "watch", "False")
+                return None
+            _watcher = Watcher(libc)
+    return _watcher
+
+
+def watch(collection):
+    """Watch ``collection`` if possible; return whether it is watched."""
+    watcher = get()
+    if watcher is None:
+        return False
+    return watcher.watch(collection)
+
+
+def unwatch(collection):
+    """Stop watching ``collection``."""
+    if _watcher is not None:
+        _watcher.unwatch(collection)
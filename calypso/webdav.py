@@ -28,20 +28,40 @@ Define the main classes of a collection as seen from the server.
 
 import os
 import codecs
+import errno
+import collections
 import time
 import hashlib
 import logging
+import multiprocessing
 import tempfile
 import vobject
 import re
 import subprocess
+import threading
 import vobject.base
 
 import ConfigParser
 
-from . import config, paths
+from . import compression, config, follower, layout, maintenance, metrics, notify, paths, scanner, tzcache, watcher
 
-METADATA_FILENAME = ".calypso-collection"
+METADATA_FILENAME = layout.METADATA_FILENAME
+
+# A parsed vobject tree takes roughly this many times the size of its text
+PARSED_SIZE_FACTOR = 60
+
+# Items parsed when first needed so far; collections estimate their
+# memory again once it changed
+_lazy_parses = 0
+
+# Values of [storage] fsync: never, after every file written, or for all
+# the files written at once before they are committed
+FSYNC_NONE = "none"
+FSYNC_WRITE = "write"
+FSYNC_COMMIT = "commit"
+
+# Share the tzinfo of identical time zones between items
+tzcache.install()
 
 #
 # Recursive search for 'name' within 'vobject'
@@ -59,6 +79,18 @@ def find_vobject_value(vobject, name):
     return None
 
 
+def normalize_text(text):
+    """Return ``text`` as utf-8 bytes without control characters."""
+    try:
+        text = text.encode('utf8')
+    except UnicodeDecodeError:
+        text = text.decode('latin1').encode('utf-8')
+
+    # Strip out control characters
+
+    return re.sub(r"[\x01-\x09\x0b-\x1F\x7F]","",text)
+
+
 class Item(object):
 
     """Internal item. Wraps a vObject"""
@@ -67,29 +99,35 @@ class Item(object):
         """Initialize object from ``text`` and different ``kwargs``."""
 
         self.log = logging.getLogger(__name__)
-        try:
-            text = text.encode('utf8')
-        except UnicodeDecodeError:
-            text = text.decode('latin1').encode('utf-8')
-
-        # Strip out control characters
+        text = normalize_text(text)
+        self._text = None
+        self._object = self.parse(text, name, path)
+        self.scanned = scanner.scan(text)
 
-        text = re.sub(r"[\x01-\x09\x0b-\x1F\x7F]","",text)
+        self.path = path
+        self.name = self._object.x_calypso_name.value
+        self.urlpath = "/".join([parent_urlpath, self.name])
+        self.tag = self._object.name
+        self.etag = hashlib.sha1(text).hexdigest()
+        self.size = len(text)
 
+    def parse(self, text, name, path):
+        """Parse normalized ``text`` into a vobject, naming it ``name``."""
+        metrics.ITEMS_PARSED.inc()
         try:
-            self.object = vobject.readOne(text)
+            obj = vobject.readOne(text)
         except Exception:
             self.log.exception("Parse error in %s %s", name, path)
             raise
 
-        if 'x-calypso-name' not in self.object.contents:
+        if 'x-calypso-name' not in obj.contents:
             if not name:
-                if self.object.name == 'VCARD' or self.object.name == 'VEVENT':
-                    if 'uid' not in self.object.contents:
-                        self.object.add('UID').value = hashlib.sha1(text).hexdigest()
-                    name = self.object.uid.value
+                if obj.name == 'VCARD' or obj.name == 'VEVENT':
+                    if 'uid' not in obj.contents:
+                        obj.add('UID').value = hashlib.sha1(text).hexdigest()
+                    name = obj.uid.value
                 else:
-                    for child in self.object.getChildren():
+                    for child in obj.getChildren():
                         if child.name == 'VEVENT' or child.name == 'VCARD':
                             if 'uid' not in child.contents:
                                 child.add('UID').value = hashlib.sha1(text).hexdigest()
@@ -98,57 +136,65 @@ class Item(object):
                     if not name:
                         name = hashlib.sha1(text).hexdigest()
 
-            self.object.add("X-CALYPSO-NAME").value = name
+            obj.add("X-CALYPSO-NAME").value = name
         else:
-            names = self.object.contents[u'x-calypso-name']
+            names = obj.contents[u'x-calypso-name']
             if len(names) > 1:
-                self.object.contents[u'x-calypso-name'] = [names[0]]
+                obj.contents[u'x-calypso-name'] = [names[0]]
+        return obj
 
-        self.path = path
-        self.name = self.object.x_calypso_name.value
-        self.urlpath = "/".join([parent_urlpath, self.name])
-        self.tag = self.object.name
-        self.etag = hashlib.sha1(text).hexdigest()
+    @classmethod
+    def from_summary(cls, summary, parent_urlpath):
+        """Create an item from the result of ``summarize_file``.
+
+        The vobject is only built when first needed.
+
+        """
+        path, text, etag, scanned = summary
+        item = cls.__new__(cls)
+        item.log = logging.getLogger(__name__)
+        item._text = text
+        item._object = None
+        item.scanned = scanned
+        item.path = path
+        item.name = scanned.name
+        item.urlpath = "/".join([parent_urlpath, item.name])
+        item.tag = scanned.tag
+        item.etag = etag
+        item.size = len(text)
+        return item
+
+    @classmethod
+    def load(cls, text, path, parent_urlpath):
+        """Create the item stored at ``path`` from its ``text``.
+
+        Items naming themselves with a single X-CALYPSO-NAME, as all the
+        files written by calypso do, are only parsed when their vobject is
+        needed.
+
+        """
+        return cls.from_summary(summarize_text(text, path), parent_urlpath)
+
+    @property
+    def object(self):
+        """The vobject of this item."""
+        global _lazy_parses
+        if self._object is None:
+            # Files are read without a name, parse them the same way
+            self._object = self.parse(self._text, None, self.path)
+            self._text = None
+            _lazy_parses += 1
+        return self._object
 
     @property
     def is_vcard(self):
         """Whether this item is a vcard entry"""
-        if self.object.name == 'VCARD':
-            return True
-        if self.object.name == 'VEVENT':
-            return False
-        if self.object.name == 'VTODO':
-            return False
-        if self.object.name == 'VCALENDAR':
-            return False
-        for child in self.object.getChildren():
-            if child.name == 'VCARD':
-                return True
-            if child.name == 'VEVENT':
-                return False
-            if child.name == 'VTODO':
-                return False
-        return False
+        return scanner.is_vcard(self.tag, self.scanned.components)
 
     @property
     def is_vcal(self):
         """Whether this item is a vcal entry"""
-        if self.object.name == 'VCARD':
-            return False
-        if self.object.name == 'VEVENT':
-            return True
-        if self.object.name == 'VTODO':
-            return True
-        if self.object.name == 'VCALENDAR':
-            return True
-        for child in self.object.getChildren():
-            if child.name == 'VCARD':
-                return False
-            if child.name == 'VEVENT':
-                return True
-            if child.name == 'VTODO':
-                return True
-        return False
+        return scanner.is_vcal(self.tag, self.scanned.components)
 
     @property
     def file_prefix(self):
@@ -170,9 +216,12 @@ class Item(object):
     def text(self):
         """Item text.
 
-        Text is the serialized form of the item.
+        Text is the serialized form of the item, or the stored text of
+        items not parsed yet when it names the item.
 
         """
+        if self._object is None and self.scanned.names == 1:
+            return self._text.decode('utf-8')
         try:
             return self.object.serialize().decode('utf-8')
         except vobject.base.ValidateError as e:
@@ -183,8 +232,20 @@ class Item(object):
     def length(self):
         return "%d" % len(self.text)
 
+    @property
+    def estimated_size(self):
+        """Rough estimate of the memory held by this item, in bytes."""
+        if self._object is None:
+            # Only the text is held until the item is parsed
+            return self.size
+        return self.size * PARSED_SIZE_FACTOR
+
     @property
     def last_modified(self):
+        if self.scanned.last_modified:
+            value = scanner.utc_timetuple(self.scanned.last_modified)
+            if value:
+                return value
         value = find_vobject_value(self.object, "LAST-MODIFIED")
         if value:
             return value.utctimetuple()
@@ -216,6 +277,147 @@ class Item(object):
         return self.name
 
 
+def fsync_policy():
+    policy = config.get("storage", "fsync").strip().lower()
+    if policy not in (FSYNC_NONE, FSYNC_WRITE, FSYNC_COMMIT):
+        return FSYNC_NONE
+    return policy
+
+
+def fsync_directory(directory):
+    """fsync ``directory`` so that files created or renamed in it persist."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not supported by every file system
+        pass
+    finally:
+        os.close(fd)
+
+
+def summarize_text(text, path):
+    """Return what is needed to list the item stored at ``path``.
+
+    The text is only parsed when it does not name the item.
+
+    """
+    normalized = normalize_text(text)
+    scanned = scanner.scan(normalized)
+    if scanned.names != 1:
+        item = Item(text, None, path, "")
+        scanned = scanned._replace(name=item.name, tag=item.tag)
+    return (path, normalized, hashlib.sha1(normalized).hexdigest(), scanned)
+
+
+def summarize_file(path):
+    """Read the item stored at ``path`` and return what is needed to list it.
+
+    Runs in the parse pool; the result is the tuple expected by
+    ``Item.from_summary``, or the path and the error message if the file
+    cannot be read.
+
+    """
+    try:
+        return summarize_text(codecs.open(path, encoding='utf-8').read(), path)
+    except Exception as ex:
+        return (path, "%s: %s" % (type(ex).__name__, ex))
+
+
+#
+# Split an iCalendar or vCard stream into the texts of the items to
+# import, without holding more than one item in memory. Every event,
+# todo or journal of a VCALENDAR becomes its own calendar, carrying the
+# calendar properties and the time zones defined before it.
+#
+
+def split_components(lines):
+    depth = 0
+    header = []
+    # TZID -> lines of the time zone, a redefinition replaces the previous one
+    timezones = collections.OrderedDict()
+    component = []
+    calendar = False
+    for line in lines:
+        if not line.strip():
+            continue
+        if not line.endswith("\n"):
+            line += "\r\n"
+        keyword = line.strip().upper()
+        if keyword.startswith("BEGIN:"):
+            depth += 1
+            if depth == 1:
+                calendar = keyword == "BEGIN:VCALENDAR"
+                header = [line] if calendar else []
+                timezones.clear()
+                component = [] if calendar else [line]
+                continue
+        elif keyword.startswith("END:"):
+            depth -= 1
+            if depth == 0:
+                if not calendar:
+                    component.append(line)
+                    yield "".join(component)
+                component = []
+                continue
+        if not calendar:
+            component.append(line)
+        elif depth == 1 and not component:
+            header.append(line)
+        else:
+            component.append(line)
+            if depth == 1:
+                # End of a component of the calendar
+                if component[0].strip().upper() == "BEGIN:VTIMEZONE":
+                    tzid = [l for l in component if l.upper().startswith("TZID")][:1]
+                    timezones[tuple(tzid)] = component
+                else:
+                    yield "".join(header + sum(timezones.values(), []) + component +
+                                  ["END:VCALENDAR\r\n"])
+                component = []
+
+
+def prepare_import(text):
+    """Parse the item ``text`` to import.
+
+    Runs in the parse pool; the result is the name of the item, its
+    serialized text, the file prefix and extension to store it with, or
+    None and the error message.
+
+    """
+    try:
+        item = Item(text, None, None, "")
+        # Drop the duration of events having both dtstart and duration
+        for ve in item.object.contents.get('vevent', []):
+            if 'dtstart' in ve.contents and 'duration' in ve.contents:
+                del ve.contents['duration']
+        return (item.name, item.text, item.file_prefix, item.file_extension)
+    except Exception as ex:
+        return (None, "%s: %s" % (type(ex).__name__, ex))
+
+
+_parse_pool = None
+
+#
+# Return the process pool used to parse large batches of files, or None
+# if parsing in parallel is disabled. The server creates it at startup:
+# forking once background threads run could leave a worker process with
+# a lock, such as the one of logging, held for ever
+#
+
+def parse_pool():
+    global _parse_pool
+    workers = config.getint("storage", "parse_workers")
+    if workers <= 0:
+        return None
+    if _parse_pool is None:
+        _parse_pool = multiprocessing.Pool(workers)
+    return _parse_pool
+
+
 class Pathtime(object):
     """Path name and timestamps"""
 
@@ -260,7 +462,7 @@ class Collection(object):
 
     def read_file(self, path):
         text = codecs.open(path,encoding='utf-8').read()
-        item = Item(text, None, path, self.urlpath)
+        item = Item.load(text, path, self.urlpath)
         return item
 
     def insert_file(self, path):
@@ -291,6 +493,27 @@ class Collection(object):
         self.remove_file(path)
         self.insert_file(path)
 
+    def insert_files(self, filepaths):
+        """Insert the items stored at ``filepaths``.
+
+        Large batches are parsed in the parse pool.
+
+        """
+        pool = None
+        if len(filepaths) >= config.getint("storage", "parse_batch"):
+            pool = parse_pool()
+        if pool is None:
+            for filepath in filepaths:
+                self.insert_file(filepath)
+            return
+        self.log.debug("Parsing %d files in parallel", len(filepaths))
+        chunksize = max(1, len(filepaths) // (4 * config.getint("storage", "parse_workers")))
+        for summary in pool.imap(summarize_file, filepaths, chunksize):
+            if len(summary) == 2:
+                self.log.error("Insert %s failed: %s", summary[0], summary[1])
+                continue
+            self.my_items.append(Item.from_summary(summary, self.urlpath))
+
     __metadatafile = property(lambda self: os.path.join(self.path, METADATA_FILENAME))
 
     def scan_metadata(self, force):
@@ -307,7 +530,91 @@ class Collection(object):
         parser.read(self.__metadatafile)
         self.metadata = parser
 
+    def mark_dirty(self, path):
+        """Record that ``path`` changed on disk; None means anything may have."""
+        with self.dirty_lock:
+            if path is None:
+                self.dirty_all = True
+            elif self.dirty is not None:
+                self.dirty.add(path)
+
+    def take_dirty(self):
+        """Return and clear the changed paths, or None if a full scan is needed."""
+        with self.dirty_lock:
+            if self.dirty_all:
+                self.dirty_all = False
+                self.dirty = set()
+                return None
+            changed = self.dirty
+            self.dirty = set()
+            return changed
+
+    def scan_paths(self, changed):
+        """Bring the items stored at the ``changed`` paths up to date."""
+        self.log.debug("Scan %d changed paths in %s", len(changed), self.path)
+        for filepath in changed:
+            filename = os.path.basename(filepath)
+            if filename == METADATA_FILENAME:
+                self.scan_metadata(True)
+                continue
+            if filename.startswith('.'):
+                continue
+            files = self.files.setdefault(os.path.dirname(filepath), {})
+            known = files.get(filepath)
+            if not os.path.exists(filepath):
+                if known:
+                    self.log.debug("Removed %s", filepath)
+                    self.remove_file(filepath)
+                    del files[filepath]
+                continue
+            if known:
+                if not known.is_up_to_date():
+                    self.log.debug("Changed %s", filepath)
+                    self.scan_file(filepath)
+                continue
+            self.log.debug("New %s", filepath)
+            files[filepath] = Pathtime(filepath)
+            if not os.path.isdir(filepath):
+                self.insert_file(filepath)
+            else:
+                self.insert_directory("/".join([self.urlpath, filename]))
+        try:
+            self.mtime = os.path.getmtime(self.path)
+        except OSError:
+            pass
+        self.update_ctag()
+
+    def update_ctag(self):
+        h = hashlib.sha1()
+        size = 0
+        for item in self.my_items:
+            if getattr(item, 'etag', None):
+                h.update(item.etag)
+            else:
+                h.update(item.ctag)
+            size += item.estimated_size
+        ctag = '%d-' % self.latest_mtime() + h.hexdigest()
+        self._size = size
+        self._size_parses = _lazy_parses
+        if ctag != self._ctag:
+            self._ctag = ctag
+            notify.changed(self.urlpath)
+
     def scan_dir(self, force):
+        with metrics.phase("scan"):
+            self._scan_dir(force)
+
+    def _scan_dir(self, force):
+        if (self.watched or self.followed) and not force:
+            # The watcher, or the follower, tells us exactly what changed,
+            # no need to stat
+            changed = self.take_dirty()
+            if changed is not None:
+                if changed:
+                    self.scan_paths(changed)
+                return
+            force = True
+
         try:
             mtime = os.path.getmtime(self.path)
         except OSError:
@@ -316,44 +623,128 @@ class Collection(object):
 
         self.scan_metadata(force)
 
+        if self.sharded:
+            if self.watched:
+                # Changes within the shards are not reported by the watcher
+                watcher.unwatch(self)
+                self.watched = False
+            self.scan_shards(force, mtime)
+            return
+
         if not force and mtime == self.mtime:
             return
         self.log.debug("Scan %s", self.path)
         self.mtime = mtime
-        filenames = os.listdir(self.path)
-        newfiles = []
+        self.insert_files(self.scan_directory(self.path, os.listdir(self.path)))
+        self.update_ctag()
+
+    def scan_directory(self, directory, filenames):
+        """Bring the files known in ``directory`` up to date with ``filenames``.
+
+        Subcollections are inserted; return the new and changed item
+        files, to be parsed.
+
+        """
+        # Keyed as os.path.dirname gives it, without trailing separator
+        key = os.path.normpath(directory)
+        known = self.files.get(key, {})
+        files = {}
+        toparse = []
         for filename in filenames:
             if filename == METADATA_FILENAME:
                 continue
             if filename == '.git':
                 continue
-            filepath = os.path.join(self.path, filename)
-            for file in self.files:
-                if filepath == file.path:
-                    newfiles.append(file)
-                    if not file.is_up_to_date():
-                        self.log.debug("Changed %s", filepath)
-                        self.scan_file(filepath)
-                    break
-            else:
-                self.log.debug("New %s", filepath)
-                newfiles.append(Pathtime(filepath))
-                if not os.path.isdir(filepath):
-                    self.insert_file(filepath)
-                else:
-                    self.insert_directory("/".join([self.urlpath, filename]))
-        for file in self.files:
-            if os.path.basename(file.path) not in filenames:
-                self.log.debug("Removed %s", file.path)
-                self.remove_file(file.path)
-        h = hashlib.sha1()
-        for item in self.my_items:
-            if getattr(item, 'etag', None):
-                h.update(item.etag)
+            if filename.startswith('.'):
+                # Files being written
+                continue
+            filepath = os.path.join(directory, filename)
+            file = known.get(filepath)
+            if file is not None:
+                files[filepath] = file
+                if not file.is_up_to_date():
+                    self.log.debug("Changed %s", filepath)
+                    self.remove_file(filepath)
+                    toparse.append(filepath)
+                continue
+            self.log.debug("New %s", filepath)
+            files[filepath] = Pathtime(filepath)
+            if not os.path.isdir(filepath):
+                toparse.append(filepath)
             else:
-                h.update(item.ctag)
-        self._ctag = '%d-' % self.mtime + h.hexdigest()
-        self.files = newfiles
+                self.insert_directory("/".join([self.urlpath, filename]))
+        for filepath in known:
+            if filepath not in files:
+                self.log.debug("Removed %s", filepath)
+                self.remove_file(filepath)
+        self.files[key] = files
+        return toparse
+
+    def scan_shards(self, force, mtime):
+        """Scan a sharded collection, listing only the shards that changed."""
+        toparse = []
+        changed = force or mtime != self.mtime
+        if changed:
+            self.log.debug("Scan %s", self.path)
+            self.mtime = mtime
+            shards = layout.shards(self.path)
+            for directory in list(self.shard_mtimes):
+                if directory not in shards:
+                    for filepath in self.files.pop(directory, {}):
+                        self.log.debug("Removed %s", filepath)
+                        self.remove_file(filepath)
+                    del self.shard_mtimes[directory]
+            for directory in shards:
+                self.shard_mtimes.setdefault(directory, None)
+            # Files and subcollections outside of the shards
+            filenames = [filename for filename in os.listdir(self.path)
+                         if os.path.join(self.path, filename) not in self.shard_mtimes]
+            toparse.extend(self.scan_directory(self.path, filenames))
+        for directory in sorted(self.shard_mtimes):
+            new = self.scan_shard(directory, force)
+            if new is not None:
+                toparse.extend(new)
+                changed = True
+        if changed:
+            self.insert_files(toparse)
+            self.update_ctag()
+
+    def scan_shard(self, directory, force):
+        """Scan the shard ``directory`` if it changed.
+
+        Return the files to parse, or None if the shard did not change.
+
+        """
+        try:
+            mtime = os.path.getmtime(directory)
+        except OSError:
+            # Removed, the collection directory has changed too
+            return None
+        if not force and mtime == self.shard_mtimes.get(directory):
+            return None
+        self.shard_mtimes[directory] = mtime
+        return self.scan_directory(directory, os.listdir(directory))
+
+    def latest_mtime(self):
+        """Last modification time of the collection directory or its shards."""
+        return max([self.mtime] + [mtime for mtime in self.shard_mtimes.values() if mtime])
+
+    @property
+    def sharded(self):
+        return self.metadata is not None and \
+            layout.metadata_layout(self.metadata) == layout.SHARDED
+
+    def item_directory(self, key):
+        """Directory receiving the file of the item called ``key``."""
+        if not self.sharded:
+            return self.path
+        directory = os.path.join(self.path, layout.shard_name(key))
+        try:
+            os.mkdir(directory)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        return directory
 
     def __init__(self, path):
         """Initialize the collection with ``cal`` and ``user`` parameters."""
@@ -363,13 +754,29 @@ class Collection(object):
         self.urlpath = path
         self.owner = paths.url_to_owner(path)
         self.path = paths.url_to_file(path)
-        self.files = []
+        # directory -> path -> Pathtime of the files of the collection
+        self.files = {}
+        # shard directory -> mtime when last listed
+        self.shard_mtimes = {}
         self.my_items = []
         self.mtime = 0
         self._ctag = ''
+        self._size = 0
+        self._size_parses = _lazy_parses
         self.etag = hashlib.sha1(self.path).hexdigest()
         self.metadata = None
         self.metadata_mtime = None
+        self._compressed_ctag = None
+        self._compressed = {}
+        self.dirty_lock = threading.Lock()
+        self.dirty = set()
+        self.dirty_all = True
+        # Files written and not fsynced yet, with [storage] fsync = commit
+        self.unsynced = set()
+        # Start watching before the first scan so no change is missed
+        self.watched = watcher.watch(self)
+        # Changes of a follower only come from its git updates
+        self.followed = follower.enabled()
         self.scan_dir(False)
         self.tag = "Collection"
 
@@ -383,6 +790,8 @@ class Collection(object):
         return True
 
     def git_commit(self, context):
+        # Group the fsync of the files written with their commit
+        self.sync_pending()
         args = ["git", "commit", "--allow-empty"]
         env = {}
 
@@ -397,42 +806,156 @@ class Collection(object):
             # information explicitly in the config file. (slicing it in after
             # the git command as position is important with git arguments)
             args[1:1] = ["-c", "advice.implicitIdentity=false"]
+        if maintenance.enabled():
+            # Leave packing the objects to maintenance, outside of requests
+            args[1:1] = ["-c", "gc.auto=0"]
         if "user-agent" in context:
             message += u"\n\nUser-Agent: %r"%context['user-agent']
 
         args.extend(["-m", message.encode('utf8')])
 
-        subprocess.check_call(args, cwd=self.path, env=env)
+        self.run_git(args, env=env)
+        maintenance.committed(self.path)
+
+    def run_git(self, args, env=None):
+        """Run the git command ``args`` in the collection directory."""
+        with metrics.phase("git"), maintenance.lock(self.path):
+            subprocess.check_call(args, cwd=self.path, env=env)
 
     def git_add(self, path, context):
         if self.has_git():
-            subprocess.check_call(["git", "add", os.path.basename(path)], cwd=self.path)
+            self.run_git(["git", "add", os.path.relpath(path, self.path)])
             self.git_commit(context=context)
 
     def git_rm(self, path, context):
         if self.has_git():
-            subprocess.check_call(["git", "rm", os.path.basename(path)], cwd=self.path)
+            self.run_git(["git", "rm", os.path.relpath(path, self.path)])
             self.git_commit(context=context)
 
+    def git_stage(self, filepaths):
+        """Stage the files ``filepaths``, whether they were written or removed."""
+        written = [os.path.relpath(filepath, self.path) for filepath in filepaths
+                   if os.path.lexists(filepath)]
+        # Removed files may never have been committed
+        removed = [os.path.relpath(filepath, self.path) for filepath in filepaths
+                   if not os.path.lexists(filepath)]
+        for start in range(0, len(written), 1000):
+            self.run_git(["git", "add", "--"] + written[start:start + 1000])
+        for start in range(0, len(removed), 1000):
+            self.run_git(["git", "rm", "-q", "--cached", "--ignore-unmatch", "--"] +
+                         removed[start:start + 1000])
+
     def git_change(self, path, context):
         if self.has_git():
-            subprocess.check_call(["git", "add", os.path.basename(path)], cwd=self.path)
+            self.run_git(["git", "add", os.path.relpath(path, self.path)])
             self.git_commit(context=context)
             # Touch directory so that another running instance will update
             try:
-                os.utime(self.path, None)
+                os.utime(os.path.dirname(path), None)
             except Exception as ex:
                 self.log.exception("Failed to set directory mtime")
 
-    def write_file(self, item):
-        fd, path = tempfile.mkstemp(item.file_extension, item.file_prefix, dir=self.path)
+    def write_file(self, item, target=None):
+        return self.write_text(item.text, item.file_prefix, item.file_extension,
+                               item.name, target)
+
+    def write_text(self, text, prefix, extension, name=None, target=None):
+        """Write ``text`` to the file ``target``, or a new item file.
+
+        The text goes to a hidden temporary file renamed into place, so
+        an item file is never seen half-written. Return the path written.
+
+        """
+        if target is None:
+            directory = self.item_directory(name or text)
+        else:
+            directory = os.path.dirname(target)
+        while True:
+            fd, tmp = tempfile.mkstemp(extension, "." + prefix, dir=directory)
+            path = target or os.path.join(directory, os.path.basename(tmp)[1:])
+            if target or not os.path.exists(path):
+                break
+            os.close(fd)
+            os.unlink(tmp)
         self.log.debug('Trying to write to %s', path)
-        file = os.fdopen(fd, 'w')
-        file.write(item.text.encode('utf-8'))
-        file.close()
-        self.log.debug('Wrote %s to %s', file, path)
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write(text.encode('utf-8'))
+                if fsync_policy() == FSYNC_WRITE:
+                    file.flush()
+                    os.fsync(file.fileno())
+            os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        self.synced(path)
+        self.log.debug('Wrote %s', path)
         return path
 
+    def synced(self, path):
+        """Apply the fsync policy after ``path`` was written or removed."""
+        policy = fsync_policy()
+        if policy == FSYNC_WRITE:
+            fsync_directory(os.path.dirname(path))
+        elif policy == FSYNC_COMMIT:
+            with self.dirty_lock:
+                self.unsynced.add(path)
+
+    def sync_pending(self):
+        """fsync the files written since the last commit, and their directories."""
+        with self.dirty_lock:
+            pending, self.unsynced = self.unsynced, set()
+        if not pending:
+            return
+        with metrics.phase("fsync"):
+            for path in pending:
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError:
+                    # Removed since
+                    continue
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            for directory in set(os.path.dirname(path) for path in pending):
+                fsync_directory(directory)
+
+    def register_file(self, path, item):
+        """Record that ``item`` is now stored at ``path``, without rescanning.
+
+        ``item`` is None if ``path`` was removed.
+
+        """
+        self.register_files([(path, item)])
+
+    def register_files(self, changes):
+        """Record the ``changes``, pairs of a path and the item now stored there."""
+        changed = set(path for path, item in changes)
+        self.my_items = [item for item in self.my_items if item.path not in changed]
+        directories = set()
+        for path, item in changes:
+            directory = os.path.dirname(path)
+            directories.add(directory)
+            files = self.files.setdefault(directory, {})
+            if item is None:
+                files.pop(path, None)
+            else:
+                files[path] = Pathtime(path)
+                self.my_items.append(item)
+        # Later scans only look for changes made by others
+        for directory in directories:
+            try:
+                mtime = os.path.getmtime(directory)
+            except OSError:
+                mtime = 0
+            if directory == os.path.normpath(self.path):
+                self.mtime = mtime
+            else:
+                self.shard_mtimes[directory] = mtime
+        self.update_ctag()
+
     def _action_msg(self, action, item):
         return u'%s %s' % (action, str(item).decode('utf-8'))
 
@@ -453,7 +976,9 @@ class Collection(object):
         try:
             path = self.write_file(item)
             self.git_add(path, context=context)
-            self.scan_dir(True)
+            stored = self.read_file(path)
+            self.register_file(path, stored)
+            return stored
         except OSError as ex:
             self.log.exception("Error writing file")
             raise
@@ -467,8 +992,9 @@ class Collection(object):
         context['action'] = self._action_msg("Remove", item)
         try:
             os.unlink(item.path)
+            self.synced(item.path)
             self.git_rm(item.path, context=context)
-            self.scan_dir(True)
+            self.register_file(item.path, None)
         except Exception as ex:
             self.log.exception("Failed to remove %s", item.path)
             raise
@@ -477,11 +1003,11 @@ class Collection(object):
         self._log_action("Change", item)
         context['action'] = self._action_msg("Modify", item)
         try:
-            new_path = self.write_file(item)
-            os.rename(new_path, item.path)
-            self.scan_file(item.path)
+            self.write_file(item, item.path)
             self.git_change(item.path, context=context)
-            self.scan_dir(True)
+            stored = self.read_file(item.path)
+            self.register_file(item.path, stored)
+            return stored
         except Exception as ex:
             self.log.exception("Failed to rewrite %s", item.path)
             raise
@@ -518,13 +1044,12 @@ class Collection(object):
             self.log.debug("Item %s already present %s" , new_item.name, self.get_item(new_item.name).path)
             raise CalypsoError(new_item.name, "Item already present")
         self.log.debug("New item %s", new_item.name)
-        self.create_file(new_item, context=context)
-        return new_item
+        return self.create_file(new_item, context=context)
 
     def remove(self, name, context):
         """Remove object named ``name`` from collection."""
         self.log.debug("Remove object %s", name)
-        for old_item in self.my_items:
+        for old_item in list(self.my_items):
             if old_item.name == name:
                 self.destroy_file(old_item, context=context)
 
@@ -542,15 +1067,133 @@ class Collection(object):
             self.log.exception("Failed to replace %s", name)
             raise
 
-        ret = False
         if path is not None:
             self.log.debug('rewrite path %s', path)
-            self.rewrite_file(new_item, context=context)
+            return self.rewrite_file(new_item, context=context)
+        self.log.debug('remove and append item %s', name)
+        self.remove(name, context=context)
+        return self.append(name, text, context=context)
+
+    def transfer(self, item, destination, name, move, context):
+        """Copy or move ``item`` to the collection ``destination`` as ``name``.
+
+        An item called ``name`` in ``destination`` is replaced. The stored
+        text is kept unless the item is renamed, a moved file is renamed
+        into place, and a move within one git repository is a single
+        commit. Both collections are updated without rescanning them.
+        Return the stored item.
+
+        """
+        old_item = destination.get_item(name)
+        if old_item is item:
+            raise CalypsoError(name, "Source and destination are the same item")
+        if name == item.name:
+            text = item.text
         else:
-            self.log.debug('remove and append item %s', name)
-            self.remove(name)
-            self.append(name, text, context=context)
-        return new_item
+            obj = item.parse(normalize_text(item.text), name, item.path)
+            obj.x_calypso_name.value = name
+            text = obj.serialize().decode('utf-8')
+
+        action = u"Move" if move else u"Copy"
+        self.log.debug("%s %s to %s as %s", action, item.name, destination.urlpath, name)
+        context['action'] = u'%s to %s' % (self._action_msg(action, item), destination.urlpath)
+
+        if old_item is not None:
+            target = old_item.path
+        else:
+            target = os.path.join(destination.item_directory(name), os.path.basename(item.path))
+            if os.path.exists(target):
+                target = None
+        path = None
+        if move and name == item.name and target is not None:
+            try:
+                os.rename(item.path, target)
+                path = target
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        if path is None:
+            path = destination.write_text(text, item.file_prefix, item.file_extension,
+                                          name, target)
+            if move:
+                os.unlink(item.path)
+        else:
+            destination.synced(path)
+        if move:
+            self.synced(item.path)
+
+        repository = paths.git_root(destination.path)
+        if move and repository is not None and repository == paths.git_root(self.path):
+            # As git mv: the removal and the addition in one commit
+            self.sync_pending()
+            destination.run_git(["git", "add", "-A", "--",
+                                 os.path.relpath(path, destination.path),
+                                 os.path.relpath(item.path, destination.path)])
+            destination.git_commit(context=context)
+        else:
+            destination.git_add(path, context=context)
+            if move:
+                self.git_rm(item.path, context=context)
+
+        if move:
+            self.register_file(item.path, None)
+        stored = destination.read_file(path)
+        destination.register_file(path, stored)
+        return stored
+
+    def batch(self, changes, context):
+        """Apply ``changes`` with a single commit.
+
+        ``changes`` are pairs of an item name and the new item, None to
+        remove the items of that name. The files are all written before
+        being committed and registered at once. Return the stored items,
+        None for the removed ones.
+
+        """
+        if not changes:
+            return []
+        existing = {}
+        for item in self.my_items:
+            existing.setdefault(item.name, []).append(item)
+        counts = {"Add": 0, "Modify": 0, "Remove": 0}
+        # (path, new item) of each change, None for removals
+        stored = []
+        # Paths of the files removed
+        removed = []
+        try:
+            for name, new_item in changes:
+                old_items = existing.get(name, [])
+                if new_item is None:
+                    stored.append(None)
+                elif old_items:
+                    # The first item of the name is rewritten, the others removed
+                    stored.append((self.write_file(new_item, old_items[0].path), new_item))
+                    counts["Modify"] += 1
+                    old_items = old_items[1:]
+                else:
+                    stored.append((self.write_file(new_item), new_item))
+                    counts["Add"] += 1
+                for old_item in old_items:
+                    os.unlink(old_item.path)
+                    self.synced(old_item.path)
+                    removed.append(old_item.path)
+                    counts["Remove"] += 1
+        except Exception:
+            self.log.exception("Failed to apply a batch of changes to %s", self.path)
+            # Leave the files written so far to the next scan
+            self.mark_dirty(None)
+            raise
+        context['action'] = u"Batch of changes: %s" % u", ".join(
+            u"%s %d" % (action, counts[action]) for action in ("Add", "Modify", "Remove")
+            if counts[action])
+        written = [change[0] for change in stored if change is not None]
+        if self.has_git():
+            self.git_stage(written + removed)
+            self.git_commit(context=context)
+        stored = [change and (change[0], self.read_file(change[0])) for change in stored]
+        self.register_files([change for change in stored if change is not None] +
+                            [(path, None) for path in removed])
+        return [change and change[1] for change in stored]
 
     def import_item(self, new_item, path):
         old_item = self.get_item(new_item.name)
@@ -564,29 +1207,157 @@ class Collection(object):
 
     def import_file(self, path):
         """Merge items from ``path`` to collection.
-        """
 
+        The file is streamed and its items parsed in the parse pool when
+        enabled. All files are written before being committed at once, or
+        in batches of ``[storage] import_batch`` files, and the collection
+        is scanned only once at the end. If the import fails, the files
+        written since the last commit are committed as a partial import.
+
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # name -> path of the items of the collection
+        existing = dict((item.name, item.path) for item in self.my_items if item.path)
+        batch = config.getint("storage", "import_batch")
+        pending = []
+        added = []
+        updated = 0
+        success = True
         try:
-            new_object = vobject.readComponents(codecs.open(path,encoding='utf-8').read())
-            for new_ics in new_object:
-                if new_ics.name == 'VCALENDAR':
-
-                    events = new_ics.vevent_list
-                    for ve in events:
-                        # Check for events with both dtstart and duration entries and
-                        # delete the duration one
-                        if 'dtstart' in ve.contents and 'duration' in ve.contents:
-                            del ve.contents['duration']
-                        new_ics.vevent_list = [ve]
-                        new_item = Item(new_ics.serialize().decode('utf-8'), None, path, self.urlpath)
-                        self.import_item(new_item, path)
+            with codecs.open(path, encoding='utf-8') as f:
+                components = split_components(f)
+                pool = parse_pool()
+                if pool is None:
+                    results = (prepare_import(text) for text in components)
                 else:
-                    new_item = Item(new_ics.serialize().decode('utf-8'), None, path, self.urlpath)
-                    self.import_item(new_item, path)
-            return True
+                    results = pool.imap(prepare_import, components, 16)
+                for result in results:
+                    if result[0] is None:
+                        self.log.error("Failed to import an item of %s: %s", path, result[1])
+                        success = False
+                        continue
+                    name, text, prefix, extension = result
+                    old_path = existing.get(name)
+                    new_path = self.write_text(text, prefix, extension, name, old_path)
+                    if old_path is not None:
+                        updated += 1
+                    else:
+                        existing[name] = new_path
+                        added.append(new_path)
+                    pending.append(new_path)
+                    if batch and len(pending) >= batch:
+                        self.git_import(pending, path)
+                        pending = []
+            if pending:
+                self.git_import(pending, path)
+            self.log.debug("Imported %s: %d added, %d updated", path, len(added), updated)
+            return success
         except Exception as ex:
             self.log.exception("Failed to import: %s", path)
+            if pending:
+                self.abort_import(pending, added, path)
             return False
+        finally:
+            # Keep the new items in import order, the scan picks up the rest
+            self.insert_files(added)
+            for filepath in added:
+                self.files.setdefault(os.path.dirname(filepath), {})[filepath] = Pathtime(filepath)
+            self.scan_dir(True)
+
+    def git_import(self, filepaths, source, partial=False):
+        """Commit the imported files ``filepaths`` at once."""
+        if not self.has_git():
+            return
+        names = [os.path.relpath(filepath, self.path) for filepath in filepaths]
+        # Keep command lines reasonably short
+        for start in range(0, len(names), 1000):
+            self.run_git(["git", "add", "--"] + names[start:start + 1000])
+        context = {'action': u"%s %d items from %s" % (
+            "Partial import of" if partial else "Import", len(names),
+            os.path.basename(source).decode('utf-8'))}
+        self.git_commit(context=context)
+
+    def abort_import(self, filepaths, added, source):
+        """Commit the files ``filepaths`` written by a failed import.
+
+        If that commit fails too, the files are put back as they were
+        committed, and the new ones in ``added`` removed from it, so
+        that no item is served without being committed.
+
+        """
+        try:
+            self.git_import(filepaths, source, partial=True)
+            return
+        except Exception:
+            self.log.exception("Failed to commit the partial import of %s", source)
+        new = set(added).intersection(filepaths)
+        names = [os.path.relpath(filepath, self.path) for filepath in filepaths]
+        updated = [os.path.relpath(filepath, self.path) for filepath in filepaths
+                   if filepath not in new]
+        try:
+            for start in range(0, len(names), 1000):
+                self.run_git(["git", "reset", "-q", "--"] + names[start:start + 1000])
+            for start in range(0, len(updated), 1000):
+                self.run_git(["git", "checkout", "--"] + updated[start:start + 1000])
+        except Exception:
+            self.log.exception("Failed to restore the files imported from %s", source)
+        for filepath in new:
+            os.unlink(filepath)
+        added[:] = [filepath for filepath in added if filepath not in new]
+
+    def set_layout(self, name):
+        """Move the item files to the layout ``name``, committing it at once.
+
+        Return the number of files moved.
+
+        """
+        self.scan_dir(True)
+        moves = []
+        for item in self.my_items:
+            if not getattr(item, 'path', None):
+                continue
+            if name == layout.SHARDED:
+                directory = os.path.join(self.path, layout.shard_name(item.name))
+            else:
+                directory = os.path.normpath(self.path)
+            target = os.path.join(directory, os.path.basename(item.path))
+            if target != item.path:
+                moves.append((item.path, target))
+        changed = []
+        for source, target in moves:
+            if os.path.exists(target):
+                self.log.error("Cannot move %s, %s exists", source, target)
+                continue
+            if not os.path.isdir(os.path.dirname(target)):
+                os.mkdir(os.path.dirname(target))
+            os.rename(source, target)
+            changed.extend([source, target])
+        moved = len(changed) // 2
+        if name == layout.FLAT:
+            for directory in layout.shards(self.path):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+        parser = self.metadata or ConfigParser.RawConfigParser()
+        if not parser.has_section('collection'):
+            parser.add_section('collection')
+        parser.set('collection', 'layout', name)
+        with open(self.__metadatafile, 'w') as f:
+            parser.write(f)
+        changed.append(self.__metadatafile)
+
+        if self.has_git():
+            self.git_stage(changed)
+            self.git_commit(context={'action': u"Change layout to %s" % name})
+
+        self.files = {}
+        self.shard_mtimes = {}
+        self.my_items = []
+        self.scan_dir(True)
+        return moved
 
     def write(self, headers=None, items=None):
         return True
@@ -606,10 +1377,27 @@ class Collection(object):
     def text(self):
         """Collection as plain text."""
         self.scan_dir(False)
-        _text = ""
-        for item in self.my_items:
-            _text = _text + item.text
-        return _text
+        return u"".join(item.text for item in self.my_items)
+
+    def compressed_text(self, coding, encoding):
+        """Collection text encoded in ``encoding`` and compressed with ``coding``.
+
+        The compressed form is kept until the ctag of the collection
+        changes, so repeated exports only pay for compression once.
+
+        """
+        ctag = self.ctag
+        if self._compressed_ctag != ctag:
+            self._compressed_ctag = ctag
+            self._compressed = {}
+        key = (coding, encoding)
+        if key not in self._compressed:
+            compressor = compression.compressor(coding)
+            chunks = [compressor.compress(item.text.encode(encoding, "xmlcharrefreplace"))
+                      for item in self.my_items]
+            chunks.append(compressor.flush())
+            self._compressed[key] = "".join(chunks)
+        return self._compressed[key]
 
     @property
     def color(self):
@@ -638,12 +1426,21 @@ class Collection(object):
 
         """
         self.scan_dir(False)
-        return time.gmtime(self.mtime)
+        return time.gmtime(self.latest_mtime())
 
     @property
     def length(self):
         return "%d" % len(self.text)
 
+    @property
+    def estimated_size(self):
+        """Rough estimate of the memory held by the items, in bytes."""
+        if self._size_parses != _lazy_parses:
+            # Items may have been parsed since
+            self._size_parses = _lazy_parses
+            self._size = sum(item.estimated_size for item in self.my_items)
+        return self._size
+
     @property
     def is_addressbook(self):
         try:
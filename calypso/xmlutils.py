@@ -37,8 +37,9 @@ import dateutil.tz
 import datetime
 import email.utils
 import logging
+import urlparse
 
-from . import client, config, webdav, paths
+from . import client, config, metrics, tzcache, webdav, paths
 
 __package__ = 'calypso.xmlutils'
 
@@ -47,7 +48,8 @@ NAMESPACES = {
     "A": "urn:ietf:params:xml:ns:carddav",
     "D": "DAV:",
     "E": "http://apple.com/ns/ical/",
-    "CS": "http://calendarserver.org/ns/"}
+    "CS": "http://calendarserver.org/ns/",
+    "Y": "http://keithp.com/calypso/ns/"}
 
 log = logging.getLogger(__name__)
 
@@ -58,6 +60,9 @@ def _tag(short_name, local):
 
 def _response(code):
     """Return full W3C names from HTTP status codes."""
+    if code == client.FAILED_DEPENDENCY:
+        # Not known to httplib
+        return "HTTP/1.1 424 Failed Dependency"
     return "HTTP/1.1 %i %s" % (code, client.responses[code])
 
 def delete(path, collection, context):
@@ -82,7 +87,8 @@ def delete(path, collection, context):
     status.text = _response(200)
     response.append(status)
 
-    return ET.tostring(multistatus, config.get("encoding", "request"))
+    with metrics.phase("serialize"):
+        return ET.tostring(multistatus, config.get("encoding", "request"))
 
 
 def propfind(path, xml_request, collection, depth, context):
@@ -139,6 +145,9 @@ def propfind(path, xml_request, collection, depth, context):
     else:
         items = []
 
+    metrics.count("items_scanned", len(items))
+    metrics.count("items_matched", len(items))
+
     for item in items:
         is_collection = isinstance(item, webdav.Collection)
 
@@ -229,7 +238,8 @@ def propfind(path, xml_request, collection, depth, context):
         status.text = _response(200)
         propstat.append(status)
 
-    return ET.tostring(multistatus, config.get("encoding", "request"))
+    with metrics.phase("serialize"):
+        return ET.tostring(multistatus, config.get("encoding", "request"))
 
 
 def propfind_deny():
@@ -240,7 +250,8 @@ def propfind_deny():
     error = ET.Element(_tag("D", "error"))
     prec_code = ET.Element(_tag("D", "propfind-finite-depth"))
     error.append(prec_code)
-    return ET.tostring(error, config.get("encoding", "request"))
+    with metrics.phase("serialize"):
+        return ET.tostring(error, config.get("encoding", "request"))
 
 
 def put(path, webdav_request, collection, context):
@@ -257,6 +268,109 @@ def put(path, webdav_request, collection, context):
         return collection.append(name, webdav_request, context=context)
 
 
+def _etag_matches(value, etag):
+    """Whether the If-Match ``value`` matches ``etag``."""
+    value = value.strip()
+    return value == "*" or value.replace('\\"', '"').strip('"') == etag
+
+
+def batch(path, xml_request, collection, context):
+    """Read and answer batch POST requests.
+
+    The request lists changes to items of the collection, applied
+    together with a single commit, or not at all if one of them cannot
+    be: its status says why, and the others fail with 424 Failed
+    Dependency. ``if-match`` is optional::
+
+        <Y:batch xmlns:D="DAV:" xmlns:Y="http://keithp.com/calypso/ns/">
+          <Y:put>
+            <D:href>/user/calendar/event.ics</D:href>
+            <Y:if-match>"etag"</Y:if-match>
+            <Y:data>BEGIN:VCALENDAR...</Y:data>
+          </Y:put>
+          <Y:delete>
+            <D:href>/user/calendar/old.ics</D:href>
+          </Y:delete>
+        </Y:batch>
+
+    The answer is a multistatus giving the new etag of the items put.
+
+    """
+    root = ET.fromstring(xml_request)
+    if root.tag != _tag("Y", "batch"):
+        raise ValueError("Not a batch request: %s" % root.tag)
+
+    collection_path = paths.collection_from_path(path)
+    existing = {}
+    for item in collection.items:
+        existing.setdefault(item.name, item)
+
+    hrefs = []
+    changes = []
+    statuses = []
+    names = set()
+    with metrics.phase("parse"):
+        for element in root:
+            href = (element.findtext(_tag("D", "href")) or "").strip()
+            name = new_item = status = None
+            if element.tag not in (_tag("Y", "put"), _tag("Y", "delete")) or not href:
+                status = client.BAD_REQUEST
+            else:
+                target = urlparse.urlparse(href).path
+                name = paths.resource_from_path(target)
+                if not name or paths.collection_from_path(target) != collection_path:
+                    status = client.FORBIDDEN
+                elif name in names:
+                    status = client.CONFLICT
+                names.add(name)
+            old_item = existing.get(name)
+            if_match = element.findtext(_tag("Y", "if-match"))
+            if status is not None:
+                pass
+            elif if_match is not None and \
+                    (old_item is None or not _etag_matches(if_match, old_item.etag)):
+                status = client.PRECONDITION_FAILED
+            elif element.tag == _tag("Y", "delete"):
+                if old_item is None:
+                    status = client.NOT_FOUND
+                else:
+                    status = client.NO_CONTENT
+            else:
+                try:
+                    new_item = webdav.Item(element.findtext(_tag("Y", "data")), name,
+                                           old_item and old_item.path, collection.urlpath)
+                    status = client.NO_CONTENT if old_item else client.CREATED
+                except Exception:
+                    log.exception("Invalid item %s in batch", href)
+                    status = client.BAD_REQUEST
+            hrefs.append(href)
+            changes.append((name, new_item))
+            statuses.append(status)
+
+    if any(status >= 300 for status in statuses):
+        statuses = [status if status >= 300 else client.FAILED_DEPENDENCY
+                    for status in statuses]
+        stored = [None] * len(changes)
+    else:
+        stored = collection.batch(changes, context=context)
+
+    # Writing answer
+    multistatus = ET.Element(_tag("D", "multistatus"))
+    for href, status, item in zip(hrefs, statuses, stored):
+        response = ET.SubElement(multistatus, _tag("D", "response"))
+        ET.SubElement(response, _tag("D", "href")).text = href
+        if item is None:
+            ET.SubElement(response, _tag("D", "status")).text = _response(status)
+            continue
+        propstat = ET.SubElement(response, _tag("D", "propstat"))
+        prop = ET.SubElement(propstat, _tag("D", "prop"))
+        ET.SubElement(prop, _tag("D", "getetag")).text = item.etag
+        ET.SubElement(propstat, _tag("D", "status")).text = _response(status)
+
+    with metrics.phase("serialize"):
+        return ET.tostring(multistatus, config.get("encoding", "request"))
+
+
 def match_filter_element(vobject, fe):
     if fe.tag == _tag("C", "comp-filter"):
         comp = fe.get("name")
@@ -306,14 +420,10 @@ def match_filter_element(vobject, fe):
             except Exception:
                 0
             if dtstart.tzinfo is None:
-                dtstart = dtstart.replace(tzinfo = dateutil.tz.tzlocal())
+                dtstart = dtstart.replace(tzinfo = tzcache.local())
             rruleset.rdate(dtstart)
-        start_datetime = dateutil.parser.parse(start)
-        if start_datetime.tzinfo is None:
-            start_datetime = start_datetime.replace(tzinfo = dateutil.tz.tzlocal())
-        end_datetime = dateutil.parser.parse(end)
-        if end_datetime.tzinfo is None:
-            end_datetime = end_datetime.replace(tzinfo = dateutil.tz.tzlocal())
+        start_datetime = tzcache.bound(start)
+        end_datetime = tzcache.bound(end)
         try:
             if rruleset.between(start_datetime, end_datetime, True):
                 return True
@@ -334,6 +444,11 @@ def match_filter(item, filter):
     if filter.tag != _tag("C", "filter"):
         return True
     for fe in filter.getchildren():
+        # A component filter not naming the item cannot match, no need
+        # to parse it
+        if fe.tag == _tag("C", "comp-filter") and fe.get("name") and \
+                fe.get("name") != item.tag:
+            continue
         if match_filter_element(item.object, fe):
             return True
     return False
@@ -365,6 +480,8 @@ def report(path, xml_request, collection):
 
     # Writing answer
     multistatus = ET.Element(_tag("D", "multistatus"))
+    filter_time = filter_cpu = 0.0
+    scanned = matches = 0
 
     for hreference in hreferences:
         # Check if the reference is an item or a collection
@@ -380,8 +497,14 @@ def report(path, xml_request, collection):
 
 
         for item in items:
-            if not match_filter(item, filter_element):
+            start, cpu_start = time.time(), metrics.thread_time()
+            matched = match_filter(item, filter_element)
+            filter_time += time.time() - start
+            filter_cpu += metrics.thread_time() - cpu_start
+            scanned += 1
+            if not matched:
                 continue
+            matches += 1
 
             response = ET.Element(_tag("D", "response"))
             multistatus.append(response)
@@ -410,6 +533,11 @@ def report(path, xml_request, collection):
             status.text = _response(200)
             propstat.append(status)
 
-    reply = ET.tostring(multistatus, config.get("encoding", "request"))
+    metrics.record_phase("filter", filter_time, filter_cpu)
+    metrics.count("items_scanned", scanned)
+    metrics.count("items_matched", matches)
+
+    with metrics.phase("serialize"):
+        reply = ET.tostring(multistatus, config.get("encoding", "request"))
 
     return reply
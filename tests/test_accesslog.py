@@ -0,0 +1,47 @@
+# vim: set fileencoding=utf-8 :
+"""Test the structured access log"""
+
+import json
+import logging
+import os
+
+from calypso import accesslog, metrics
+
+from .testutils import CalypsoTestCase
+
+
+class TestAccessLog(CalypsoTestCase):
+
+    def test_entry(self):
+        record = metrics.begin_request()
+        metrics.note("collection", "/user/calendar")
+        metrics.count("items_scanned", 10)
+        metrics.count("items_matched", 2)
+        metrics.record_phase("scan", 0.5, 0.25)
+        metrics.end_request()
+
+        entry = accesslog.entry(record, method="REPORT", status=207)
+        self.assertEqual(entry["method"], "REPORT")
+        self.assertEqual(entry["collection"], "/user/calendar")
+        self.assertEqual(entry["items_scanned"], 10)
+        self.assertEqual(entry["items_matched"], 2)
+        self.assertEqual(entry["phases"]["scan"], {"wall": 0.5, "cpu": 0.25})
+        self.assertTrue(entry["wall"] >= 0)
+
+    def test_buffered_handler(self):
+        filename = os.path.join(self.tmpdir, "access.log")
+        handler = accesslog.BufferedHandler(filename)
+        handler.setFormatter(accesslog.JSONFormatter())
+        logger = logging.getLogger("calypso.test.access")
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            for i in range(3):
+                logger.warning("access", extra={"entry": {"n": i}})
+            handler.flush()
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        entries = [json.loads(line) for line in open(filename)]
+        self.assertEqual([entry["n"] for entry in entries], [0, 1, 2])
+        self.assertTrue(all("time" in entry for entry in entries))
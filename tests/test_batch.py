@@ -0,0 +1,115 @@
+# vim: set fileencoding=utf-8 :
+"""Test batches of changes posted to a collection"""
+
+import os
+import subprocess
+import xml.etree.ElementTree as ET
+
+from .testutils import EVENT, ServerTestCase
+
+DAV = "{DAV:}"
+
+
+def put(href, text, if_match=None):
+    condition = "<Y:if-match>%s</Y:if-match>" % if_match if if_match else ""
+    return "<Y:put><D:href>%s</D:href>%s<Y:data>%s</Y:data></Y:put>" % (href, condition, text)
+
+
+def delete(href, if_match=None):
+    condition = "<Y:if-match>%s</Y:if-match>" % if_match if if_match else ""
+    return "<Y:delete><D:href>%s</D:href>%s</Y:delete>" % (href, condition)
+
+
+class TestBatch(ServerTestCase):
+
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        os.makedirs(os.path.join(self.tmpdir, "alice", "cal"))
+        self.start_server()
+        self.etag = self.request("PUT", "/alice/cal/old.ics",
+                                 EVENT % ("old", "Old")).getheader("ETag")
+
+    def batch(self, *operations):
+        body = ('<Y:batch xmlns:D="DAV:" xmlns:Y="http://keithp.com/calypso/ns/">%s'
+                '</Y:batch>' % "".join(operations))
+        response = self.request("POST", "/alice/cal/", body)
+        self.assertEqual(response.status, 207)
+        result = []
+        for element in ET.fromstring(response.body).findall(DAV + "response"):
+            status = element.findtext(DAV + "status") or \
+                element.findtext("%spropstat/%sstatus" % (DAV, DAV))
+            etag = element.findtext("%spropstat/%sprop/%sgetetag" % (DAV, DAV, DAV))
+            result.append((element.findtext(DAV + "href"), int(status.split()[1]), etag))
+        return result
+
+    def commits(self):
+        return subprocess.check_output(["git", "log", "--format=%s"], cwd=self.tmpdir).splitlines()
+
+    def test_batch(self):
+        commits = len(self.commits())
+        result = self.batch(put("/alice/cal/a.ics", EVENT % ("a", "A")),
+                            put("/alice/cal/old.ics", EVENT % ("old", "Changed"), self.etag),
+                            put("/alice/cal/b.ics", EVENT % ("b", "B")))
+        self.assertEqual([(href, status) for href, status, etag in result],
+                         [("/alice/cal/a.ics", 201), ("/alice/cal/old.ics", 204),
+                          ("/alice/cal/b.ics", 201)])
+        for href, status, etag in result:
+            response = self.request("GET", href)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.getheader("ETag"), etag)
+        self.assertTrue("SUMMARY:Changed" in self.request("GET", "/alice/cal/old.ics").body)
+
+        result = self.batch(delete("/alice/cal/a.ics"), delete("/alice/cal/b.ics"))
+        self.assertEqual([status for href, status, etag in result], [204, 204])
+        self.assertEqual(self.request("GET", "/alice/cal/a.ics").status, 410)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir, "alice", "cal"))), 1)
+        self.assertEqual(len(self.commits()), commits + 2)
+
+    def test_all_or_nothing(self):
+        commits = len(self.commits())
+        result = self.batch(put("/alice/cal/a.ics", EVENT % ("a", "A")),
+                            delete("/alice/cal/old.ics", '"nope"'),
+                            delete("/alice/cal/missing.ics"),
+                            put("/alice/other/b.ics", EVENT % ("b", "B")),
+                            put("/alice/cal/c.ics", "garbage"))
+        self.assertEqual([status for href, status, etag in result], [424, 412, 404, 403, 400])
+        self.assertEqual(self.request("GET", "/alice/cal/a.ics").status, 410)
+        self.assertEqual(self.request("GET", "/alice/cal/old.ics").status, 200)
+        self.assertEqual(len(self.commits()), commits)
+
+    def duplicate(self):
+        """Store a second file for the item old.ics."""
+        directory = os.path.join(self.tmpdir, "alice", "cal")
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name)) as f:
+                text = f.read()
+            if "UID:old@" in text:
+                break
+        with open(os.path.join(directory, "duplicate.ics"), "w") as f:
+            f.write(text)
+        return directory
+
+    def test_duplicates(self):
+        directory = self.duplicate()
+        result = self.batch(put("/alice/cal/old.ics", EVENT % ("old", "Changed")),
+                            put("/alice/cal/new.ics", EVENT % ("new", "New")))
+        # One answer for each change, whatever the files removed
+        self.assertEqual([(href, status) for href, status, etag in result],
+                         [("/alice/cal/old.ics", 204), ("/alice/cal/new.ics", 201)])
+        for href, status, etag in result:
+            self.assertEqual(self.request("GET", href).getheader("ETag"), etag)
+        self.assertEqual(len(os.listdir(directory)), 2)
+        self.assertEqual(self.commits()[0], "Batch of changes: Add 1, Modify 1, Remove 1")
+        self.assertTrue("SUMMARY:Changed" in self.request("GET", "/alice/cal/old.ics").body)
+
+        self.duplicate()
+        result = self.batch(delete("/alice/cal/old.ics"), delete("/alice/cal/new.ics"))
+        self.assertEqual([(href, status) for href, status, etag in result],
+                         [("/alice/cal/old.ics", 204), ("/alice/cal/new.ics", 204)])
+        self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(self.commits()[0], "Batch of changes: Remove 3")
+        self.assertEqual(self.request("GET", "/alice/cal/old.ics").status, 410)
+
+    def test_not_a_batch(self):
+        self.assertEqual(self.request("POST", "/alice/cal/", "<foo/>").status, 400)
+        self.assertEqual(self.request("POST", "/alice/cal/old.ics", "").status, 405)
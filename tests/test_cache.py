@@ -0,0 +1,74 @@
+# vim: set fileencoding=utf-8 :
+"""Test the bounded collection cache"""
+
+import os
+
+from calypso.cache import CollectionCache
+from calypso import webdav
+
+from .testutils import EVENT, CalypsoTestCase
+
+
+class FakeCollection(object):
+    def __init__(self, path):
+        self.path = path
+        self.estimated_size = 1000
+
+
+class TestCollectionCache(CalypsoTestCase):
+
+    def test_lru_eviction(self):
+        cache = CollectionCache(max_collections=2, max_memory=0, idle_timeout=0,
+                                loader=FakeCollection)
+        a = cache.get("/a")
+        cache.get("/b")
+        self.assertTrue(cache.get("/a") is a)
+        cache.get("/c")
+        self.assertTrue("/a" in cache)
+        self.assertFalse("/b" in cache)
+        self.assertEqual(len(cache), 2)
+
+        cache.get("/b")
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 4)
+        self.assertEqual(stats["evictions"], 2)
+        self.assertEqual(stats["reloads"], 1)
+
+    def test_memory_budget(self):
+        cache = CollectionCache(max_collections=0, max_memory=2500, idle_timeout=0,
+                                loader=FakeCollection)
+        for path in ("/a", "/b", "/c", "/d"):
+            cache.get(path)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.memory, 2000)
+
+        # the collection being returned is never evicted
+        big = CollectionCache(max_collections=0, max_memory=10, idle_timeout=0,
+                              loader=FakeCollection)
+        self.assertTrue(big.get("/a") is big.peek("/a"))
+
+    def test_idle_timeout(self):
+        cache = CollectionCache(max_collections=0, max_memory=0, idle_timeout=60,
+                                loader=FakeCollection)
+        cache.get("/a")
+        cache.get("/b")
+        cache.entries["/a"] = (cache.peek("/a"), 0)
+        cache.expire()
+        self.assertFalse("/a" in cache)
+        self.assertTrue("/b" in cache)
+
+    def test_memory_estimate(self):
+        path = os.path.join(self.tmpdir, "alice", "cal")
+        os.makedirs(path)
+        for name in ("a", "b"):
+            with open(os.path.join(path, name + ".ics"), "w") as f:
+                f.write(EVENT % (name, "Test"))
+        cache = CollectionCache(max_collections=0, max_memory=0, idle_timeout=0)
+        collection = cache.get("/alice/cal")
+        first, second = collection.items
+        # Stored items only hold their text until they are parsed
+        self.assertEqual(cache.memory, first.size + second.size)
+        first.object
+        self.assertEqual(cache.memory,
+                         first.size * webdav.PARSED_SIZE_FACTOR + second.size)
@@ -1,11 +1,13 @@
 # vim: set fileencoding=utf-8 :
 
+import os
 import subprocess
 import tempfile
 import shutil
 import unittest
 
-from calypso.webdav import Collection
+import calypso.config
+from calypso.webdav import Collection, split_components
 from calypso import paths
 
 from .testutils import CalypsoTestCase
@@ -47,3 +49,103 @@ class TestCollection(CalypsoTestCase):
         self.assertEquals(r, veventuid)
         self.assertEquals("/", c)
 
+    def test_parallel_load(self):
+        collection = Collection("")
+        self.assertTrue(collection.import_file(self.test_vcard))
+        expected = sorted((item.name, item.etag, item.text) for item in collection.items)
+
+        calypso.config.set('storage', 'parse_workers', '2')
+        calypso.config.set('storage', 'parse_batch', '1')
+        try:
+            reloaded = Collection("")
+            self.assertTrue(all(item._object is None for item in reloaded.items))
+            self.assertEqual(sorted((item.name, item.etag, item.text) for item in reloaded.items),
+                             expected)
+        finally:
+            calypso.config.set('storage', 'parse_workers', '0')
+            calypso.config.set('storage', 'parse_batch', '200')
+
+    def test_split_components(self):
+        lines = ["BEGIN:VCALENDAR\r\n", "VERSION:2.0\r\n",
+                 "BEGIN:VTIMEZONE\r\n", "TZID:Europe/Oslo\r\n", "END:VTIMEZONE\r\n",
+                 "BEGIN:VEVENT\r\n", "UID:a\r\n",
+                 "BEGIN:VALARM\r\n", "ACTION:DISPLAY\r\n", "END:VALARM\r\n",
+                 "END:VEVENT\r\n",
+                 "BEGIN:VTODO\r\n", "UID:b\r\n", "END:VTODO\r\n",
+                 "END:VCALENDAR\r\n",
+                 "BEGIN:VCARD\r\n", "FN:c\r\n", "END:VCARD\r\n"]
+        texts = list(split_components(lines))
+        self.assertEqual(len(texts), 3)
+        self.assertEqual(texts[0].splitlines(), [
+            "BEGIN:VCALENDAR", "VERSION:2.0",
+            "BEGIN:VTIMEZONE", "TZID:Europe/Oslo", "END:VTIMEZONE",
+            "BEGIN:VEVENT", "UID:a", "BEGIN:VALARM", "ACTION:DISPLAY", "END:VALARM",
+            "END:VEVENT", "END:VCALENDAR"])
+        self.assertTrue("UID:b" in texts[1] and "TZID:Europe/Oslo" in texts[1])
+        self.assertEqual(texts[2], "BEGIN:VCARD\r\nFN:c\r\nEND:VCARD\r\n")
+
+    def test_import_single_commit(self):
+        def commits():
+            return int(subprocess.check_output(
+                ["git", "rev-list", "--count", "--all"], cwd=self.tmpdir) or 0)
+        collection = Collection("")
+        self.assertTrue(collection.import_file(self.test_vcard))
+        self.assertEqual(commits(), 1)
+        # Importing again updates the existing files
+        self.assertTrue(collection.import_file(self.test_vcard))
+        self.assertEqual(len(collection.items), 2)
+        self.assertEqual(commits(), 2)
+
+    def fail_second_write(self, collection):
+        write_text = collection.write_text
+        written = []
+
+        def fail(*args):
+            if written:
+                raise IOError("disk full")
+            written.append(write_text(*args))
+            return written[-1]
+        collection.write_text = fail
+
+    def status(self):
+        return subprocess.check_output(["git", "status", "--porcelain"], cwd=self.tmpdir)
+
+    def test_import_failure_commits(self):
+        collection = Collection("")
+        self.fail_second_write(collection)
+        self.assertFalse(collection.import_file(self.test_vcard))
+        # What was written is committed, and served
+        self.assertEqual(self.status(), "")
+        self.assertEqual(subprocess.check_output(["git", "log", "-1", "--format=%s"],
+                                                 cwd=self.tmpdir),
+                         "Partial import of 1 items from import.vcard\n")
+        self.assertEqual(len(collection.items), 1)
+
+    def test_import_failure_discards(self):
+        collection = Collection("")
+        self.fail_second_write(collection)
+
+        def fail(context):
+            raise IOError("git is gone")
+        collection.git_commit = fail
+        self.assertFalse(collection.import_file(self.test_vcard))
+        # Nothing left behind that was not committed
+        self.assertEqual(self.status(), "")
+        self.assertEqual(len(collection.items), 0)
+
+    def test_append_registers_item(self):
+        event = (u"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nBEGIN:VEVENT\r\n"
+                 u"UID:new@example.com\r\nDTSTART:20150101T100000Z\r\n"
+                 u"SUMMARY:New\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n")
+        calypso.config.set('storage', 'fsync', 'commit')
+        try:
+            collection = Collection("")
+            item = collection.append("new.ics", event, context={})
+        finally:
+            calypso.config.set('storage', 'fsync', 'none')
+        self.assertEqual(collection.unsynced, set())
+        self.assertEqual([i.name for i in collection.items], ["new.ics"])
+        # No temporary file is left, and the etag matches the stored file
+        self.assertEqual([name for name in os.listdir(self.tmpdir) if name != ".git"],
+                         [os.path.basename(item.path)])
+        self.assertEqual(Collection("").get_item("new.ics").etag, item.etag)
@@ -0,0 +1,61 @@
+# vim: set fileencoding=utf-8 :
+"""Test content coding negotiation and the compressed collection cache"""
+
+import gzip
+import StringIO
+import zlib
+
+from calypso.webdav import Collection
+from calypso import compression
+
+from .testutils import CalypsoTestCase
+
+
+class TestCompression(CalypsoTestCase):
+    test_vcard = "tests/data/import.vcard"
+
+    def test_negotiate(self):
+        self.assertEqual(compression.negotiate(None), None)
+        self.assertEqual(compression.negotiate("identity"), None)
+        self.assertEqual(compression.negotiate("gzip, deflate"), "gzip")
+        self.assertEqual(compression.negotiate("deflate"), "deflate")
+        self.assertEqual(compression.negotiate("gzip;q=0.5, deflate"), "deflate")
+        self.assertEqual(compression.negotiate("gzip;q=0, *"), "deflate")
+        self.assertEqual(compression.negotiate("x-gzip"), "gzip")
+
+    def test_roundtrip(self):
+        data = "BEGIN:VCALENDAR\r\n" * 100
+        for coding in compression.SUPPORTED:
+            packed = compression.compress(data, coding)
+            self.assertTrue(len(packed) < len(data))
+            self.assertEqual(compression.decompress(packed, coding), data)
+
+        # gzip output must be readable by the gzip module
+        packed = compression.compress(data, "gzip")
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(packed)).read(), data)
+
+        # raw deflate streams are accepted too
+        obj = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = obj.compress(data) + obj.flush()
+        self.assertEqual(compression.decompress(raw, "deflate"), data)
+
+    def test_decompress_errors(self):
+        self.assertRaises(ValueError, compression.decompress, "data", "br")
+        self.assertRaises(ValueError, compression.decompress, "not gzip", "gzip")
+        self.assertEqual(compression.decompress("data", "identity"), "data")
+
+    def test_compressed_text(self):
+        collection = Collection("")
+        self.assertTrue(collection.import_file(self.test_vcard))
+        packed = collection.compressed_text("gzip", "utf-8")
+        self.assertEqual(compression.decompress(packed, "gzip"),
+                         collection.text.encode("utf-8"))
+        self.assertTrue(collection.compressed_text("gzip", "utf-8") is packed)
+        # Each encoding is cached on its own
+        latin = compression.decompress(collection.compressed_text("gzip", "latin-1"), "gzip")
+        self.assertEqual(latin, collection.text.encode("latin-1", "xmlcharrefreplace"))
+        self.assertNotEqual(latin, compression.decompress(packed, "gzip"))
+
+        collection.remove(collection.items[0].name, {})
+        unpacked = compression.decompress(collection.compressed_text("gzip", "utf-8"), "gzip")
+        self.assertEqual(unpacked, collection.text.encode("utf-8"))
@@ -0,0 +1,86 @@
+# vim: set fileencoding=utf-8 :
+"""Test the event loop server engine"""
+
+import os
+import socket
+import subprocess
+import unittest
+
+import calypso
+from calypso import engine
+
+from .testutils import EVENT, ServerTestCase
+
+
+def ipv6_available():
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.bind(("::1", 0))
+        sock.close()
+        return True
+    except (AttributeError, socket.error):
+        return False
+
+
+class TestEngine(ServerTestCase):
+    address = ("127.0.0.1", 0)
+
+    def setUp(self):
+        super(TestEngine, self).setUp()
+        path = os.path.join(self.tmpdir, "alice", "cal")
+        os.makedirs(path)
+        subprocess.call(["git", "init", "-q", path])
+        with open(os.path.join(path, "event.ics"), "w") as f:
+            f.write(EVENT % ("event", "Test"))
+
+    def create_server(self):
+        return engine.EventLoopServer(self.address, calypso.CollectionHTTPHandler, workers=2)
+
+    def receive(self, sock, count):
+        """Read ``count`` responses from ``sock``."""
+        data = ""
+        while data.count("HTTP/1.1 ") < count or not data.endswith("END:VCALENDAR\r\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_request_length(self):
+        self.assertEqual(engine.request_length("GET / HTTP/1.1\r\n"), None)
+        self.assertEqual(engine.request_length("GET / HTTP/1.1\r\n\r\nGET"), 18)
+        request = "PUT / HTTP/1.1\r\nContent-Length: 4\r\n\r\n"
+        self.assertEqual(engine.request_length(request + "ab"), None)
+        self.assertEqual(engine.request_length(request + "abcd"), len(request) + 4)
+        self.assertRaises(ValueError, engine.request_length, "x" * (engine.MAX_HEADER_SIZE + 1))
+
+    def test_keepalive(self):
+        self.start_server()
+        sock = socket.create_connection(self.server.server_address[:2])
+        sock.settimeout(10)
+        try:
+            request = "GET /alice/cal/ HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n"
+            sock.sendall(request)
+            response = self.receive(sock, 1)
+            self.assertTrue(response.startswith("HTTP/1.1 200"))
+            self.assertTrue("UID:event@example.com" in response)
+            # Pipelined requests on the same connection
+            sock.sendall(request * 2)
+            response = self.receive(sock, 2)
+            self.assertEqual(response.count("HTTP/1.1 200"), 2)
+            self.assertEqual(len(self.server.connections), 1)
+        finally:
+            sock.close()
+
+    @unittest.skipUnless(ipv6_available(), "IPv6 is not available")
+    def test_ipv6(self):
+        self.address = ("::1", 0)
+        self.start_server()
+        sock = socket.create_connection(self.server.server_address[:2])
+        sock.settimeout(10)
+        try:
+            sock.sendall("GET /alice/cal/ HTTP/1.1\r\nHost: localhost\r\n"
+                         "Connection: close\r\n\r\n")
+            self.assertTrue(self.receive(sock, 1).startswith("HTTP/1.1 200"))
+        finally:
+            sock.close()
@@ -0,0 +1,40 @@
+# vim: set fileencoding=utf-8 :
+"""Test collection export"""
+
+import os
+import StringIO
+
+import vobject
+
+from calypso.webdav import Collection
+from calypso import export
+
+from .testutils import CalypsoTestCase
+
+
+class TestExport(CalypsoTestCase):
+    test_vcard = "tests/data/import.vcard"
+    test_vcal = "tests/data/import.vcalendar"
+
+    def test_export_calendar(self):
+        collection = Collection("")
+        self.assertTrue(collection.import_file(self.test_vcal))
+        self.assertTrue(collection.import_file("tests/data/from-tripsync.ics"))
+        out = StringIO.StringIO()
+        self.assertEqual(export.write_collection("", out), 2)
+        calendars = list(vobject.readComponents(out.getvalue()))
+        self.assertEqual(sorted(calendar.x_calypso_name.value for calendar in calendars),
+                         sorted(item.name for item in collection.items))
+        # Exporting again gives the same result
+        again = StringIO.StringIO()
+        export.write_collection("", again)
+        self.assertEqual(out.getvalue(), again.getvalue())
+
+    def test_export_addressbook(self):
+        collection = Collection("")
+        self.assertTrue(collection.import_file(self.test_vcard))
+        destination = os.path.join(self.tmpdir, "backup")
+        self.assertTrue(export.export(["/"], destination, jobs=2))
+        with open(os.path.join(destination, "root.vcf")) as f:
+            cards = list(vobject.readComponents(f.read()))
+        self.assertEqual(len(cards), 2)
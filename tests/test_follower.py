@@ -0,0 +1,94 @@
+# vim: set fileencoding=utf-8 :
+"""Test read-only followers of a primary server"""
+
+import os
+import subprocess
+
+import calypso
+import calypso.config
+from calypso import follower
+
+from .testutils import EVENT, ServerTestCase
+
+
+class TestFollower(ServerTestCase):
+
+    def setUp(self):
+        super(TestFollower, self).setUp()
+        self.primary = os.path.join(self.tmpdir, "primary")
+        os.makedirs(os.path.join(self.primary, "alice", "cal"))
+        self.git(self.primary, "init", "-q")
+        self.write("event.ics", EVENT % ("event", "Event"))
+        self.write("other.ics", EVENT % ("other", "Other"))
+        self.commit()
+        self.storage = os.path.join(self.tmpdir, "follower")
+        subprocess.check_call(["git", "clone", "-q", self.primary, self.storage])
+        calypso.config.set("storage", "folder", self.storage)
+        calypso.config.set("server", "follower", "True")
+        calypso.CollectionHTTPHandler.collections.clear()
+        self.collections = calypso.CollectionHTTPHandler.collections
+
+    def tearDown(self):
+        calypso.config.set("server", "follower", "False")
+        calypso.config.set("follower", "primary", "")
+        calypso.CollectionHTTPHandler.collections.clear()
+        super(TestFollower, self).tearDown()
+
+    def git(self, repository, *args):
+        subprocess.check_call(("git", "-c", "user.name=primary",
+                               "-c", "user.email=primary@example.com") + args, cwd=repository)
+
+    def write(self, name, text):
+        with open(os.path.join(self.primary, "alice", "cal", name), "w") as f:
+            f.write(text)
+
+    def commit(self):
+        self.git(self.primary, "add", "-A")
+        self.git(self.primary, "commit", "-q", "-m", "change")
+
+    def summaries(self, collection):
+        return sorted(item.object.vevent.summary.value for item in collection.items)
+
+    def test_refresh(self):
+        collection = self.collections.get("/alice/cal")
+        self.assertEqual(self.summaries(collection), ["Event", "Other"])
+        self.assertEqual(follower.sync(self.storage), [])
+
+        self.write("event.ics", EVENT % ("event", "Changed"))
+        self.write("new.ics", EVENT % ("new", "New"))
+        os.unlink(os.path.join(self.primary, "alice", "cal", "other.ics"))
+        self.commit()
+        changed = follower.sync(self.storage)
+        self.assertEqual(sorted(os.path.basename(path) for path in changed),
+                         ["event.ics", "new.ics", "other.ics"])
+
+        scans = []
+        scan_directory = collection.scan_directory
+        collection.scan_directory = lambda *args: scans.append(args) or scan_directory(*args)
+        ctag = collection.ctag
+        self.assertEqual(follower.refresh(self.collections, changed), set(["/alice/cal"]))
+        self.assertEqual(self.summaries(collection), ["Changed", "New"])
+        self.assertNotEqual(collection.ctag, ctag)
+        # Only the changed files were read
+        self.assertEqual(scans, [])
+
+    def test_subcollections(self):
+        root = self.collections.get("/alice")
+        os.makedirs(os.path.join(self.primary, "alice", "work"))
+        with open(os.path.join(self.primary, "alice", "work", "event.ics"), "w") as f:
+            f.write(EVENT % ("work", "Work"))
+        self.commit()
+        self.assertEqual(follower.refresh(self.collections, follower.sync(self.storage)),
+                         set(["/alice"]))
+        self.assertTrue(os.path.join(self.storage, "alice", "work") in root.dirty)
+
+    def test_writes(self):
+        self.start_server()
+        self.request("GET", "/alice/cal/", expected=200)
+        self.request("PUT", "/alice/cal/new.ics", EVENT % ("new", "New"), expected=403)
+        calypso.config.set("follower", "primary", "http://primary:5233/")
+        response = self.request("DELETE", "/alice/cal/event.ics", expected=307)
+        self.assertEqual(response.getheader("Location"),
+                         "http://primary:5233/alice/cal/event.ics")
+        self.assertEqual(sorted(os.listdir(os.path.join(self.storage, "alice", "cal"))),
+                         ["event.ics", "other.ics"])
@@ -0,0 +1,48 @@
+# vim: set fileencoding=utf-8 :
+"""Test persistent connections"""
+
+import os
+import subprocess
+
+import calypso.config
+
+from .testutils import EVENT, ServerTestCase
+
+
+class TestKeepAlive(ServerTestCase):
+
+    def setUp(self):
+        super(TestKeepAlive, self).setUp()
+        path = os.path.join(self.tmpdir, "alice", "cal")
+        os.makedirs(path)
+        subprocess.call(["git", "init", "-q", path])
+        with open(os.path.join(path, "event.ics"), "w") as f:
+            f.write(EVENT % ("event", "Test"))
+        self.start_server()
+
+    def tearDown(self):
+        calypso.config.set("server", "keepalive_requests", "100")
+        super(TestKeepAlive, self).tearDown()
+
+    def get(self, headers={}):
+        self.connection.request("GET", "/alice/cal/", headers=headers)
+        response = self.connection.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertTrue("UID:event@example.com" in response.read())
+        return response
+
+    def test_default_persistence(self):
+        response = self.get()
+        self.assertEqual(response.getheader("Connection"), "Keep-Alive")
+        sock = self.connection.sock
+        response = self.get()
+        self.assertTrue(self.connection.sock is sock)
+
+    def test_close(self):
+        response = self.get({"Connection": "close"})
+        self.assertEqual(response.getheader("Connection"), "Close")
+
+    def test_max_requests(self):
+        calypso.config.set("server", "keepalive_requests", "2")
+        self.assertEqual(self.get().getheader("Connection"), "Keep-Alive")
+        self.assertEqual(self.get().getheader("Connection"), "Close")
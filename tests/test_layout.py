@@ -0,0 +1,59 @@
+# vim: set fileencoding=utf-8 :
+"""Test the sharded collection layout"""
+
+import os
+import subprocess
+
+from calypso import export, layout
+from calypso.webdav import Collection
+
+from .testutils import CalypsoTestCase
+
+
+class TestLayout(CalypsoTestCase):
+    test_vcard = "tests/data/import.vcard"
+
+    def sharded(self):
+        collection = Collection("")
+        self.assertTrue(collection.import_file(self.test_vcard))
+        self.assertEqual(collection.set_layout(layout.SHARDED), 2)
+        return collection
+
+    def test_migrate(self):
+        collection = self.sharded()
+        self.assertTrue(collection.sharded)
+        self.assertEqual(len(collection.items), 2)
+        for item in collection.items:
+            self.assertEqual(os.path.dirname(item.path),
+                             os.path.join(self.tmpdir, layout.shard_name(item.name)))
+        # Moves are committed, nothing is left behind
+        status = subprocess.check_output(["git", "status", "--porcelain"], cwd=self.tmpdir)
+        self.assertEqual(status, "")
+
+        reloaded = Collection("")
+        self.assertEqual(sorted(item.name for item in reloaded.items),
+                         sorted(item.name for item in collection.items))
+        self.assertEqual(len(export.item_files("")), 2)
+
+        self.assertEqual(reloaded.set_layout(layout.FLAT), 2)
+        self.assertEqual(layout.shards(self.tmpdir), [])
+        self.assertEqual(len(Collection("").items), 2)
+
+    def test_write_in_shard(self):
+        collection = self.sharded()
+        item = collection.items[0]
+        text = item.text.replace(u"END:VCARD", u"NOTE:Changed\nEND:VCARD")
+        listed = []
+        scan_directory = collection.scan_directory
+
+        def spy(directory, filenames):
+            listed.append(directory)
+            return scan_directory(directory, filenames)
+        collection.scan_directory = spy
+        collection.replace(item.name, text, context={})
+        # The item is registered as written, nothing is listed
+        self.assertEqual(listed, [])
+        self.assertTrue(u"NOTE:Changed" in collection.get_item(item.name).text)
+
+        collection.remove(item.name, context={})
+        self.assertEqual(len(collection.items), 1)
@@ -0,0 +1,125 @@
+# vim: set fileencoding=utf-8 :
+"""Test waiting for the changes of a collection"""
+
+import httplib
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+import calypso
+from calypso import engine
+
+from .testutils import EVENT, ServerTestCase
+
+
+class LongPollTestCase(ServerTestCase):
+
+    url = "/alice/cal/"
+
+    def setUp(self):
+        super(LongPollTestCase, self).setUp()
+        self.path = os.path.join(self.tmpdir, "alice", "cal")
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, "event.ics"), "w") as f:
+            f.write(EVENT % ("event", "Test"))
+        self.start_server()
+
+    def changes(self, since, timeout=None):
+        """Status, ctag and duration of a wait for the changes since ``since``."""
+        connection = httplib.HTTPConnection(*self.server.server_address, timeout=10)
+        path = "%s?since=%s" % (self.url, since)
+        if timeout is not None:
+            path += "&timeout=%s" % timeout
+        start = time.time()
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            return response.status, response.read(), time.time() - start
+        finally:
+            connection.close()
+
+    def later(self, delay, function):
+        timer = threading.Timer(delay, function)
+        timer.start()
+        self.addCleanup(timer.join)
+
+
+class TestBlocking(LongPollTestCase):
+
+    def test_changed(self):
+        status, ctag, elapsed = self.changes("unknown")
+        self.assertEqual(status, 200)
+        self.assertTrue(ctag)
+        self.assertEqual(self.changes(ctag, 0.3)[0], 304)
+
+    def test_wait(self):
+        status, ctag, elapsed = self.changes("unknown")
+
+        def add():
+            with open(os.path.join(self.path, "new.ics"), "w") as f:
+                f.write(EVENT % ("new", "Test"))
+        self.later(0.3, add)
+        status, new_ctag, elapsed = self.changes(ctag, 5)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_ctag, ctag)
+        self.assertTrue(elapsed < 4)
+
+
+class TestEventLoop(LongPollTestCase):
+
+    def create_server(self):
+        # A single worker: waiting requests must not keep it
+        return engine.EventLoopServer(("127.0.0.1", 0), calypso.CollectionHTTPHandler,
+                                      workers=1)
+
+    def put(self, name):
+        self.request("PUT", "/alice/cal/%s" % name, EVENT % (name, "Test"), expected=201)
+
+    def test_wait(self):
+        status, ctag, elapsed = self.changes("unknown")
+        self.assertEqual(status, 200)
+        results = []
+        waiters = [threading.Thread(target=lambda: results.append(self.changes(ctag, 10)))
+                   for i in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        time.sleep(0.3)
+        self.assertEqual(sum(len(waiting) for waiting in self.server.parked.values()), 3)
+        self.put("new.ics")
+        for waiter in waiters:
+            waiter.join()
+        self.assertEqual(len(results), 3)
+        for status, new_ctag, elapsed in results:
+            self.assertEqual(status, 200)
+            self.assertNotEqual(new_ctag, ctag)
+            self.assertTrue(elapsed < 5)
+
+    def test_timeout(self):
+        status, ctag, elapsed = self.changes("unknown")
+        status, new_ctag, elapsed = self.changes(ctag, 1)
+        self.assertEqual(status, 304)
+        self.assertTrue(0.9 < elapsed < 5)
+        self.assertEqual(self.server.parked, {})
+
+
+class CollectionRepository(object):
+    """Only the collection is a git repository, and its URL has no trailing slash."""
+
+    url = "/alice/cal"
+
+    def setUp(self):
+        super(CollectionRepository, self).setUp()
+        shutil.rmtree(os.path.join(self.tmpdir, ".git"))
+        for args in (["init", "-q"], ["config", "user.email", "calypso@example.com"],
+                     ["config", "user.name", "cal Ypso"]):
+            subprocess.check_call(["git"] + args, cwd=self.path)
+
+
+class TestBlockingCollectionRepository(CollectionRepository, TestBlocking):
+    pass
+
+
+class TestEventLoopCollectionRepository(CollectionRepository, TestEventLoop):
+    pass
@@ -0,0 +1,70 @@
+# vim: set fileencoding=utf-8 :
+"""Test the background maintenance of the git repositories"""
+
+import os
+import subprocess
+
+import calypso.config
+from calypso import maintenance, webdav
+
+from .testutils import EVENT, CalypsoTestCase
+
+
+class TestMaintenance(CalypsoTestCase):
+
+    def setUp(self):
+        super(TestMaintenance, self).setUp()
+        calypso.config.set("maintenance", "enabled", "True")
+        os.makedirs(os.path.join(self.tmpdir, "alice", "cal"))
+        self.collection = webdav.Collection("/alice/cal")
+        for i in range(3):
+            self.collection.append("event%d.ics" % i, EVENT % (i, "Test"), context={})
+        self.repository = maintenance.repository(self.tmpdir)
+
+    def tearDown(self):
+        calypso.config.set("maintenance", "enabled", "False")
+        calypso.config.set("maintenance", "loose_objects", "6700")
+        calypso.config.set("maintenance", "packs", "50")
+        maintenance._repositories.clear()
+        super(TestMaintenance, self).tearDown()
+
+    def count_objects(self):
+        output = subprocess.check_output(["git", "count-objects", "-v"], cwd=self.tmpdir)
+        return dict((key, int(value)) for key, value in
+                    (line.split(": ") for line in output.splitlines() if ": " in line))
+
+    def test_committed(self):
+        self.assertEqual(self.repository.path, self.tmpdir)
+        self.assertEqual(self.repository.commits, 3)
+        # Nothing is needed yet
+        self.assertEqual(maintenance.maintain(self.repository), [])
+
+    def test_repack(self):
+        calypso.config.set("maintenance", "loose_objects", "0")
+        self.assertEqual(maintenance.maintain(self.repository),
+                         ["repack", "commit-graph", "index"])
+        objects = self.count_objects()
+        self.assertEqual(objects["count"], 0)
+        self.assertEqual(objects["packs"], 1)
+        # Only gc forgets about the commits
+        self.assertEqual(self.repository.commits, 3)
+
+    def test_gc(self):
+        calypso.config.set("maintenance", "loose_objects", "0")
+        maintenance.maintain(self.repository)
+        self.collection.append("event.ics", EVENT % ("event", "Test"), context={})
+        maintenance.maintain(self.repository)
+        self.assertEqual(self.count_objects()["packs"], 2)
+        calypso.config.set("maintenance", "packs", "1")
+        self.assertEqual(maintenance.maintain(self.repository), ["gc", "index"])
+        self.assertEqual(self.count_objects()["packs"], 1)
+        self.assertEqual(self.repository.commits, 0)
+
+    def test_busy(self):
+        calypso.config.set("maintenance", "loose_objects", "0")
+        skipped = maintenance.TASKS_RUN.value(task="index", result="skipped")
+        with maintenance.lock(self.collection.path):
+            # Packing does not wait for requests, refreshing the index does
+            self.assertEqual(len(maintenance.maintain(self.repository)), 3)
+        self.assertEqual(maintenance.TASKS_RUN.value(task="index", result="skipped"), skipped + 1)
+        self.assertEqual(self.count_objects()["count"], 0)
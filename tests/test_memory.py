@@ -0,0 +1,75 @@
+# vim: set fileencoding=utf-8 :
+"""Test memory accounting"""
+
+import base64
+import os
+import subprocess
+
+import calypso.config
+from calypso.cache import CollectionCache
+from calypso import memory
+
+from .testutils import EVENT, ServerTestCase
+
+
+class TestMemory(ServerTestCase):
+
+    def setUp(self):
+        super(TestMemory, self).setUp()
+        path = os.path.join(self.tmpdir, "alice", "cal")
+        os.makedirs(path)
+        subprocess.call(["git", "init", "-q", path])
+        with open(os.path.join(path, "event.ics"), "w") as f:
+            f.write(EVENT % ("event", "Test"))
+
+    def tearDown(self):
+        calypso.config.set("memory", "path", "")
+        calypso.config.set("memory", "admins", "")
+        super(TestMemory, self).tearDown()
+
+    def test_report(self):
+        collections = CollectionCache(max_collections=0, max_memory=0, idle_timeout=0)
+        collections.get("/alice/cal")
+        result = memory.report(collections)
+        self.assertEqual(result["items"], 1)
+        entry = result["collections"][0]
+        self.assertEqual(entry["path"], "/alice/cal")
+        self.assertEqual(entry["items"], 1)
+        self.assertTrue(entry["estimated_bytes"] >= entry["text_bytes"] > 0)
+        self.assertFalse("tracemalloc" in result)
+
+    def test_subcollections(self):
+        os.makedirs(os.path.join(self.tmpdir, "bob", "cal"))
+        subprocess.call(["git", "init", "-q", os.path.join(self.tmpdir, "bob")])
+        collections = CollectionCache(max_collections=0, max_memory=0, idle_timeout=0)
+        collections.get("/bob")
+        entry = memory.report(collections)["collections"][0]
+        self.assertEqual(entry["path"], "/bob")
+        self.assertEqual(entry["items"], 0)
+        self.assertTrue(memory.render(collections))
+
+    def test_group(self):
+        import vobject
+        import xml.etree.ElementTree
+        self.assertEqual(memory.group(vobject.__file__), "vobject")
+        self.assertEqual(memory.group(xml.etree.ElementTree.__file__), "xml.etree")
+        self.assertEqual(memory.group(memory.__file__), "calypso")
+
+    def test_admins(self):
+        calypso.config.set("memory", "path", "/.memory")
+        self.start_server()
+        self.server.acl = type("ACL", (object,), {
+            "has_right": staticmethod(lambda owner, user, password: password == "secret")})
+
+        def status(user=None):
+            headers = {}
+            if user:
+                headers["Authorization"] = "Basic " + base64.b64encode(user + ":secret")
+            return self.request("GET", "/.memory", headers=headers).status
+        # Nobody reads the report until admins are configured
+        self.assertEqual(status(), 401)
+        self.assertEqual(status("alice"), 401)
+        calypso.config.set("memory", "admins", "alice")
+        self.assertEqual(status(), 401)
+        self.assertEqual(status("bob"), 401)
+        self.assertEqual(status("alice"), 200)
@@ -0,0 +1,62 @@
+# vim: set fileencoding=utf-8 :
+"""Test metrics collection and rendering"""
+
+import threading
+import time
+import unittest
+
+from calypso import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        counter = metrics.Counter("test_counter_total", "A counter.", ("method",))
+        counter.inc(method="GET")
+        counter.inc(2, method="GET")
+        counter.inc(method="PUT")
+        self.assertEqual(counter.value(method="GET"), 3)
+        text = metrics.render()
+        self.assertTrue("# TYPE test_counter_total counter" in text)
+        self.assertTrue('test_counter_total{method="GET"} 3' in text)
+        self.assertTrue('test_counter_total{method="PUT"} 1' in text)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "A histogram.", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = histogram.samples()
+        self.assertEqual(lines, [
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3'])
+
+    def test_phases(self):
+        before = metrics.PHASE_SECONDS.count(phase="test")
+        record = metrics.begin_request()
+        with metrics.phase("test"):
+            pass
+        metrics.record_phase("test", 1.5)
+        self.assertTrue(metrics.end_request() is record)
+        self.assertTrue(record.phases["test"][0] >= 1.5)
+        self.assertEqual(metrics.PHASE_SECONDS.count(phase="test"), before + 2)
+        self.assertTrue(metrics.current() is None)
+
+    @unittest.skipUnless(metrics.thread_cpu, "no CPU clock for threads")
+    def test_thread_cpu(self):
+        def spin():
+            end = time.time() + 0.3
+            while time.time() < end:
+                pass
+        thread = threading.Thread(target=spin)
+        record = metrics.begin_request()
+        with metrics.phase("test"):
+            thread.start()
+            thread.join()
+        metrics.end_request()
+        # The work of other threads is not the request's
+        self.assertTrue(record.phases["test"][1] < 0.1)
+        self.assertTrue(record.cpu < 0.1)
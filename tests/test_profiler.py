@@ -0,0 +1,53 @@
+# vim: set fileencoding=utf-8 :
+"""Test the slow request profiler"""
+
+import os
+
+import calypso.config
+from calypso import profiler
+
+from .testutils import CalypsoTestCase
+
+
+class TestProfiler(CalypsoTestCase):
+
+    def setUp(self):
+        super(TestProfiler, self).setUp()
+        self.spool = os.path.join(self.tmpdir, "profiles")
+        calypso.config.set('profiler', 'spool', self.spool)
+        calypso.config.set('profiler', 'sample_rate', '1.0')
+        profiler.enabled = True
+
+    def tearDown(self):
+        profiler.enabled = False
+        calypso.config.set('profiler', 'sample_rate', '0.1')
+        calypso.config.remove_option('profiler', 'threshold_report')
+        super(TestProfiler, self).tearDown()
+
+    def test_dump_slow_request(self):
+        profile = profiler.start()
+        self.assertTrue(profile is not None)
+        base = profiler.finish(profile, "REPORT", 5.0,
+                               lambda: ["request: REPORT /user/cal HTTP/1.1", "items: 3"])
+        self.assertTrue(os.path.exists(base + ".prof"))
+        description = open(base + ".txt").read()
+        self.assertTrue("REPORT /user/cal" in description)
+        self.assertTrue("items: 3" in description)
+
+    def test_fast_request_not_dumped(self):
+        calypso.config.set('profiler', 'threshold_report', '10')
+        self.assertEqual(profiler.finish(profiler.start(), "REPORT", 5.0, lambda: []), None)
+        self.assertFalse(os.path.exists(self.spool))
+
+    def test_disabled(self):
+        profiler.toggle()
+        self.assertEqual(profiler.start(), None)
+
+    def test_trim(self):
+        calypso.config.set('profiler', 'max_files', '2')
+        try:
+            for i in range(4):
+                profiler.finish(profiler.start(), "GET%d" % i, 5.0, lambda: [])
+        finally:
+            calypso.config.set('profiler', 'max_files', '50')
+        self.assertEqual(len([f for f in os.listdir(self.spool) if f.endswith(".prof")]), 2)
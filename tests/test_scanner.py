@@ -0,0 +1,47 @@
+# vim: set fileencoding=utf-8 :
+"""Test the iCalendar/vCard line scanner"""
+
+import codecs
+import unittest
+
+from calypso import scanner
+from calypso.webdav import Item
+
+
+class TestScanner(unittest.TestCase):
+
+    def test_scan_calendar(self):
+        text = ("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nX-CALYPSO-NAME:event.ics\r\n"
+                "BEGIN:VTIMEZONE\r\nTZID:Europe/Oslo\r\nBEGIN:STANDARD\r\n"
+                "DTSTART:19701025T030000\r\nEND:STANDARD\r\nEND:VTIMEZONE\r\n"
+                "BEGIN:VEVENT\r\nUID:some-very-long-uid-that-is\r\n  folded\r\n"
+                "DTSTART;TZID=\"Europe/Oslo\":20150101T100000\r\n"
+                "RRULE:FREQ=WEEKLY\r\nLAST-MODIFIED:20150102T030405Z\r\n"
+                "END:VEVENT\r\nEND:VCALENDAR\r\n")
+        scanned = scanner.scan(text)
+        self.assertEqual(scanned.tag, "VCALENDAR")
+        self.assertEqual(scanned.components, ("VTIMEZONE", "VEVENT"))
+        self.assertEqual((scanned.name, scanned.names), ("event.ics", 1))
+        self.assertEqual(scanned.uid, "some-very-long-uid-that-is folded")
+        self.assertEqual(scanned.dtstart, "20150101T100000")
+        self.assertEqual(scanned.tzid, "Europe/Oslo")
+        self.assertEqual(scanned.rrule, "FREQ=WEEKLY")
+        self.assertEqual(scanner.utc_timetuple(scanned.last_modified)[:6],
+                         (2015, 1, 2, 3, 4, 5))
+        self.assertTrue(scanner.is_vcal(scanned.tag, scanned.components))
+        self.assertFalse(scanner.is_vcard(scanned.tag, scanned.components))
+
+    def test_matches_vobject(self):
+        for filename in ("tests/data/import.vcard", "tests/data/import.vcalendar",
+                         "tests/data/from-tripsync.ics"):
+            text = codecs.open(filename, encoding="utf-8").read()
+            item = Item(text, None, None, "")
+            loaded = Item.load(item.text, "/path", "")
+            self.assertTrue(loaded._object is None)
+            self.assertEqual(loaded.name, item.name)
+            self.assertEqual(loaded.tag, item.tag)
+            self.assertEqual(loaded.is_vcard, item.is_vcard)
+            self.assertEqual(loaded.is_vcal, item.is_vcal)
+            self.assertEqual(loaded.file_extension, item.file_extension)
+            if item.scanned.last_modified:
+                self.assertEqual(loaded.last_modified, item.last_modified)
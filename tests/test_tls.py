@@ -0,0 +1,114 @@
+# vim: set fileencoding=utf-8 :
+"""Test the TLS server"""
+
+import os
+import socket
+import ssl
+import subprocess
+import time
+import unittest
+
+import calypso
+import calypso.config
+from calypso import tls
+
+from .testutils import ServerTestCase
+
+
+def openssl_available():
+    try:
+        return subprocess.call(["openssl", "version"], stdout=open(os.devnull, "w")) == 0
+    except OSError:
+        return False
+
+
+@unittest.skipUnless(openssl_available(), "openssl is needed to create a certificate")
+class TestTLS(ServerTestCase):
+
+    def setUp(self):
+        super(TestTLS, self).setUp()
+        path = os.path.join(self.tmpdir, "alice", "cal")
+        os.makedirs(path)
+        subprocess.call(["git", "init", "-q", path])
+        certificate = os.path.join(self.tmpdir, "server.crt")
+        key = os.path.join(self.tmpdir, "server.key")
+        subprocess.check_call(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", "/CN=localhost", "-keyout", key, "-out", certificate],
+            stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        calypso.config.set("server", "certificate", certificate)
+        calypso.config.set("server", "key", key)
+        calypso.config.set("server", "handshake_timeout", "2")
+        tls._context = None
+        self.start_server()
+
+    def create_server(self):
+        return calypso.HTTPSServer(("127.0.0.1", 0), calypso.CollectionHTTPHandler)
+
+    def tearDown(self):
+        tls._context = None
+        calypso.config.set("server", "handshake_timeout", "10")
+        super(TestTLS, self).tearDown()
+
+    def test_request(self):
+        before = tls.HANDSHAKES.value(result="ok")
+        sock = ssl.wrap_socket(socket.create_connection(self.server.server_address))
+        try:
+            sock.sendall("GET /alice/cal/ HTTP/1.1\r\nHost: localhost\r\n"
+                         "Connection: close\r\n\r\n")
+            self.assertTrue(sock.recv(4096).startswith("HTTP/1.1 200"))
+        finally:
+            sock.close()
+        self.assertEqual(tls.HANDSHAKES.value(result="ok"), before + 1)
+
+    def test_failed_handshake(self):
+        before = tls.HANDSHAKES.value(result="failed")
+        sock = socket.create_connection(self.server.server_address)
+        try:
+            sock.sendall("GET / HTTP/1.1\r\n\r\n")
+            sock.settimeout(5)
+            try:
+                sock.recv(4096)
+            except socket.error:
+                pass
+        finally:
+            sock.close()
+        # The server is free for the next client once the handshake failed
+        sock = ssl.wrap_socket(socket.create_connection(self.server.server_address))
+        sock.close()
+        self.assertEqual(tls.HANDSHAKES.value(result="failed"), before + 1)
+
+    def get(self, sock, close=True):
+        sock.sendall("GET /alice/cal/ HTTP/1.1\r\nHost: localhost\r\n%s\r\n"
+                     % ("Connection: close\r\n" if close else ""))
+        return sock.recv(4096)
+
+    def test_stalled_handshake(self):
+        # A client that never completes its handshake does not hold up others
+        stalled = socket.create_connection(self.server.server_address)
+        try:
+            time.sleep(0.2)
+            start = time.time()
+            sock = ssl.wrap_socket(socket.create_connection(self.server.server_address))
+            try:
+                self.assertTrue(self.get(sock).startswith("HTTP/1.1 200"))
+            finally:
+                sock.close()
+            self.assertTrue(time.time() - start < 1.5)
+        finally:
+            stalled.close()
+
+    def test_idle_connection(self):
+        # An idle persistent connection is given up for a waiting client
+        idle = ssl.wrap_socket(socket.create_connection(self.server.server_address))
+        try:
+            self.assertTrue(self.get(idle, close=False).startswith("HTTP/1.1 200"))
+            start = time.time()
+            sock = ssl.wrap_socket(socket.create_connection(self.server.server_address))
+            try:
+                self.assertTrue(self.get(sock).startswith("HTTP/1.1 200"))
+            finally:
+                sock.close()
+            self.assertTrue(time.time() - start < 5)
+        finally:
+            idle.close()
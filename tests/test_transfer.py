@@ -0,0 +1,93 @@
+# vim: set fileencoding=utf-8 :
+"""Test server-side MOVE and COPY"""
+
+import os
+import subprocess
+
+from .testutils import EVENT, ServerTestCase
+
+
+class TestTransfer(ServerTestCase):
+
+    def setUp(self):
+        super(TestTransfer, self).setUp()
+        for name in ("work", "home"):
+            os.makedirs(os.path.join(self.tmpdir, "alice", name))
+        # A collection with a git repository of its own
+        self.other = os.path.join(self.tmpdir, "alice", "other")
+        os.makedirs(self.other)
+        subprocess.call(["git", "init", "-q", self.other])
+        subprocess.call(["git", "config", "user.email", "calypso@example.com"], cwd=self.other)
+        subprocess.call(["git", "config", "user.name", "cal Ypso"], cwd=self.other)
+        self.start_server()
+        self.etag = self.request("PUT", "/alice/work/event.ics", EVENT % ("event", "Test"),
+                                 expected=201).getheader("ETag")
+
+    def destination(self, path):
+        return "http://%s:%d%s" % (self.server.server_address + (path,))
+
+    def commits(self, repository):
+        return subprocess.check_output(["git", "log", "--format=%s"], cwd=repository).splitlines()
+
+    def test_options(self):
+        allow = self.request("OPTIONS", "/alice/work/", expected=200).getheader("Allow")
+        self.assertTrue("MOVE" in allow and "COPY" in allow)
+
+    def test_move(self):
+        commits = len(self.commits(self.tmpdir))
+        response = self.request("MOVE", "/alice/work/event.ics", headers={
+            "Destination": self.destination("/alice/home/event.ics")}, expected=201)
+        self.assertEqual(response.getheader("ETag"), self.etag)
+        self.request("GET", "/alice/work/event.ics", expected=410)
+        response = self.request("GET", "/alice/home/event.ics", expected=200)
+        self.assertTrue("UID:event@example.com" in response.body)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, "alice", "work")), [])
+        # A single commit, git sees the file renamed
+        self.assertEqual(len(self.commits(self.tmpdir)), commits + 1)
+        status = subprocess.check_output(
+            ["git", "show", "-M", "--name-status", "--format="], cwd=self.tmpdir)
+        self.assertTrue(status.startswith("R100"))
+        self.assertEqual(subprocess.check_output(
+            ["git", "status", "--porcelain", "alice/work", "alice/home"], cwd=self.tmpdir), "")
+
+    def test_move_to_other_repository(self):
+        self.request("MOVE", "/alice/work/event.ics", headers={
+            "Destination": self.destination("/alice/other/event.ics")}, expected=201)
+        self.request("GET", "/alice/work/event.ics", expected=410)
+        self.request("GET", "/alice/other/event.ics", expected=200)
+        self.assertEqual(len(self.commits(self.other)), 1)
+
+    def test_copy_renamed(self):
+        self.request("COPY", "/alice/work/event.ics", headers={
+            "Destination": self.destination("/alice/home/copy.ics")}, expected=201)
+        self.request("GET", "/alice/work/event.ics", expected=200)
+        response = self.request("GET", "/alice/home/copy.ics", expected=200)
+        self.assertTrue("X-CALYPSO-NAME:copy.ics" in response.body)
+        self.assertTrue("UID:event@example.com" in response.body)
+
+    def test_overwrite(self):
+        self.request("PUT", "/alice/home/event.ics", EVENT % ("old", "Test"), expected=201)
+        headers = {"Destination": self.destination("/alice/home/event.ics"),
+                   "Overwrite": "F"}
+        self.request("COPY", "/alice/work/event.ics", headers=headers, expected=412)
+        headers["Overwrite"] = "T"
+        self.request("COPY", "/alice/work/event.ics", headers=headers, expected=204)
+        response = self.request("GET", "/alice/home/event.ics", expected=200)
+        self.assertTrue("UID:event@example.com" in response.body)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir, "alice", "home"))), 1)
+
+    def test_if_match(self):
+        headers = {"Destination": self.destination("/alice/home/event.ics"),
+                   "If-Match": '"nope"'}
+        self.request("MOVE", "/alice/work/event.ics", headers=headers, expected=412)
+        headers["If-Match"] = self.etag
+        self.request("MOVE", "/alice/work/event.ics", headers=headers, expected=201)
+
+    def test_errors(self):
+        self.request("MOVE", "/alice/work/missing.ics", headers={
+            "Destination": self.destination("/alice/home/missing.ics")}, expected=404)
+        self.request("MOVE", "/alice/work/event.ics", expected=409)
+        self.request("MOVE", "/alice/work/event.ics", headers={
+            "Destination": self.destination("/alice/work/event.ics")}, expected=403)
+        self.request("MOVE", "/alice/work/", headers={
+            "Destination": self.destination("/alice/home/")}, expected=403)
@@ -0,0 +1,52 @@
+# vim: set fileencoding=utf-8 :
+"""Test the shared time zone cache"""
+
+import datetime
+import unittest
+
+import dateutil.tz
+
+from calypso import tzcache
+from calypso.webdav import Item
+
+EVENT = """BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VTIMEZONE
+TZID:Europe/Oslo
+BEGIN:STANDARD
+DTSTART:19701025T030000
+RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=10
+TZOFFSETFROM:+0200
+TZOFFSETTO:+0100
+END:STANDARD
+BEGIN:DAYLIGHT
+DTSTART:19700329T020000
+RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3
+TZOFFSETFROM:+0100
+TZOFFSETTO:+0200
+END:DAYLIGHT
+END:VTIMEZONE
+BEGIN:VEVENT
+UID:%s
+DTSTART;TZID=Europe/Oslo:%s
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class TestTzCache(unittest.TestCase):
+
+    def test_shared_tzinfo(self):
+        first = Item(EVENT % ("a", "20150701T100000"), None, None, "")
+        second = Item(EVENT % ("b", "20151201T100000"), None, None, "")
+        summer = first.object.vevent.dtstart.value
+        winter = second.object.vevent.dtstart.value
+        self.assertTrue(first.object.vtimezone.tzinfo is second.object.vtimezone.tzinfo)
+        self.assertEqual(summer.utcoffset(), datetime.timedelta(hours=2))
+        self.assertEqual(winter.utcoffset(), datetime.timedelta(hours=1))
+
+    def test_bound(self):
+        self.assertTrue(tzcache.bound("20150101T000000Z") is tzcache.bound("20150101T000000Z"))
+        self.assertEqual(tzcache.bound("20150101T000000Z").utcoffset(), datetime.timedelta(0))
+        self.assertTrue(tzcache.bound("20150101T000000").tzinfo is tzcache.local())
+        self.assertTrue(isinstance(tzcache.local(), dateutil.tz.tzlocal))
@@ -0,0 +1,51 @@
+# vim: set fileencoding=utf-8 :
+"""Test startup warm-up of collections"""
+
+import os
+import subprocess
+
+import calypso.config
+from calypso.cache import CollectionCache
+from calypso import export, paths, warmup
+
+from .testutils import CalypsoTestCase
+
+
+class TestWarmup(CalypsoTestCase):
+
+    def make_repo(self, name, mtime):
+        path = os.path.join(self.tmpdir, name)
+        os.makedirs(path)
+        subprocess.call(["git", "init", "-q", path])
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_discover_most_recent_first(self):
+        self.make_repo("alice/old", 1000)
+        self.make_repo("bob/new", 2000)
+        # the storage folder itself is a repository without an index
+        os.utime(self.tmpdir, (500, 500))
+        self.assertEqual(warmup.discover(), ["/bob/new", "/alice/old", "/"])
+
+    def test_run(self):
+        self.make_repo("alice/cal", 1000)
+        warmup.ready.clear()
+        collections = CollectionCache(max_collections=0, max_memory=0, idle_timeout=0)
+        warmup.run(collections)
+        self.assertTrue(warmup.ready.is_set())
+        self.assertTrue("/alice/cal" in collections)
+        self.assertTrue("/" in collections)
+
+    def test_base_prefix(self):
+        self.make_repo("alice/cal", 1000)
+        calypso.config.set("server", "base_prefix", "/dav/")
+        try:
+            urls = warmup.discover()
+            # Warm-up fills the cache keys requests look up
+            self.assertEqual(sorted(urls), ["/dav", "/dav/alice/cal"])
+            self.assertTrue(paths.collection_from_path("/dav/alice/cal/event.ics") in urls)
+            self.assertTrue(paths.collection_from_path("/dav/") in urls)
+            self.assertEqual(export.destination("out", "/dav/alice/cal"),
+                             os.path.join("out", "alice", "cal.ics"))
+        finally:
+            calypso.config.set("server", "base_prefix", "/")
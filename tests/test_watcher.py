@@ -0,0 +1,62 @@
+# vim: set fileencoding=utf-8 :
+"""Test inotify driven change detection"""
+
+import os
+import shutil
+import time
+import unittest
+
+import calypso.config
+from calypso.webdav import Collection
+from calypso import watcher
+
+from .testutils import CalypsoTestCase
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@unittest.skipIf(watcher._load_libc() is None, "inotify not available")
+class TestWatcher(CalypsoTestCase):
+    test_vcard = "tests/data/import.vcard"
+
+    def setUp(self):
+        super(TestWatcher, self).setUp()
+        calypso.config.set('storage', 'watch', 'True')
+
+    def tearDown(self):
+        calypso.config.set('storage', 'watch', 'False')
+        super(TestWatcher, self).tearDown()
+
+    def test_external_changes(self):
+        collection = Collection("")
+        self.assertTrue(collection.watched)
+        self.assertEqual(len(collection.items), 0)
+
+        shutil.copy(self.test_vcard, os.path.join(self.tmpdir, "new.vcf"))
+        self.assertTrue(wait_for(lambda: len(collection.items) == 1))
+        ctag = collection.ctag
+
+        os.unlink(os.path.join(self.tmpdir, "new.vcf"))
+        self.assertTrue(wait_for(lambda: len(collection.items) == 0))
+        self.assertNotEqual(ctag, collection.ctag)
+
+    def test_clean_collection_is_not_rescanned(self):
+        collection = Collection("")
+        collection.items
+        scans = []
+        collection.scan_paths = lambda changed: scans.append(changed)
+        collection.items
+        collection.ctag
+        self.assertEqual(scans, [])
+
+        with open(os.path.join(self.tmpdir, "other.vcf"), "w") as f:
+            f.write("junk")
+        self.assertTrue(wait_for(lambda: collection.items is not None and scans))
+        self.assertEqual(scans[0], set([os.path.join(self.tmpdir, "other.vcf")]))
@@ -1,10 +1,17 @@
+import httplib
 import shutil
 import subprocess
 import tempfile
+import threading
 import unittest
 
+import calypso
 import calypso.config
 
+EVENT = ("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nBEGIN:VEVENT\r\n"
+         "UID:%s@example.com\r\nDTSTART:20150101T100000Z\r\n"
+         "SUMMARY:%s\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n")
+
 
 class CalypsoTestCase(unittest.TestCase):
 
@@ -18,3 +25,41 @@ class CalypsoTestCase(unittest.TestCase):
     def tearDown(self):
         if self.tmpdir:
             shutil.rmtree(self.tmpdir)
+
+
+class ServerTestCase(CalypsoTestCase):
+    """Test case talking to a server run in a thread.
+
+    ``start_server`` starts it, once the storage folder is ready; it is
+    stopped before the folder is removed.
+
+    """
+    server = None
+
+    def create_server(self):
+        return calypso.HTTPServer(("127.0.0.1", 0), calypso.CollectionHTTPHandler)
+
+    def start_server(self):
+        calypso.CollectionHTTPHandler.collections.clear()
+        self.server = self.create_server()
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.1,))
+        self.thread.start()
+        self.connection = httplib.HTTPConnection(*self.server.server_address[:2], timeout=10)
+
+    def tearDown(self):
+        if self.server is not None:
+            self.connection.close()
+            self.server.shutdown()
+            self.thread.join()
+            self.server.server_close()
+            self.server = None
+        super(ServerTestCase, self).tearDown()
+
+    def request(self, method, path, body=None, headers={}, expected=None):
+        """Send a request on the connection; return the response, its body read."""
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        response.body = response.read()
+        if expected is not None:
+            self.assertEqual(response.status, expected)
+        return response